@@ -0,0 +1,163 @@
+"""
+Delta-sync change feed for trips and ride requests (GET /changes)
+
+Dashboards and the simulator used to re-fetch the full active lists in a loop. The feed
+returns only rows inserted, updated or deleted since a cursor, in compact columnar form,
+so a client keeps a local mirror and each poll costs what changed, not fleet size.
+
+Change sequence (installed by migrate_database.py):
+    - A trigger sets trips.change_seq / ride_requests.change_seq on every INSERT and
+      UPDATE (ORM writes, bulk updates and location_buffer's batched UPDATEs alike) to
+      the writing transaction's id, txid_current(): 64-bit and only ever increasing
+    - A DELETE trigger records a tombstone (kind, row_id, change_seq) in row_tombstones
+    - Rows are only handed out below the xmin of the current snapshot: every transaction
+      below it has finished, so a write that commits late can't land behind a cursor the
+      client already holds. (A plain sequence can't promise that: values are taken in one
+      order and committed in another.)
+
+Cursors are opaque. Without one the feed starts an initial sync (active rows only, as of
+one fixed horizon); follow `cursor` while `more` is true, then keep polling with the last
+cursor. Tombstones are pruned after CHANGE_FEED_TOMBSTONE_HOURS; a cursor older than that
+gets reset=true and should start over without a cursor.
+
+Environment Variables:
+    CHANGE_FEED_PAGE: Default max changes per response (default 500)
+    CHANGE_FEED_TOMBSTONE_HOURS: How long deletions stay in the feed (default 48)
+    CHANGE_FEED_PRUNE_SECONDS: How often an instance prunes old tombstones (default 3600)
+"""
+
+import os
+import time
+import logging
+from datetime import datetime, timedelta
+from typing import List, NamedTuple, Optional, Sequence
+
+from sqlalchemy import text, tuple_
+from sqlalchemy.orm import Session
+
+from models import RowTombstone
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+CHANGE_FEED_PAGE = int(os.getenv("CHANGE_FEED_PAGE", "500"))
+CHANGE_FEED_TOMBSTONE_HOURS = float(os.getenv("CHANGE_FEED_TOMBSTONE_HOURS", "48"))
+CHANGE_FEED_PRUNE_SECONDS = float(os.getenv("CHANGE_FEED_PRUNE_SECONDS", "3600"))
+
+# Tombstone row that remembers the highest change_seq pruned so far
+PRUNED_KIND = "pruned"
+
+
+class Feed(NamedTuple):
+    name: str          # Key in the response, e.g. "trips"
+    kind: str          # Tombstone kind written by the DELETE trigger, e.g. "trip"
+    model: type
+    fields: Sequence[str]
+    active: object     # SQL expression: row belongs on the map (what the /active endpoints list)
+
+
+class Cursor(NamedTuple):
+    full: bool    # Initial sync: active rows only, no tombstones, below a fixed horizon
+    hi: int       # That horizon (full sync only)
+    seq: int      # Last position handed out: (change_seq, source rank, id)
+    rank: int
+    row_id: int
+
+
+def encode_cursor(cursor: Cursor) -> str:
+    return ".".join(str(int(v)) for v in cursor)
+
+
+def decode_cursor(value: str) -> Cursor:
+    """Raises ValueError for anything that isn't a cursor from encode_cursor()."""
+    parts = [int(p) for p in value.split(".")]
+    if len(parts) != 5 or parts[0] not in (0, 1):
+        raise ValueError("Invalid cursor")
+    return Cursor(bool(parts[0]), *parts[1:])
+
+
+def _after(seq_col, id_col, rank: int, pos: Cursor):
+    """Rows of source `rank` positioned after pos in (change_seq, rank, id) order."""
+    if rank > pos.rank:
+        return seq_col >= pos.seq
+    if rank < pos.rank:
+        return seq_col > pos.seq
+    return tuple_(seq_col, id_col) > tuple_(pos.seq, pos.row_id)
+
+
+_next_prune = 0.0
+
+
+def _maybe_prune(db: Session) -> None:
+    """Drop tombstones past retention (at most every CHANGE_FEED_PRUNE_SECONDS per instance)."""
+    global _next_prune
+    if time.monotonic() < _next_prune:
+        return
+    _next_prune = time.monotonic() + CHANGE_FEED_PRUNE_SECONDS
+    cutoff = datetime.utcnow() - timedelta(hours=CHANGE_FEED_TOMBSTONE_HOURS)
+    pruned = db.execute(text(
+        "WITH gone AS (DELETE FROM row_tombstones WHERE kind <> :pruned AND deleted_at < :cutoff RETURNING change_seq) "
+        "SELECT count(*), max(change_seq) FROM gone"
+    ), {"pruned": PRUNED_KIND, "cutoff": cutoff}).first()
+    if pruned[0]:
+        marker = db.query(RowTombstone).filter(RowTombstone.kind == PRUNED_KIND).first()
+        if marker is None:
+            db.add(RowTombstone(kind=PRUNED_KIND, row_id=0, change_seq=pruned[1]))
+        else:
+            marker.change_seq = max(marker.change_seq, pruned[1])
+        logger.info(f"Change feed: pruned {pruned[0]} tombstone(s) up to change_seq {pruned[1]}")
+    db.commit()
+
+
+def read(db: Session, feeds: Sequence[Feed], since: Optional[str], limit: int = CHANGE_FEED_PAGE) -> dict:
+    """One page of the feed after cursor `since` (None: start an initial sync)."""
+    pos = decode_cursor(since) if since else Cursor(True, 0, -1, -1, 0)
+    _maybe_prune(db)
+    xmin = db.execute(text("SELECT txid_snapshot_xmin(txid_current_snapshot())")).scalar()
+    hi = (pos.hi or xmin) if pos.full else xmin
+
+    body = {name: {"fields": [*fields, "active"], "rows": [], "deleted": []} for name, _, _, fields, _ in feeds}
+    if not pos.full:
+        pruned_through = db.query(RowTombstone.change_seq).filter(RowTombstone.kind == PRUNED_KIND).scalar()
+        if pruned_through is not None and pos.seq <= pruned_through:
+            return {"reset": True, "cursor": None, "more": False, "full": False, **body}
+
+    # Each source in (change_seq, id) order; merged by (change_seq, rank, id)
+    entries: List[tuple] = []
+    for rank, feed in enumerate(feeds):
+        model = feed.model
+        query = db.query(
+            model.change_seq, model.id, *[getattr(model, f) for f in feed.fields], feed.active
+        ).filter(model.change_seq < hi, _after(model.change_seq, model.id, rank, pos))
+        if pos.full:
+            query = query.filter(feed.active)
+        for row in query.order_by(model.change_seq, model.id).limit(limit + 1):
+            entries.append((row[0], rank, row[1], feed.name, list(row[2:-1]) + [bool(row[-1])]))
+    if not pos.full:
+        rank = len(feeds)
+        names = {feed.kind: feed.name for feed in feeds}
+        query = db.query(RowTombstone).filter(
+            RowTombstone.kind.in_(list(names)),
+            RowTombstone.change_seq < hi,
+            _after(RowTombstone.change_seq, RowTombstone.id, rank, pos),
+        ).order_by(RowTombstone.change_seq, RowTombstone.id).limit(limit + 1)
+        for tomb in query:
+            entries.append((tomb.change_seq, rank, tomb.id, names[tomb.kind], tomb.row_id))
+
+    entries.sort(key=lambda e: e[:3])
+    more = len(entries) > limit
+    entries = entries[:limit]
+    for seq, rank, _, name, payload in entries:
+        if rank < len(feeds):
+            body[name]["rows"].append(payload)
+        else:
+            body[name]["deleted"].append(payload)
+
+    if more:
+        last = entries[-1]
+        cursor = Cursor(pos.full, hi if pos.full else 0, last[0], last[1], last[2])
+    else:
+        # Everything below hi has been handed out: continue with changes from hi on
+        cursor = Cursor(False, 0, hi, -1, 0)
+    return {"reset": False, "cursor": encode_cursor(cursor), "more": more, "full": pos.full, **body}
@@ -13,13 +13,18 @@ Environment Variables:
     Cloud Run (production):
         - INSTANCE_CONNECTION_NAME: Cloud SQL instance (e.g., project:region:instance)
         - DB_USER, DB_PASSWORD, DB_NAME: Database credentials
+
+    Diagnostics:
+        - DB_QUERY_COUNT: "1" to count SQL statements per HTTP request (main.py returns the
+          count in an X-DB-Queries header; test_flows.py checks it against query budgets)
 """
 
 import os
 import time
 import logging
-from typing import Optional
-from sqlalchemy import create_engine, text, pool
+from contextvars import ContextVar
+from typing import List, Optional
+from sqlalchemy import create_engine, event, text, pool
 from sqlalchemy.orm import DeclarativeBase, sessionmaker
 from dotenv import load_dotenv
 
@@ -39,6 +44,8 @@ DB_PASSWORD = os.getenv("DB_PASSWORD")
 DB_NAME = os.getenv("DB_NAME", "skipooldb")
 INSTANCE_CONNECTION_NAME = os.getenv("INSTANCE_CONNECTION_NAME", "skipool-483602:us-central1:skipooldb")
 
+DB_QUERY_COUNT = os.getenv("DB_QUERY_COUNT", "0") == "1"
+
 # Connection retry settings
 MAX_RETRIES = 3
 RETRY_DELAYS = [2, 4, 8]  # Exponential backoff: 2s, 4s, 8s
@@ -190,6 +197,16 @@ def verify_connection(engine) -> bool:
 logger.info("Initializing database connection...")
 engine = create_engine_with_retry()
 
+# Per-request statement counter (set by main.py's middleware; copied into threadpool workers)
+query_counter: ContextVar[Optional[List[int]]] = ContextVar("query_counter", default=None)
+
+if DB_QUERY_COUNT:
+    @event.listens_for(engine, "before_cursor_execute")
+    def _count_query(conn, cursor, statement, parameters, context, executemany):
+        counter = query_counter.get()
+        if counter is not None:
+            counter[0] += 1
+
 # Create session factory
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
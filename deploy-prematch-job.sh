@@ -0,0 +1,54 @@
+#!/bin/bash
+# Script to deploy the nightly scheduled-match pre-computation job to Cloud Run
+# Usage: ./deploy-prematch-job.sh
+#
+# Reuses the API image (prematch.py imports the matcher from main.py) and runs
+# "python prematch.py --yes --loop", which refreshes tomorrow's snapshots for
+# every resort until the evening window closes. Trigger it from Cloud Scheduler
+# shortly after PREMATCH_WINDOW_START_HOUR.
+
+set -e
+
+PROJECT_ID="skipool-483602"
+REGION="us-central1"
+JOB_NAME="skipool-prematch"
+IMAGE_NAME="gcr.io/${PROJECT_ID}/skipool-backend:latest"
+CLOUDSQL_INSTANCE="skipool-483602:us-central1:skipooldb"
+
+echo "🚀 Deploying SkiPool Prematch Job to Cloud Run"
+echo "================================================"
+echo "Project: ${PROJECT_ID}"
+echo "Region: ${REGION}"
+echo "Job Name: ${JOB_NAME}"
+echo ""
+
+# Build the Docker image
+echo "📦 Building Docker image..."
+docker build -t ${IMAGE_NAME} -f Dockerfile .
+
+# Push the image to Google Container Registry
+echo "📤 Pushing image to GCR..."
+docker push ${IMAGE_NAME}
+
+# Deploy as Cloud Run Job
+echo "🚀 Deploying Cloud Run Job..."
+gcloud run jobs deploy ${JOB_NAME} \
+  --image=${IMAGE_NAME} \
+  --region=${REGION} \
+  --set-cloudsql-instances=${CLOUDSQL_INSTANCE} \
+  --command=python \
+  --args=prematch.py,--yes,--loop \
+  --max-retries=1 \
+  --task-timeout=28800 \
+  --memory=512Mi \
+  --cpu=1 \
+  --project=${PROJECT_ID}
+
+echo ""
+echo "✅ Prematch job deployed successfully!"
+echo ""
+echo "To run it now, execute:"
+echo "  gcloud run jobs execute ${JOB_NAME} --region=${REGION} --project=${PROJECT_ID}"
+echo ""
+echo "To view logs:"
+echo "  gcloud run jobs executions list --job=${JOB_NAME} --region=${REGION} --project=${PROJECT_ID}"
@@ -0,0 +1,226 @@
+"""
+Read-through cache of Trip / RideRequest rows by id
+
+Most traffic is polling GETs of one trip or request (or a matched pair) by
+primary key. Rows are cached per process as plain column snapshots (never ORM
+objects, which belong to a session) and handed out as fresh transient instances,
+so a caller can't change what the next request sees.
+
+Consistency:
+    - Every committed ORM write to a Trip / RideRequest invalidates its entry:
+      track(SessionLocal) collects the rows each flush touches and invalidates them
+      when the transaction ends, so no endpoint has to remember to do it
+    - Version stamps: a cache-wide clock ticks on every invalidation and remembers
+      when each key was last written. A loader takes stamp() *before* reading the
+      DB and store() refuses the snapshot if the key was written since, so a read
+      that raced with a write can't put the old row back
+    - Writes outside the ORM (location_buffer's batched UPDATEs) patch the cached
+      columns through apply(); bulk query updates call invalidate_where()
+    - Lifecycle changes committed on another instance arrive as pub/sub status messages;
+      main.py invalidates the pair before the bus wakes local subscribers, so a woken
+      long-poll reloads from the DB. Positions taken on another instance arrive as location
+      messages and are patched in through apply(), as a local flush would. After a listener
+      reconnect (messages lost) the whole cache is cleared
+    - Entries also expire after ENTITY_CACHE_TTL_SECONDS, which bounds staleness
+      for other writes that land on another instance
+
+Environment Variables:
+    ENTITY_CACHE_ENABLED: "0" to always read from the DB (default "1")
+    ENTITY_CACHE_MAX: Max rows cached, least recently used evicted first (default 20000)
+    ENTITY_CACHE_TTL_SECONDS: Max age of a cached row (default 10)
+"""
+
+import os
+import time
+import threading
+import logging
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, Optional, Set, Tuple
+
+from sqlalchemy import event, inspect
+
+from models import Trip, RideRequest
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+ENTITY_CACHE_ENABLED = os.getenv("ENTITY_CACHE_ENABLED", "1") == "1"
+ENTITY_CACHE_MAX = int(os.getenv("ENTITY_CACHE_MAX", "20000"))
+ENTITY_CACHE_TTL_SECONDS = float(os.getenv("ENTITY_CACHE_TTL_SECONDS", "10"))
+
+TRIP = "trip"
+REQUEST = "request"
+MODELS = {TRIP: Trip, REQUEST: RideRequest}
+_KINDS = {Trip: TRIP, RideRequest: REQUEST}
+
+Key = Tuple[str, int]
+
+
+class Entry:
+    __slots__ = ("snapshot", "version", "loaded_at")
+
+    def __init__(self, snapshot: dict, version: int, loaded_at: float):
+        self.snapshot = snapshot
+        self.version = version    # Clock value the snapshot is valid from
+        self.loaded_at = loaded_at
+
+
+def snapshot(obj) -> dict:
+    """Column values of a loaded row (take it before any location overlay)."""
+    return {attr.key: getattr(obj, attr.key) for attr in inspect(obj).mapper.column_attrs}
+
+
+def materialize(kind: str, snap: dict):
+    """A fresh transient Trip / RideRequest from a snapshot."""
+    return MODELS[kind](**snap)
+
+
+class EntityCache:
+    """(kind, id) -> Entry with version stamps, TTL and LRU bound."""
+
+    def __init__(self, max_entries: int = ENTITY_CACHE_MAX, ttl: float = ENTITY_CACHE_TTL_SECONDS):
+        self.enabled = ENTITY_CACHE_ENABLED
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[Key, Entry]" = OrderedDict()
+        self._clock = 0
+        # Clock value of the last write per key; bounded, older writes fold into _written_floor
+        self._written: "OrderedDict[Key, int]" = OrderedDict()
+        self._written_floor = 0
+        self._lock = threading.Lock()
+        self.counters = {
+            "hits": 0,
+            "misses": 0,
+            "expired": 0,
+            "stores": 0,
+            "stale_rejected": 0,
+            "invalidations": 0,
+            "patches": 0,
+            "evictions": 0,
+        }
+
+    def stamp(self) -> int:
+        """Current clock; take it before reading rows you intend to store()."""
+        return self._clock
+
+    def lookup(self, kind: str, row_id: int) -> Optional[Entry]:
+        """Fresh entry for a row, or None (counted as a miss)."""
+        if not self.enabled:
+            return None
+        key = (kind, row_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry.loaded_at >= self.ttl:
+                del self._entries[key]
+                self.counters["expired"] += 1
+                entry = None
+            if entry is None:
+                self.counters["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.counters["hits"] += 1
+            return entry
+
+    def store(self, kind: str, obj, stamp: int) -> bool:
+        """Cache a row loaded after stamp(); refused if the row was written since."""
+        if not self.enabled or obj is None:
+            return False
+        key = (kind, obj.id)
+        snap = snapshot(obj)
+        with self._lock:
+            if self._written.get(key, self._written_floor) > stamp:
+                self.counters["stale_rejected"] += 1
+                return False
+            self._entries[key] = Entry(snap, stamp, time.monotonic())
+            self._entries.move_to_end(key)
+            self.counters["stores"] += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.counters["evictions"] += 1
+        return True
+
+    def _written_now(self, key: Key) -> int:
+        """Record a write to key (lock held); returns the new clock value."""
+        self._clock += 1
+        self._written[key] = self._clock
+        self._written.move_to_end(key)
+        while len(self._written) > self.max_entries * 2:
+            _, clock = self._written.popitem(last=False)
+            self._written_floor = max(self._written_floor, clock)
+        return self._clock
+
+    def invalidate(self, kind: str, row_ids: Iterable[int]) -> None:
+        with self._lock:
+            for row_id in row_ids:
+                key = (kind, row_id)
+                self._written_now(key)
+                if self._entries.pop(key, None) is not None:
+                    self.counters["invalidations"] += 1
+
+    def clear(self) -> None:
+        """Drop every entry; loads that started before are refused (writes we can't attribute, e.g. missed)."""
+        with self._lock:
+            self._clock += 1
+            self._written.clear()
+            self._written_floor = self._clock
+            self.counters["invalidations"] += len(self._entries)
+            self._entries.clear()
+
+    def invalidate_where(self, kind: str, predicate: Callable[[dict], bool]) -> None:
+        """Invalidate cached rows of a kind whose snapshot matches (after a bulk UPDATE)."""
+        with self._lock:
+            row_ids = [key[1] for key, entry in self._entries.items() if key[0] == kind and predicate(entry.snapshot)]
+        self.invalidate(kind, row_ids)
+
+    def apply(self, kind: str, changes: Dict[int, dict]) -> None:
+        """A committed write outside the ORM set these columns: patch cached rows in place."""
+        with self._lock:
+            for row_id, values in changes.items():
+                key = (kind, row_id)
+                version = self._written_now(key)
+                entry = self._entries.get(key)
+                if entry is not None:
+                    entry.snapshot = {**entry.snapshot, **values}
+                    entry.version = version
+                    self.counters["patches"] += 1
+
+    def stats(self) -> dict:
+        lookups = self.counters["hits"] + self.counters["misses"]
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "clock": self._clock,
+            **self.counters,
+            "hit_ratio": round(self.counters["hits"] / lookups, 4) if lookups else None,
+        }
+
+
+cache = EntityCache()
+
+
+def track(session_factory) -> None:
+    """Invalidate every Trip / RideRequest a session flushes once its transaction ends."""
+
+    @event.listens_for(session_factory, "after_flush")
+    def _collect(session, flush_context):
+        touched: Set[Key] = session.info.setdefault("entity_cache_touched", set())
+        for obj in list(session.dirty) + list(session.deleted):
+            kind = _KINDS.get(type(obj))
+            if kind is not None and obj.id is not None:
+                touched.add((kind, obj.id))
+
+    def _invalidate(session):
+        touched = session.info.pop("entity_cache_touched", None)
+        if not touched:
+            return
+        by_kind: Dict[str, list] = {}
+        for kind, row_id in touched:
+            by_kind.setdefault(kind, []).append(row_id)
+        for kind, row_ids in by_kind.items():
+            cache.invalidate(kind, row_ids)
+
+    # After commit the new rows are visible to the next loader; after rollback nothing
+    # changed, but invalidating anyway is harmless and keeps savepoint handling simple
+    event.listen(session_factory, "after_commit", _invalidate)
+    event.listen(session_factory, "after_rollback", _invalidate)
@@ -0,0 +1,340 @@
+"""
+Hub Registry for SkiPool
+
+Resorts, park-and-ride hubs and the resort -> hub mapping are loaded from a
+versioned JSON data file (hubs.json by default) instead of being hardcoded in
+main.py, so new UTA park-and-rides or resorts can be added without a code change.
+Point HUB_REGISTRY_PATH at a Cloud Storage volume mount to update it without
+redeploying.
+
+Each load builds an immutable HubRegistry with:
+    - a KD-tree (scipy cKDTree) over hub coordinates for nearest-hub and
+      within-radius queries
+    - precomputed per-resort hub lists
+    - a DistanceMatrix: hub-to-hub and resort-to-hub distances plus resort-to-hub
+      bearings as NumPy arrays, so hub scoring never recomputes fixed-point
+      haversines and gets driver-route cross-track for all hubs in one vector op
+
+Hot reload swaps the module-level registry reference atomically: readers call
+get_registry() once per request and keep using that snapshot, so a reload never
+blocks or mixes versions within a request. A bad file is rejected and the
+current registry stays in place.
+
+Data file format:
+    {
+      "version": 1,
+      "resorts": [{"name": "Alta", "lat": 40.5883, "lng": -111.6358}, ...],
+      "hubs": {"h1": {"name": "...", "lat": 40.58, "lng": -111.88, "address": "...", ...}, ...},
+      "resort_hubs": {"Alta": ["h1", "h2"], ...}
+    }
+
+Environment Variables:
+    HUB_REGISTRY_PATH: Path to the data file (default: hubs.json next to this module)
+    HUB_REGISTRY_POLL_SECONDS: If > 0, main.py reloads when the file's mtime changes (default 0)
+
+Usage (export matrices for benchmark tooling):
+    python hubs.py --export hub_matrix.npz
+"""
+
+import os
+import sys
+import json
+import argparse
+import math
+import asyncio
+import threading
+import logging
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+HUB_REGISTRY_PATH = os.getenv(
+    "HUB_REGISTRY_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "hubs.json"),
+)
+HUB_REGISTRY_POLL_SECONDS = int(os.getenv("HUB_REGISTRY_POLL_SECONDS", "0"))
+
+EARTH_RADIUS_KM = 6371
+
+
+def _unit_vectors(lats, lngs) -> np.ndarray:
+    """Lat/lng degrees -> 3D unit vectors, so KD-tree chord distance is monotonic in great-circle distance."""
+    lat = np.radians(np.asarray(lats, dtype=float))
+    lng = np.radians(np.asarray(lngs, dtype=float))
+    return np.column_stack((np.cos(lat) * np.cos(lng), np.cos(lat) * np.sin(lng), np.sin(lat)))
+
+
+def _km_to_chord(km: float) -> float:
+    return 2.0 * math.sin(min(km / EARTH_RADIUS_KM, math.pi) / 2.0)
+
+
+def _chord_to_km(chord: float) -> float:
+    return 2.0 * EARTH_RADIUS_KM * math.asin(min(chord / 2.0, 1.0))
+
+
+def haversine_np(lat1, lng1, lat2, lng2) -> np.ndarray:
+    """Vectorized haversine (km); inputs in degrees, broadcastable."""
+    lat1, lng1, lat2, lng2 = (np.radians(np.asarray(x, dtype=float)) for x in (lat1, lng1, lat2, lng2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def bearing_np(lat1, lng1, lat2, lng2) -> np.ndarray:
+    """Vectorized initial bearing (radians, not normalized); inputs in degrees, broadcastable."""
+    lat1, lng1, lat2, lng2 = (np.radians(np.asarray(x, dtype=float)) for x in (lat1, lng1, lat2, lng2))
+    dl = lng2 - lng1
+    y = np.sin(dl) * np.cos(lat2)
+    x = np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(dl)
+    return np.arctan2(y, x)
+
+
+class DistanceMatrix:
+    """Static distances between the registry's fixed points, built once per registry load.
+
+    Arrays (row/column order follows resort_names / hub_ids):
+        hub_hub_km:          (H, H) great-circle km between hubs
+        resort_hub_km:       (R, H) great-circle km from each resort to each hub
+        resort_hub_bearing:  (R, H) initial bearing (radians) from each resort to each hub
+
+    Cross-track distance of a hub from the driver's route (start -> resort) equals its distance
+    from the great circle through the resort and the start, so with the resort as the origin
+    only the resort -> start bearing depends on the trip; the rest comes from these arrays.
+    """
+
+    def __init__(self, hub_ids: List[str], hubs: Dict[str, dict], resorts: List[dict], resort_hubs: Dict[str, List[str]]):
+        self.hub_ids = list(hub_ids)
+        self.resort_names = [r["name"] for r in resorts]
+        self.hub_index = {hid: i for i, hid in enumerate(self.hub_ids)}
+        self.resort_index = {name: i for i, name in enumerate(self.resort_names)}
+        self.hub_lat = np.array([hubs[h]["lat"] for h in self.hub_ids], dtype=float)
+        self.hub_lng = np.array([hubs[h]["lng"] for h in self.hub_ids], dtype=float)
+        self.resort_lat = np.array([r["lat"] for r in resorts], dtype=float)
+        self.resort_lng = np.array([r["lng"] for r in resorts], dtype=float)
+
+        self.hub_hub_km = haversine_np(
+            self.hub_lat[:, None], self.hub_lng[:, None], self.hub_lat[None, :], self.hub_lng[None, :]
+        )
+        self.resort_hub_km = haversine_np(
+            self.resort_lat[:, None], self.resort_lng[:, None], self.hub_lat[None, :], self.hub_lng[None, :]
+        )
+        self.resort_hub_bearing = bearing_np(
+            self.resort_lat[:, None], self.resort_lng[:, None], self.hub_lat[None, :], self.hub_lng[None, :]
+        )
+        # Column indices of each resort's valid hubs, in resort_hubs order
+        self.resort_hub_idx = {
+            name: np.array([self.hub_index[h] for h in ids if h in self.hub_index], dtype=int)
+            for name, ids in resort_hubs.items()
+        }
+
+    def indices_for_resort(self, resort: str) -> np.ndarray:
+        """Hub column indices valid for a resort (empty if unknown)."""
+        return self.resort_hub_idx.get(resort, np.array([], dtype=int))
+
+    def point_to_hubs_km(self, lat: float, lng: float, idx: Optional[np.ndarray] = None) -> np.ndarray:
+        """Distance (km) from a point to each hub, or to hubs[idx]."""
+        if idx is None:
+            return haversine_np(lat, lng, self.hub_lat, self.hub_lng)
+        return haversine_np(lat, lng, self.hub_lat[idx], self.hub_lng[idx])
+
+    def points_to_hubs_km(self, lats, lngs, idx: Optional[np.ndarray] = None) -> np.ndarray:
+        """(N, K) distance matrix (km) from N points to each hub, or to hubs[idx]."""
+        lats = np.asarray(lats, dtype=float)[:, None]
+        lngs = np.asarray(lngs, dtype=float)[:, None]
+        if idx is None:
+            return haversine_np(lats, lngs, self.hub_lat[None, :], self.hub_lng[None, :])
+        return haversine_np(lats, lngs, self.hub_lat[idx][None, :], self.hub_lng[idx][None, :])
+
+    def route_xtd_km(self, resort: str, start_lat: float, start_lng: float, idx: Optional[np.ndarray] = None) -> np.ndarray:
+        """Cross-track distance (km) of each hub (or hubs[idx]) from the route start -> resort."""
+        r = self.resort_index[resort]
+        cols = slice(None) if idx is None else idx
+        bearing_rs = bearing_np(self.resort_lat[r], self.resort_lng[r], start_lat, start_lng)
+        d = self.resort_hub_km[r, cols] / EARTH_RADIUS_KM
+        return np.abs(np.arcsin(np.sin(d) * np.sin(self.resort_hub_bearing[r, cols] - bearing_rs))) * EARTH_RADIUS_KM
+
+    def export(self, path: str, version=None) -> None:
+        """Write all arrays and their labels to an .npz file for benchmark tooling."""
+        np.savez(
+            path,
+            version=np.array(str(version)),
+            hub_ids=np.array(self.hub_ids),
+            resort_names=np.array(self.resort_names),
+            hub_lat=self.hub_lat,
+            hub_lng=self.hub_lng,
+            resort_lat=self.resort_lat,
+            resort_lng=self.resort_lng,
+            hub_hub_km=self.hub_hub_km,
+            resort_hub_km=self.resort_hub_km,
+            resort_hub_bearing=self.resort_hub_bearing,
+        )
+
+
+class HubRegistry:
+    """Immutable snapshot of resorts and hubs. Treat hubs/resorts dicts as read-only."""
+
+    def __init__(self, version, resorts: List[dict], hubs: Dict[str, dict], resort_hubs: Dict[str, List[str]]):
+        self.version = version
+        self.resorts = resorts
+        self.hubs = hubs
+        self.resort_hubs = resort_hubs
+        self._resorts_by_name = {r["name"]: r for r in resorts}
+        # Per-resort (hub_id, hub) lists, precomputed once per load
+        self._hubs_by_resort = {
+            name: [(hid, hubs[hid]) for hid in ids if hid in hubs]
+            for name, ids in resort_hubs.items()
+        }
+        self.hub_ids = list(hubs.keys())
+        if self.hub_ids:
+            self._tree = cKDTree(_unit_vectors(
+                [hubs[h]["lat"] for h in self.hub_ids],
+                [hubs[h]["lng"] for h in self.hub_ids],
+            ))
+        else:
+            self._tree = None
+        self.matrix = DistanceMatrix(self.hub_ids, hubs, resorts, resort_hubs)
+
+    def resort(self, name: str) -> Optional[dict]:
+        """Resort dict {name, lat, lng} or None."""
+        return self._resorts_by_name.get(name)
+
+    def resort_names(self) -> List[str]:
+        return [r["name"] for r in self.resorts]
+
+    def hubs_for_resort(self, resort: str) -> List[Tuple[str, dict]]:
+        """Valid (hub_id, hub) pairs for a resort, in data-file order."""
+        return self._hubs_by_resort.get(resort, [])
+
+    def nearest(self, lat: float, lng: float, k: int = 1, resort: Optional[str] = None) -> List[Tuple[str, float]]:
+        """k nearest hubs as (hub_id, distance_km), closest first. resort limits to that resort's hubs."""
+        if self._tree is None or k < 1:
+            return []
+        allowed = {hid for hid, _ in self.hubs_for_resort(resort)} if resort else None
+        # When filtering by resort, over-fetch so the filter still leaves k results
+        fetch = len(self.hub_ids) if allowed is not None else min(k, len(self.hub_ids))
+        chords, idx = self._tree.query(_unit_vectors([lat], [lng])[0], k=fetch)
+        chords, idx = np.atleast_1d(chords), np.atleast_1d(idx)
+        out = []
+        for c, i in zip(chords, idx):
+            hid = self.hub_ids[int(i)]
+            if allowed is not None and hid not in allowed:
+                continue
+            out.append((hid, _chord_to_km(float(c))))
+            if len(out) >= k:
+                break
+        return out
+
+    def within_radius(self, lat: float, lng: float, radius_km: float) -> List[Tuple[str, float]]:
+        """All hubs within radius_km as (hub_id, distance_km), closest first."""
+        if self._tree is None or radius_km <= 0:
+            return []
+        point = _unit_vectors([lat], [lng])[0]
+        idx = self._tree.query_ball_point(point, _km_to_chord(radius_km))
+        out = []
+        for i in idx:
+            hid = self.hub_ids[int(i)]
+            out.append((hid, _chord_to_km(float(np.linalg.norm(self._tree.data[int(i)] - point)))))
+        out.sort(key=lambda x: x[1])
+        return out
+
+
+def _validate(data: dict) -> None:
+    """Raise ValueError if the data file is structurally invalid."""
+    if "version" not in data:
+        raise ValueError("Hub registry is missing 'version'")
+    hubs = data.get("hubs")
+    if not isinstance(hubs, dict) or not hubs:
+        raise ValueError("Hub registry 'hubs' must be a non-empty object")
+    for hid, hub in hubs.items():
+        for field in ("name", "lat", "lng"):
+            if field not in hub:
+                raise ValueError(f"Hub '{hid}' is missing '{field}'")
+    resorts = data.get("resorts")
+    if not isinstance(resorts, list) or not resorts:
+        raise ValueError("Hub registry 'resorts' must be a non-empty list")
+    names = set()
+    for r in resorts:
+        for field in ("name", "lat", "lng"):
+            if field not in r:
+                raise ValueError(f"Resort entry {r} is missing '{field}'")
+        names.add(r["name"])
+    for resort, ids in (data.get("resort_hubs") or {}).items():
+        if resort not in names:
+            raise ValueError(f"resort_hubs references unknown resort '{resort}'")
+        missing = [h for h in ids if h not in hubs]
+        if missing:
+            raise ValueError(f"resort_hubs['{resort}'] references unknown hubs {missing}")
+
+
+def load_registry(path: str = None) -> HubRegistry:
+    """Read and validate a data file into a new HubRegistry (does not install it)."""
+    path = path or HUB_REGISTRY_PATH
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    _validate(data)
+    return HubRegistry(
+        version=data["version"],
+        resorts=data["resorts"],
+        hubs=data["hubs"],
+        resort_hubs=data.get("resort_hubs") or {},
+    )
+
+
+_reload_lock = threading.Lock()
+_registry: HubRegistry = load_registry()
+_loaded_mtime: Optional[float] = os.path.getmtime(HUB_REGISTRY_PATH)
+logger.info(f"Hub registry v{_registry.version} loaded: {len(_registry.hubs)} hubs, {len(_registry.resorts)} resorts")
+
+
+def get_registry() -> HubRegistry:
+    """Current registry snapshot. Lock-free; grab once per request."""
+    return _registry
+
+
+def reload(path: str = None) -> HubRegistry:
+    """Load the data file and atomically install it. On error the current registry is kept and the error re-raised."""
+    global _registry, _loaded_mtime
+    path = path or HUB_REGISTRY_PATH
+    with _reload_lock:
+        mtime = os.path.getmtime(path)
+        new = load_registry(path)
+        _registry = new
+        _loaded_mtime = mtime
+    logger.info(f"🔁 Hub registry reloaded: v{new.version}, {len(new.hubs)} hubs, {len(new.resorts)} resorts")
+    return new
+
+
+async def watch(poll_seconds: int = None) -> None:
+    """In-process task: reload when the data file's mtime changes."""
+    poll_seconds = poll_seconds or HUB_REGISTRY_POLL_SECONDS
+    logger.info(f"Hub registry watcher started ({HUB_REGISTRY_PATH}, every {poll_seconds}s)")
+    while True:
+        await asyncio.sleep(poll_seconds)
+        try:
+            if os.path.getmtime(HUB_REGISTRY_PATH) != _loaded_mtime:
+                await asyncio.to_thread(reload)
+        except Exception as e:
+            logger.error(f"Hub registry reload failed, keeping v{_registry.version}: {e}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='SkiPool Hub Registry')
+    parser.add_argument('--path', default=None,
+                       help='Data file to load (default: HUB_REGISTRY_PATH)')
+    parser.add_argument('--export', default=None,
+                       help='Write the distance matrices to this .npz file')
+    args = parser.parse_args()
+
+    try:
+        registry = load_registry(args.path)
+    except Exception as e:
+        print(f"❌ Invalid hub registry: {e}")
+        sys.exit(1)
+    print(f"✅ Hub registry v{registry.version}: {len(registry.hubs)} hubs, {len(registry.resorts)} resorts")
+    if args.export:
+        registry.matrix.export(args.export, version=registry.version)
+        print(f"📦 Exported distance matrices to {args.export}")
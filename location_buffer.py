@@ -0,0 +1,199 @@
+"""
+Write-behind buffer for high-frequency location updates
+
+GPS pings (PUT /trips/{id}/location, PUT /ride-requests/{id}/location) are the
+busiest write path. Instead of an UPDATE + COMMIT + REFRESH per ping, the latest
+position per row is kept in memory and flushed to Postgres in batched multi-row
+UPDATEs every LOCATION_FLUSH_SECONDS. Reads overlay the buffered position onto
+loaded rows, so the API answers with the newest fix immediately.
+
+Guarantees and observability:
+    - Only the newest fix per row is kept; superseded fixes are counted as "coalesced"
+    - A failed flush re-queues its rows (unless a newer fix arrived) and is counted
+    - main.py flushes synchronously on shutdown; anything that still can't be written
+      is logged and counted as "lost_on_shutdown"
+    - When the buffer is full, new rows are rejected ("overflow") and the caller
+      writes through to the DB instead, so nothing is silently dropped
+    - stats() backs GET /health/location-buffer
+    - on_flushed (optional) is called with each committed batch, e.g. so caches
+      holding these rows can pick up the written positions
+
+Environment Variables:
+    LOCATION_WRITE_BEHIND: "0" to write every ping straight to the DB (default "1")
+    LOCATION_FLUSH_SECONDS: Flush interval (default 2)
+    LOCATION_BUFFER_MAX: Max distinct rows buffered per table (default 10000)
+"""
+
+import os
+import time
+import asyncio
+import threading
+import logging
+from datetime import datetime
+from typing import Callable, Dict, Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+LOCATION_WRITE_BEHIND = os.getenv("LOCATION_WRITE_BEHIND", "1") == "1"
+LOCATION_FLUSH_SECONDS = float(os.getenv("LOCATION_FLUSH_SECONDS", "2"))
+LOCATION_BUFFER_MAX = int(os.getenv("LOCATION_BUFFER_MAX", "10000"))
+
+# Rows per UPDATE ... FROM (VALUES ...) statement
+FLUSH_CHUNK = 500
+
+Fix = Tuple[float, float, datetime]
+
+
+class LocationBuffer:
+    """Latest (lat, lng, received_at) per row id for one table, flushed in batches."""
+
+    def __init__(self, table: str, max_entries: int = LOCATION_BUFFER_MAX):
+        self.table = table  # Trusted constant ("trips" / "ride_requests"), interpolated into SQL
+        self.max_entries = max_entries
+        self._pending: Dict[int, Fix] = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self.counters = {
+            "accepted": 0,
+            "coalesced": 0,
+            "overflow": 0,
+            "flushed_rows": 0,
+            "flushes": 0,
+            "flush_failures": 0,
+            "requeued_rows": 0,
+            "lost_on_shutdown": 0,
+        }
+        self.last_flush_at: Optional[datetime] = None
+        self.last_flush_ms: Optional[float] = None
+        self.on_flushed: Optional[Callable[[Dict[int, Fix]], None]] = None
+
+    def put(self, row_id: int, lat: float, lng: float, received_at: datetime = None) -> bool:
+        """Buffer a fix. Returns False if the buffer is full (caller should write through)."""
+        fix = (lat, lng, received_at or datetime.utcnow())
+        with self._lock:
+            if row_id in self._pending:
+                self.counters["coalesced"] += 1
+            elif len(self._pending) >= self.max_entries:
+                self.counters["overflow"] += 1
+                return False
+            self._pending[row_id] = fix
+            self.counters["accepted"] += 1
+        return True
+
+    def get(self, row_id: int) -> Optional[Fix]:
+        """Buffered (not yet flushed) fix for a row, if any."""
+        return self._pending.get(row_id)
+
+    def discard(self, row_id: int) -> None:
+        """Forget a row (e.g. it was deleted)."""
+        with self._lock:
+            self._pending.pop(row_id, None)
+
+    def overlay(self, obj) -> None:
+        """Show the buffered fix on a loaded ORM row without marking it dirty."""
+        if obj is None:
+            return
+        fix = self._pending.get(obj.id)
+        if fix is None:
+            return
+        set_committed_value(obj, "current_lat", fix[0])
+        set_committed_value(obj, "current_lng", fix[1])
+        set_committed_value(obj, "last_location_update", fix[2])
+
+    def _drain(self) -> Dict[int, Fix]:
+        with self._lock:
+            batch, self._pending = self._pending, {}
+        return batch
+
+    def _requeue(self, batch: Dict[int, Fix]) -> None:
+        with self._lock:
+            for row_id, fix in batch.items():
+                current = self._pending.get(row_id)
+                if current is None or current[2] < fix[2]:
+                    self._pending[row_id] = fix
+                    self.counters["requeued_rows"] += 1
+
+    def flush(self, session_factory: Callable[[], Session]) -> int:
+        """Write all pending fixes with multi-row UPDATEs. Returns rows written; re-queues on failure."""
+        with self._flush_lock:
+            batch = self._drain()
+            if not batch:
+                return 0
+            t0 = time.perf_counter()
+            items = list(batch.items())
+            db = session_factory()
+            try:
+                for start in range(0, len(items), FLUSH_CHUNK):
+                    chunk = items[start:start + FLUSH_CHUNK]
+                    values, params = [], {}
+                    for i, (row_id, (lat, lng, ts)) in enumerate(chunk):
+                        values.append(
+                            f"(CAST(:id{i} AS INTEGER), CAST(:lat{i} AS DOUBLE PRECISION), "
+                            f"CAST(:lng{i} AS DOUBLE PRECISION), CAST(:ts{i} AS TIMESTAMP))"
+                        )
+                        params.update({f"id{i}": row_id, f"lat{i}": lat, f"lng{i}": lng, f"ts{i}": ts})
+                    db.execute(text(
+                        f"UPDATE {self.table} AS t SET current_lat = v.lat, current_lng = v.lng, "
+                        f"last_location_update = v.ts, updated_at = v.ts "
+                        f"FROM (VALUES {', '.join(values)}) AS v(id, lat, lng, ts) WHERE t.id = v.id"
+                    ), params)
+                db.commit()
+            except Exception as e:
+                db.rollback()
+                self.counters["flush_failures"] += 1
+                self._requeue(batch)
+                logger.warning(f"Location flush to {self.table} failed ({len(batch)} rows re-queued): {e}")
+                return 0
+            finally:
+                db.close()
+            self.counters["flushes"] += 1
+            self.counters["flushed_rows"] += len(batch)
+            self.last_flush_at = datetime.utcnow()
+            self.last_flush_ms = (time.perf_counter() - t0) * 1000
+            if self.on_flushed is not None:
+                try:
+                    self.on_flushed(batch)
+                except Exception as e:
+                    logger.error(f"Location flush callback for {self.table} failed: {e}")
+            return len(batch)
+
+    def flush_on_shutdown(self, session_factory: Callable[[], Session]) -> None:
+        """Final flush; whatever still can't be written is logged and counted as lost."""
+        self.flush(session_factory)
+        remaining = len(self._pending)
+        if remaining:
+            self.counters["lost_on_shutdown"] += remaining
+            logger.error(f"❌ {remaining} buffered {self.table} locations could not be flushed on shutdown")
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            **self.counters,
+            "last_flush_at": self.last_flush_at.isoformat() if self.last_flush_at else None,
+            "last_flush_ms": round(self.last_flush_ms, 2) if self.last_flush_ms is not None else None,
+        }
+
+
+trip_locations = LocationBuffer("trips")
+request_locations = LocationBuffer("ride_requests")
+
+
+def flush_all(session_factory: Callable[[], Session]) -> int:
+    return trip_locations.flush(session_factory) + request_locations.flush(session_factory)
+
+
+async def run_flusher(session_factory: Callable[[], Session]) -> None:
+    """In-process task: flush both buffers every LOCATION_FLUSH_SECONDS."""
+    logger.info(f"Location write-behind flusher started (every {LOCATION_FLUSH_SECONDS}s)")
+    while True:
+        await asyncio.sleep(LOCATION_FLUSH_SECONDS)
+        try:
+            await asyncio.to_thread(flush_all, session_factory)
+        except Exception as e:
+            logger.error(f"Location flush cycle failed: {e}")
@@ -0,0 +1,238 @@
+"""
+Driver location history for SkiPool
+
+Every accepted driver fix (PUT /trips/{id}/location and POST /trips/{id}/locations)
+is kept so a trip's track can be replayed later (ETA tuning, disputes, simulations).
+A row per ping would bloat Postgres, so fixes are stored append-only in per-trip
+chunks (trip_location_chunks):
+    - Coordinates are int32 fixed point (1e-7 degrees, ~1 cm) and times are
+      milliseconds; each is delta-encoded against the previous point in the chunk
+    - The three int32 delta arrays are packed and zlib-compressed into one blob;
+      a chunk holds up to LOCATION_HISTORY_CHUNK_POINTS fixes
+    - Fixes are buffered in memory per trip and flushed every
+      LOCATION_HISTORY_FLUSH_SECONDS as a single multi-row INSERT
+    - read_trip_trace() decodes a trip's chunks (plus anything not yet flushed)
+      into NumPy arrays
+
+History is best-effort: a failed flush is re-queued, a full buffer drops new
+fixes (counted), and main.py flushes on shutdown.
+
+Environment Variables:
+    LOCATION_HISTORY_ENABLED: "0" to skip writing history (default "1")
+    LOCATION_HISTORY_FLUSH_SECONDS: Flush interval (default 30)
+    LOCATION_HISTORY_CHUNK_POINTS: Max fixes per stored chunk (default 512)
+    LOCATION_HISTORY_BUFFER_MAX: Max buffered fixes across all trips (default 200000)
+"""
+
+import os
+import zlib
+import asyncio
+import threading
+import logging
+from datetime import datetime
+from typing import Callable, Dict, List, NamedTuple, Sequence, Tuple
+
+import numpy as np
+from sqlalchemy import insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from models import Trip, TripLocationChunk
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+LOCATION_HISTORY_ENABLED = os.getenv("LOCATION_HISTORY_ENABLED", "1") == "1"
+LOCATION_HISTORY_FLUSH_SECONDS = float(os.getenv("LOCATION_HISTORY_FLUSH_SECONDS", "30"))
+LOCATION_HISTORY_CHUNK_POINTS = int(os.getenv("LOCATION_HISTORY_CHUNK_POINTS", "512"))
+LOCATION_HISTORY_BUFFER_MAX = int(os.getenv("LOCATION_HISTORY_BUFFER_MAX", "200000"))
+
+# Fixed-point scale: 1e-7 degrees (~1.1 cm); +/-180 degrees still fits in int32
+COORD_SCALE = 10_000_000
+# Chunk blob layout version (stored per row so the encoding can evolve; migrate_database.py
+# has its own NumPy-free encoder for version 1)
+ENCODING_VERSION = 1
+
+_EPOCH = datetime(1970, 1, 1)
+
+Fix = Tuple[float, float, datetime]
+
+
+class Trace(NamedTuple):
+    """A decoded trip trace, oldest first."""
+    t: np.ndarray    # datetime64[ms] (UTC)
+    lat: np.ndarray  # float64 degrees
+    lng: np.ndarray  # float64 degrees
+
+
+def _to_ms(ts: datetime) -> int:
+    return int((ts - _EPOCH).total_seconds() * 1000)
+
+
+def encode_chunk(fixes: Sequence[Fix]) -> dict:
+    """Encode time-ordered fixes as TripLocationChunk column values (minus trip_id)."""
+    lat_q = np.round(np.array([f[0] for f in fixes], dtype=np.float64) * COORD_SCALE).astype(np.int64)
+    lng_q = np.round(np.array([f[1] for f in fixes], dtype=np.float64) * COORD_SCALE).astype(np.int64)
+    t_ms = np.array([_to_ms(f[2]) for f in fixes], dtype=np.int64)
+    deltas = np.concatenate([
+        np.diff(lat_q, prepend=lat_q[0]),
+        np.diff(lng_q, prepend=lng_q[0]),
+        np.diff(t_ms, prepend=t_ms[0]),
+    ]).astype("<i4")
+    return {
+        "start_time": fixes[0][2],
+        "end_time": fixes[-1][2],
+        "n_points": len(fixes),
+        "base_lat": int(lat_q[0]),
+        "base_lng": int(lng_q[0]),
+        "encoding": ENCODING_VERSION,
+        "data": zlib.compress(deltas.tobytes()),
+    }
+
+
+def decode_chunk(chunk: TripLocationChunk) -> Trace:
+    """Inverse of encode_chunk."""
+    n = chunk.n_points
+    deltas = np.frombuffer(zlib.decompress(chunk.data), dtype="<i4").astype(np.int64)
+    lat_q = chunk.base_lat + np.cumsum(deltas[:n])
+    lng_q = chunk.base_lng + np.cumsum(deltas[n:2 * n])
+    t_ms = _to_ms(chunk.start_time) + np.cumsum(deltas[2 * n:])
+    return Trace(t_ms.astype("datetime64[ms]"), lat_q / COORD_SCALE, lng_q / COORD_SCALE)
+
+
+class HistoryBuffer:
+    """Fixes waiting to be written, per trip, flushed as chunks."""
+
+    def __init__(self, max_points: int = LOCATION_HISTORY_BUFFER_MAX):
+        self.max_points = max_points
+        self._pending: Dict[int, List[Fix]] = {}
+        self._size = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self.counters = {
+            "appended": 0,
+            "dropped": 0,
+            "flushed_points": 0,
+            "flushed_chunks": 0,
+            "flushes": 0,
+            "flush_failures": 0,
+        }
+        self.last_flush_at = None
+
+    def append(self, trip_id: int, fixes: Sequence[Fix]) -> int:
+        """Queue fixes for a trip. Returns how many were accepted (0 when disabled or full)."""
+        if not LOCATION_HISTORY_ENABLED or not fixes:
+            return 0
+        with self._lock:
+            room = max(self.max_points - self._size, 0)
+            accepted = list(fixes[:room])
+            if len(accepted) < len(fixes):
+                self.counters["dropped"] += len(fixes) - len(accepted)
+            if accepted:
+                self._pending.setdefault(trip_id, []).extend(accepted)
+                self._size += len(accepted)
+                self.counters["appended"] += len(accepted)
+        return len(accepted)
+
+    def pending_for(self, trip_id: int) -> List[Fix]:
+        with self._lock:
+            return list(self._pending.get(trip_id, ()))
+
+    def discard(self, trip_id: int) -> None:
+        """Forget a trip's unflushed fixes (e.g. it was deleted)."""
+        with self._lock:
+            self._size -= len(self._pending.pop(trip_id, ()))
+
+    def flush(self, session_factory: Callable[[], Session]) -> int:
+        """Write all pending fixes as chunks in one INSERT. Returns chunks written; re-queues on failure."""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending, self._size = self._pending, {}, 0
+            if not batch:
+                return 0
+            rows = []
+            for trip_id, fixes in batch.items():
+                fixes.sort(key=lambda f: f[2])
+                for start in range(0, len(fixes), LOCATION_HISTORY_CHUNK_POINTS):
+                    rows.append({"trip_id": trip_id, **encode_chunk(fixes[start:start + LOCATION_HISTORY_CHUNK_POINTS])})
+            points = sum(len(f) for f in batch.values())
+            db = session_factory()
+            try:
+                try:
+                    db.execute(insert(TripLocationChunk).values(rows))
+                except IntegrityError:
+                    # A trip was deleted while its fixes were buffered: drop those and retry once
+                    db.rollback()
+                    alive = {tid for (tid,) in db.query(Trip.id).filter(Trip.id.in_(list(batch))).all()}
+                    gone = [tid for tid in batch if tid not in alive]
+                    self.counters["dropped"] += sum(len(batch.pop(tid)) for tid in gone)
+                    rows = [r for r in rows if r["trip_id"] in alive]
+                    points = sum(len(f) for f in batch.values())
+                    if rows:
+                        db.execute(insert(TripLocationChunk).values(rows))
+                db.commit()
+            except Exception as e:
+                db.rollback()
+                self.counters["flush_failures"] += 1
+                with self._lock:
+                    for trip_id, fixes in batch.items():
+                        self._pending[trip_id] = fixes + self._pending.get(trip_id, [])
+                        self._size += len(fixes)
+                logger.warning(f"Location history flush failed ({points} fixes re-queued): {type(e).__name__}: {e}")
+                return 0
+            finally:
+                db.close()
+            self.counters["flushes"] += 1
+            self.counters["flushed_chunks"] += len(rows)
+            self.counters["flushed_points"] += points
+            self.last_flush_at = datetime.utcnow()
+            return len(rows)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": LOCATION_HISTORY_ENABLED,
+            "pending": self._size,
+            **self.counters,
+            "last_flush_at": self.last_flush_at.isoformat() if self.last_flush_at else None,
+        }
+
+
+buffer = HistoryBuffer()
+
+
+def append_trip_fixes(trip_id: int, fixes: Sequence[Fix]) -> int:
+    """Queue (lat, lng, recorded_at) fixes for a trip's history. Returns how many were accepted."""
+    return buffer.append(trip_id, fixes)
+
+
+def read_trip_trace(db: Session, trip_id: int, include_pending: bool = True) -> Trace:
+    """Decode a trip's full trace (stored chunks plus unflushed fixes), sorted by time."""
+    chunks = db.query(TripLocationChunk).filter(
+        TripLocationChunk.trip_id == trip_id
+    ).order_by(TripLocationChunk.start_time, TripLocationChunk.id).all()
+    parts = [decode_chunk(c) for c in chunks]
+    pending = buffer.pending_for(trip_id) if include_pending else []
+    if pending:
+        pending.sort(key=lambda f: f[2])
+        parts.append(Trace(
+            np.array([_to_ms(f[2]) for f in pending], dtype=np.int64).astype("datetime64[ms]"),
+            np.array([f[0] for f in pending], dtype=np.float64),
+            np.array([f[1] for f in pending], dtype=np.float64),
+        ))
+    if not parts:
+        return Trace(np.array([], dtype="datetime64[ms]"), np.array([]), np.array([]))
+    t = np.concatenate([p.t for p in parts])
+    order = np.argsort(t, kind="stable")  # Late batches can overlap earlier chunks
+    return Trace(t[order], np.concatenate([p.lat for p in parts])[order], np.concatenate([p.lng for p in parts])[order])
+
+
+async def run_flusher(session_factory: Callable[[], Session]) -> None:
+    """In-process task: flush buffered history every LOCATION_HISTORY_FLUSH_SECONDS."""
+    logger.info(f"Location history flusher started (every {LOCATION_HISTORY_FLUSH_SECONDS}s)")
+    while True:
+        await asyncio.sleep(LOCATION_HISTORY_FLUSH_SECONDS)
+        try:
+            await asyncio.to_thread(buffer.flush, session_factory)
+        except Exception as e:
+            logger.error(f"Location history flush cycle failed: {e}")
@@ -0,0 +1,112 @@
+"""
+Server-side ingest policy for GPS pings
+
+Apps keep reporting while parked or stopped at a light, and every ping used to
+become a write. Before a fix reaches the buffers/DB it is checked against the last
+accepted one:
+    - Too soon (less than the minimum interval since the last accepted fix): dropped
+    - Moved less than the minimum distance: dropped, unless the last accepted fix is
+      older than the max staleness (then it is accepted as a heartbeat so
+      last_location_update doesn't go stale for a parked driver)
+    - Otherwise accepted
+
+Close to the pickup / meeting point the thresholds tighten (NEAR) so tracking stays
+precise where it matters. Every response suggests when the client should report
+next, based on distance to the target, so apps slow down when far away.
+
+Environment Variables:
+    LOCATION_MIN_DISTANCE_M: Minimum movement to accept a fix (default 15)
+    LOCATION_MIN_INTERVAL_SECONDS: Minimum time between accepted fixes (default 2)
+    LOCATION_MAX_STALENESS_SECONDS: Accept a fix anyway after this long (default 60)
+    LOCATION_NEAR_TARGET_KM: Radius around the target with tighter thresholds (default 1.0)
+    LOCATION_NEAR_MIN_DISTANCE_M / LOCATION_NEAR_MIN_INTERVAL_SECONDS: Thresholds in
+        that radius (default 3 and 1)
+    LOCATION_REPORT_TIERS: "km:seconds,..." suggested report interval by distance to
+        target, ascending (default "1:3,5:10,20:20")
+    LOCATION_REPORT_DEFAULT_SECONDS: Suggested interval beyond the last tier or with
+        no target (default 30)
+"""
+
+import os
+import logging
+from typing import List, Optional, Tuple
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+LOCATION_MIN_DISTANCE_M = float(os.getenv("LOCATION_MIN_DISTANCE_M", "15"))
+LOCATION_MIN_INTERVAL_SECONDS = float(os.getenv("LOCATION_MIN_INTERVAL_SECONDS", "2"))
+LOCATION_MAX_STALENESS_SECONDS = float(os.getenv("LOCATION_MAX_STALENESS_SECONDS", "60"))
+LOCATION_NEAR_TARGET_KM = float(os.getenv("LOCATION_NEAR_TARGET_KM", "1.0"))
+LOCATION_NEAR_MIN_DISTANCE_M = float(os.getenv("LOCATION_NEAR_MIN_DISTANCE_M", "3"))
+LOCATION_NEAR_MIN_INTERVAL_SECONDS = float(os.getenv("LOCATION_NEAR_MIN_INTERVAL_SECONDS", "1"))
+LOCATION_REPORT_DEFAULT_SECONDS = int(os.getenv("LOCATION_REPORT_DEFAULT_SECONDS", "30"))
+
+
+def _parse_tiers(raw: str) -> List[Tuple[float, int]]:
+    tiers = []
+    for part in raw.split(","):
+        if not part.strip():
+            continue
+        km, seconds = part.split(":")
+        tiers.append((float(km), int(seconds)))
+    return sorted(tiers)
+
+
+LOCATION_REPORT_TIERS = _parse_tiers(os.getenv("LOCATION_REPORT_TIERS", "1:3,5:10,20:20"))
+
+ACCEPTED = "accepted"
+HEARTBEAT = "heartbeat"
+DROPPED_INTERVAL = "dropped_interval"
+DROPPED_DISTANCE = "dropped_distance"
+
+counters = {ACCEPTED: 0, HEARTBEAT: 0, DROPPED_INTERVAL: 0, DROPPED_DISTANCE: 0}
+
+
+def thresholds(target_km: Optional[float]) -> Tuple[float, float]:
+    """(min distance m, min interval s) for a fix target_km from the pickup/meeting point."""
+    if target_km is not None and target_km < LOCATION_NEAR_TARGET_KM:
+        return LOCATION_NEAR_MIN_DISTANCE_M, LOCATION_NEAR_MIN_INTERVAL_SECONDS
+    return LOCATION_MIN_DISTANCE_M, LOCATION_MIN_INTERVAL_SECONDS
+
+
+def classify(moved_m: Optional[float], age_s: Optional[float], target_km: Optional[float] = None) -> str:
+    """Decide what to do with a fix, given how far (m) and how long (s) since the last accepted one.
+
+    moved_m / age_s are None when there is no previous fix (always accepted).
+    """
+    if moved_m is None or age_s is None:
+        return ACCEPTED
+    min_distance_m, min_interval_s = thresholds(target_km)
+    if age_s < min_interval_s:
+        return DROPPED_INTERVAL
+    if moved_m < min_distance_m:
+        return HEARTBEAT if age_s >= LOCATION_MAX_STALENESS_SECONDS else DROPPED_DISTANCE
+    return ACCEPTED
+
+
+def evaluate(moved_m: Optional[float], age_s: Optional[float], target_km: Optional[float] = None) -> bool:
+    """classify() plus counting; True if the fix should be written."""
+    outcome = classify(moved_m, age_s, target_km)
+    counters[outcome] += 1
+    return outcome in (ACCEPTED, HEARTBEAT)
+
+
+def next_report_seconds(target_km: Optional[float]) -> int:
+    """Suggested seconds until the client's next report, by distance to the target."""
+    if target_km is None:
+        return LOCATION_REPORT_DEFAULT_SECONDS
+    for max_km, seconds in LOCATION_REPORT_TIERS:
+        if target_km < max_km:
+            return seconds
+    return LOCATION_REPORT_DEFAULT_SECONDS
+
+
+def stats() -> dict:
+    total = sum(counters.values())
+    dropped = counters[DROPPED_INTERVAL] + counters[DROPPED_DISTANCE]
+    return {
+        **counters,
+        "drop_ratio": round(dropped / total, 4) if total else None,
+    }
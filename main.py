@@ -1,19 +1,37 @@
-from fastapi import FastAPI, Query, Depends, HTTPException
+from fastapi import FastAPI, Query, Depends, HTTPException, Response, Header, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy.orm import Session
-from sqlalchemy import text, inspect, func
+from fastapi.responses import StreamingResponse
+from sqlalchemy.orm import Session, joinedload, load_only
+from sqlalchemy import text, inspect, func, select, literal
 from typing import List, Optional, Tuple
 import math
 import time
-from datetime import datetime, date, timedelta
+import hashlib
+import numpy as np
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, date, timedelta, timezone
 from geopy.geocoders import Nominatim
-import httpx
 
 # Database & Models
-from database import engine, get_db, Base, verify_connection
+from database import engine, get_db, Base, verify_connection, SessionLocal, DB_QUERY_COUNT, query_counter
 from models import Trip, RideRequest
 import schemas
+import prematch
+import hubs
+import location_buffer
+import location_history
+import pubsub
+import match_context
+import entity_cache
+import change_feed
+import push
+import outbox
+import receipts
+import location_policy
 import logging
+import asyncio
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -33,6 +51,19 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+if DB_QUERY_COUNT:
+    @app.middleware("http")
+    async def count_db_queries(request: Request, call_next):
+        """Diagnostics: report how many SQL statements served a request (X-DB-Queries)."""
+        counter = [0]
+        token = query_counter.set(counter)
+        try:
+            response = await call_next(request)
+        finally:
+            query_counter.reset(token)
+        response.headers["X-DB-Queries"] = str(counter[0])
+        return response
+
 
 @app.on_event("startup")
 async def startup_event():
@@ -56,6 +87,40 @@ async def startup_event():
         # Don't raise - let the app start but log the error prominently
         # This allows health checks to work even if DB is temporarily down
 
+    if prematch.PREMATCH_IN_PROCESS:
+        asyncio.create_task(prematch.run_refresher(
+            SessionLocal, compute_scheduled_matches, lambda: hubs.get_registry().resort_names()
+        ))
+    if hubs.HUB_REGISTRY_POLL_SECONDS > 0:
+        asyncio.create_task(hubs.watch())
+    if location_buffer.LOCATION_WRITE_BEHIND:
+        asyncio.create_task(location_buffer.run_flusher(SessionLocal))
+    if location_history.LOCATION_HISTORY_ENABLED:
+        asyncio.create_task(location_history.run_flusher(SessionLocal))
+    pubsub.bus.start(engine)
+    await push.client.start()
+    outbox.start(SessionLocal)
+    receipts.start(SessionLocal)
+
+
+@app.on_event("shutdown")
+def shutdown_event():
+    """Flush buffered location updates so no acknowledged ping is lost on instance shutdown."""
+    if location_buffer.LOCATION_WRITE_BEHIND:
+        location_buffer.trip_locations.flush_on_shutdown(SessionLocal)
+        location_buffer.request_locations.flush_on_shutdown(SessionLocal)
+    if location_history.LOCATION_HISTORY_ENABLED:
+        location_history.buffer.flush(SessionLocal)
+    pubsub.bus.stop()
+
+
+@app.on_event("shutdown")
+async def close_push_client():
+    """Finish the outbox cycle, then close pooled push connections (the handler above is sync, this one needs the loop)."""
+    await outbox.stop()
+    await receipts.stop()
+    await push.client.close()
+
 
 def _is_departure_now(val) -> bool:
     """True if departure_time means 'Ride Now' (case-insensitive, null-safe)."""
@@ -64,6 +129,228 @@ def _is_departure_now(val) -> bool:
     return (str(val).strip().lower() == "now")
 
 
+def _live_trip(trip: Optional[Trip]) -> Optional[Trip]:
+    """Overlay the newest buffered (not yet flushed) driver location onto a loaded trip."""
+    location_buffer.trip_locations.overlay(trip)
+    return trip
+
+
+def _live_request(request: Optional[RideRequest]) -> Optional[RideRequest]:
+    """Overlay the newest buffered (not yet flushed) passenger location onto a loaded request."""
+    location_buffer.request_locations.overlay(request)
+    return request
+
+
+# Pair loaders: endpoints that need both sides of a match load them in one statement.
+def _request_with_trip(db: Session, request_id: int) -> Optional[RideRequest]:
+    """A request with its matched trip (request.matched_trip) joined in."""
+    return db.query(RideRequest).options(
+        joinedload(RideRequest.matched_trip)
+    ).filter(RideRequest.id == request_id).first()
+
+def _trip_with_request(db: Session, trip_id: int, statuses: Tuple[str, ...] = ("matched",)) -> Tuple[Optional[Trip], Optional[RideRequest]]:
+    """A trip and its linked request in one of statuses (first one, if several)."""
+    row = db.query(Trip, RideRequest).outerjoin(
+        Trip.ride_requests.and_(RideRequest.status.in_(statuses))
+    ).filter(Trip.id == trip_id).first()
+    return (row[0], row[1]) if row else (None, None)
+
+def _trip_and_request(db: Session, trip_id: int, request_id: int) -> Tuple[Optional[Trip], Optional[RideRequest]]:
+    """A trip and a request by id (not necessarily linked yet, e.g. before accepting a match)."""
+    anchor = select(literal(1).label("one")).subquery()
+    row = db.query(Trip, RideRequest).select_from(anchor).outerjoin(
+        Trip, Trip.id == trip_id
+    ).outerjoin(RideRequest, RideRequest.id == request_id).first()
+    return row[0], row[1]
+
+
+# Cached reads for the polling GETs (entity_cache.py). Snapshots are stored before the
+# location overlay; every hit is a fresh transient row. Committed ORM writes invalidate.
+entity_cache.track(SessionLocal)
+location_buffer.trip_locations.on_flushed = lambda batch: _location_flushed(entity_cache.TRIP, batch)
+location_buffer.request_locations.on_flushed = lambda batch: _location_flushed(entity_cache.REQUEST, batch)
+# Expo ticket errors count against their push tokens (receipts.py)
+outbox.on_ticket_errors = receipts.record_failures
+# Lifecycle writes on other instances reach these process-local caches through the bus
+pubsub.bus.on_remote_message = lambda topics, message: _remote_change(message)
+pubsub.bus.on_remote_gap = lambda: (entity_cache.cache.clear(), match_context.cache.clear())
+
+_TOPIC_KINDS = {"trip": entity_cache.TRIP, "request": entity_cache.REQUEST}
+
+def _remote_change(message: dict) -> None:
+    """Another instance took a position or committed a status change: bring the caches here up
+    to date before local long-polls wake and reload."""
+    if message.get("type") == "location":
+        prefix, _, row_id = message.get("topic", "").partition(":")
+        kind = _TOPIC_KINDS.get(prefix)
+        if kind is None or not row_id.isdigit():
+            return
+        ts = datetime.fromisoformat(message["last_location_update"])
+        # Same columns the sender's location_buffer flush writes
+        entity_cache.cache.apply(kind, {int(row_id): {
+            "current_lat": message["lat"], "current_lng": message["lng"],
+            "last_location_update": ts, "updated_at": ts,
+        }})
+        if kind == entity_cache.REQUEST:
+            match_context.cache.note_passenger_position(int(row_id), message["lat"], message["lng"])
+        return
+    if message.get("type") != "status":
+        return
+    trip_id, request_id = message.get("trip_id"), message.get("request_id")
+    if trip_id is not None:
+        entity_cache.cache.invalidate(entity_cache.TRIP, [trip_id])
+    if request_id is not None:
+        entity_cache.cache.invalidate(entity_cache.REQUEST, [request_id])
+    match_context.cache.invalidate(trip_id=trip_id, request_id=request_id)
+
+def _location_flushed(kind: str, batch: dict) -> None:
+    """Write-behind positions reached the DB: patch cached rows so they don't go stale."""
+    entity_cache.cache.apply(kind, {
+        row_id: {"current_lat": lat, "current_lng": lng, "last_location_update": ts, "updated_at": ts}
+        for row_id, (lat, lng, ts) in batch.items()
+    })
+
+def _cached_trip(db: Session, trip_id: int) -> Optional[Trip]:
+    entry = entity_cache.cache.lookup(entity_cache.TRIP, trip_id)
+    if entry is not None:
+        return _live_trip(entity_cache.materialize(entity_cache.TRIP, entry.snapshot))
+    stamp = entity_cache.cache.stamp()
+    trip = db.query(Trip).filter(Trip.id == trip_id).first()
+    entity_cache.cache.store(entity_cache.TRIP, trip, stamp)
+    return _live_trip(trip)
+
+def _cached_request(db: Session, request_id: int) -> Optional[RideRequest]:
+    entry = entity_cache.cache.lookup(entity_cache.REQUEST, request_id)
+    if entry is not None:
+        return _live_request(entity_cache.materialize(entity_cache.REQUEST, entry.snapshot))
+    stamp = entity_cache.cache.stamp()
+    request = db.query(RideRequest).filter(RideRequest.id == request_id).first()
+    entity_cache.cache.store(entity_cache.REQUEST, request, stamp)
+    return _live_request(request)
+
+def _cached_request_with_trip(db: Session, request_id: int) -> Tuple[Optional[RideRequest], Optional[Trip]]:
+    """A request and its matched trip: from the cache, else one joined query that fills it."""
+    entry = entity_cache.cache.lookup(entity_cache.REQUEST, request_id)
+    if entry is not None:
+        request = _live_request(entity_cache.materialize(entity_cache.REQUEST, entry.snapshot))
+        if request.matched_trip_id is None:
+            return request, None
+        trip_entry = entity_cache.cache.lookup(entity_cache.TRIP, request.matched_trip_id)
+        if trip_entry is not None:
+            return request, _live_trip(entity_cache.materialize(entity_cache.TRIP, trip_entry.snapshot))
+    stamp = entity_cache.cache.stamp()
+    request = _request_with_trip(db, request_id)
+    if not request:
+        return None, None
+    trip = request.matched_trip
+    entity_cache.cache.store(entity_cache.REQUEST, request, stamp)
+    entity_cache.cache.store(entity_cache.TRIP, trip, stamp)
+    return _live_request(request), _live_trip(trip)
+
+def _cached_trip_with_request(db: Session, trip_id: int) -> Tuple[Optional[Trip], Optional[RideRequest]]:
+    """A trip and its matched request (via the match context cache), else one joined query."""
+    entry = entity_cache.cache.lookup(entity_cache.TRIP, trip_id)
+    if entry is not None:
+        known, ctx = match_context.cache.peek(trip_id)
+        if known:
+            trip = _live_trip(entity_cache.materialize(entity_cache.TRIP, entry.snapshot))
+            if ctx is None:
+                return trip, None
+            request_entry = entity_cache.cache.lookup(entity_cache.REQUEST, ctx.request_id)
+            if request_entry is not None and request_entry.snapshot["status"] == "matched" \
+                    and request_entry.snapshot["matched_trip_id"] == trip_id:
+                return trip, _live_request(entity_cache.materialize(entity_cache.REQUEST, request_entry.snapshot))
+    stamp = entity_cache.cache.stamp()
+    trip, request = _trip_with_request(db, trip_id)
+    if not trip:
+        return None, None
+    entity_cache.cache.store(entity_cache.TRIP, trip, stamp)
+    entity_cache.cache.store(entity_cache.REQUEST, request, stamp)
+    trip, request = _live_trip(trip), _live_request(request)
+    match_context.cache.get(trip_id, lambda _: _match_context_for(request))
+    return trip, request
+
+
+# Conditional GETs: ETags are built from row versions, so If-None-Match is checked against the
+# cached rows before any response body is built and an unchanged poll gets an empty 304.
+def _row_version(obj) -> str:
+    """Version of a Trip / RideRequest as served: updated_at (created_at before the first
+    update) plus the buffered fix, which changes the served position without touching the row."""
+    if obj is None:
+        return "-"
+    buffer = location_buffer.trip_locations if isinstance(obj, Trip) else location_buffer.request_locations
+    stamp = obj.updated_at or obj.created_at
+    fix = buffer.get(obj.id)
+    return f"{obj.id}@{stamp.isoformat() if stamp else ''}~{fix[2].isoformat() if fix else ''}"
+
+def _etag(*parts) -> str:
+    """Strong ETag over a view name, row versions and anything else the body depends on."""
+    digest = hashlib.sha1("|".join(str(p) for p in parts).encode()).hexdigest()
+    return f'"{digest[:20]}"'
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+
+def _not_modified(etag: str, headers: Optional[dict] = None) -> Response:
+    return Response(status_code=304, headers={"ETag": etag, **(headers or {})})
+
+
+def _publish_location(topic: str, lat: float, lng: float, fix_time: datetime = None, resort: Optional[str] = None) -> None:
+    """Tell live subscribers about a new position (coalesced: only the newest undelivered one is kept).
+
+    Driver positions also go to the resort topic, for resort-wide views.
+    """
+    topics = [topic, pubsub.resort_topic(resort)] if resort else [topic]
+    pubsub.bus.publish(topics, {
+        "type": "location",
+        "topic": topic,
+        "lat": lat,
+        "lng": lng,
+        "last_location_update": (fix_time or datetime.utcnow()).isoformat(),
+    }, coalesce_key=f"location:{topic}")
+
+
+def _publish_status(trip_id: Optional[int], request_id: Optional[int], status: str) -> None:
+    """Tell live subscribers of both sides of a pair about a lifecycle transition. Call after commit."""
+    topics = []
+    if trip_id is not None:
+        topics.append(pubsub.trip_topic(trip_id))
+    if request_id is not None:
+        topics.append(pubsub.request_topic(request_id))
+    pubsub.bus.publish(topics, {"type": "status", "status": status, "trip_id": trip_id, "request_id": request_id})
+
+
+def _pair_event_key(event: str, trip: Trip, request: RideRequest) -> str:
+    """Outbox idempotency key for an event on a matched pair. It carries the request's row version
+    as loaded (change_seq, see change_feed.py: its last write before this one), so the same pair
+    matched again after a cancel gets a new notification. Already loaded, so no extra query."""
+    return f"{event}:{trip.id}:{request.id}@{request.change_seq or 0}"
+
+
+def _outbox_match(db: Session, trip: Trip, request: RideRequest, notify_driver: bool, notify_passenger: bool) -> None:
+    """Write 'matched' pushes to the outbox in the match's transaction. Call before commit."""
+    data = {"trip_id": trip.id, "request_id": request.id, "action": "view_match"}
+    key = _pair_event_key("matched", trip, request)
+    if notify_driver:
+        outbox.add(
+            db, f"{key}:driver", trip.push_token,
+            title="New passenger!",
+            body=f"{request.passenger_name} is riding with you to {trip.resort}.",
+            data=data,
+        )
+    if notify_passenger:
+        outbox.add(
+            db, f"{key}:passenger", request.push_token,
+            title="You've got a ride!",
+            body=f"{trip.driver_name} is driving you to {trip.resort}.",
+            data=data,
+        )
+
+
 def _geocode_address(raw: str) -> Tuple[Optional[float], Optional[float]]:
     """Try to geocode an address. Tries several query formats. Returns (lat, lng) or (None, None)."""
     s = (raw or "").strip()
@@ -92,124 +379,53 @@ def _geocode_address(raw: str) -> Tuple[Optional[float], Optional[float]]:
 
 
 # --- DATA CONFIGURATION ---
-RESORTS_DATA = [
-    {"name": "Alta", "lat": 40.5883, "lng": -111.6358},
-    {"name": "Snowbird", "lat": 40.5830, "lng": -111.6563},
-    {"name": "Brighton", "lat": 40.5981, "lng": -111.5831},
-    {"name": "Solitude", "lat": 40.6199, "lng": -111.5919},
-    {"name": "Park City Mountain", "lat": 40.6514, "lng": -111.5080},
-    {"name": "Canyons Village", "lat": 40.6853, "lng": -111.5562},
-    {"name": "Deer Valley", "lat": 40.6367, "lng": -111.4792},
-    {"name": "Woodward Park City", "lat": 40.7589, "lng": -111.5761}
-]
-
-HUBS = {
-    "h1": {
-        "name": "Historic Sandy Station",
-        "lat": 40.5897,
-        "lng": -111.8856,
-        "address": "8662 S. 255 E., Sandy, UT 84070",
-        "transit": True,
-        "bus_routes": ["UTA TRAX Red Line", "UTA 953 (Ski Bus)"],
-        "description": "UTA TRAX station with ski bus connections"
-    },
-    "h2": {
-        "name": "9400 S. Highland Dr.",
-        "lat": 40.5815,
-        "lng": -111.8085,
-        "address": "9400 S. Highland Dr., Sandy, UT 84092",
-        "transit": True,
-        "bus_routes": ["UTA 953 (Ski Bus)"],
-        "description": "UTA Park & Ride with ski bus service"
-    },
-    "h3": {
-        "name": "Midvale Fort Union Station",
-        "lat": 40.6192,
-        "lng": -111.8983,
-        "address": "7200 S. 1300 E., Midvale, UT 84047",
-        "transit": True,
-        "bus_routes": ["UTA TRAX Red Line", "UTA 953 (Ski Bus)"],
-        "description": "UTA TRAX station with ski bus connections"
-    },
-    "h4": {
-        "name": "6200 S. Wasatch Blvd. (Swamp Lot)",
-        "lat": 40.6375,
-        "lng": -111.7997,
-        "address": "6200 S. Wasatch Blvd., Salt Lake City, UT 84121",
-        "transit": True,
-        "bus_routes": ["UTA 953 (Ski Bus)", "UTA 994 (Ski Bus)"],
-        "description": "Popular ski bus pickup location"
-    },
-    "h5": {
-        "name": "Big Cottonwood Canyon P&R",
-        "lat": 40.6194,
-        "lng": -111.7870,
-        "address": "6450 S. Wasatch Blvd., Salt Lake City, UT 84121",
-        "transit": True,
-        "bus_routes": ["UTA 953 (Ski Bus)", "UTA 994 (Ski Bus)"],
-        "description": "UTA Park & Ride at canyon entrance"
-    },
-    "h6": {
-        "name": "Richardson Flat",
-        "lat": 40.6711,
-        "lng": -111.4496,
-        "address": "Richardson Flat Rd., Park City, UT 84098",
-        "transit": True,
-        "bus_routes": ["Park City Transit"],
-        "description": "Park & Ride with free Park City Transit"
-    },
-    "h7": {
-        "name": "Ecker Hill P&R",
-        "lat": 40.7461,
-        "lng": -111.5734,
-        "address": "I-80 Exit 146, Park City, UT 84098",
-        "transit": True,
-        "bus_routes": ["Park City Transit"],
-        "description": "Park & Ride with free Park City Transit"
-    },
-    "h8": {
-        "name": "Kimball Junction Transit Center",
-        "lat": 40.7241,
-        "lng": -111.5467,
-        "address": "1751 Sidewinder Dr., Park City, UT 84060",
-        "transit": True,
-        "bus_routes": ["Park City Transit", "UTA 902"],
-        "description": "Major transit hub with multiple bus routes"
-    },
-    "h9": {
-        "name": "Park City High School",
-        "lat": 40.6587,
-        "lng": -111.5034,
-        "address": "1752 Kearns Blvd., Park City, UT 84060",
-        "transit": True,
-        "bus_routes": ["Park City Transit"],
-        "description": "Park & Ride with free Park City Transit"
-    },
-    "h10": {
-        "name": "Jeremy Ranch P&R",
-        "lat": 40.7589,
-        "lng": -111.5761,
-        "address": "I-80 Exit 141, Park City, UT 84098",
-        "transit": True,
-        "bus_routes": ["Park City Transit"],
-        "description": "Park & Ride with free Park City Transit"
-    }
-}
-
-RESORT_HUB_MAP = {
-    "Alta": ["h1", "h2", "h3", "h4"],
-    "Snowbird": ["h1", "h2", "h3", "h4"],
-    "Brighton": ["h3", "h4", "h5"],
-    "Solitude": ["h3", "h4", "h5"],
-    "Park City Mountain": ["h6", "h7", "h8", "h9"],
-    "Canyons Village": ["h7", "h10", "h8"],
-    "Deer Valley": ["h6", "h9"],
-    "Woodward Park City": ["h7"]
-}
+# Resorts, hubs and the resort -> hub mapping live in hubs.json, served by the hub registry (hubs.py).
+# Grab hubs.get_registry() once per request so a hot reload never mixes versions mid-request.
 
 # Ride Now: max cross-track distance (km) for "on route" — canyon roads curve so 2km was too strict
 RIDE_NOW_ROUTE_KM = 8.0
 
+# Hub scoring: max cross-track distance (km) of a meeting hub from the driver's start -> resort route
+HUB_ROUTE_KM = 5.0
+# /get-optimal-hub/: stricter route threshold (km)
+OPTIMAL_HUB_ROUTE_KM = 1.5
+
+# /match-scheduled/batch: worker threads for per-partition matching, and max days per call
+MATCH_BATCH_WORKERS = int(os.getenv("MATCH_BATCH_WORKERS", "4"))
+MATCH_BATCH_MAX_DAYS = 14
+
+# Streaming (Accept: application/x-ndjson): rows fetched per server-side cursor batch
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+STREAM_YIELD_PER = 500
+
+# Map endpoints (/trips/active, /ride-requests/active) with a viewport: below this zoom rows are
+# grid-clustered (cells per 256px map tile), otherwise returned in id-ordered pages
+MAP_CLUSTER_BELOW_ZOOM = int(os.getenv("MAP_CLUSTER_BELOW_ZOOM", "12"))
+MAP_CLUSTER_CELLS_PER_TILE = 4
+MAP_PAGE_DEFAULT = 200
+MAP_PAGE_MAX = 1000
+# Row fields of the map endpoints (also the ?fields= projection choices)
+ACTIVE_TRIP_FIELDS = (
+    "id", "driver_name", "resort", "start_lat", "start_lng", "current_lat", "current_lng",
+    "available_seats", "is_realtime", "departure_time",
+)
+ACTIVE_REQUEST_FIELDS = (
+    "id", "passenger_name", "resort", "pickup_lat", "pickup_lng", "current_lat", "current_lng",
+    "departure_time", "status",
+)
+
+# POST /trips/{id}/locations: max fixes per batch, and how far device timestamps may lag
+# (queued offline) or lead (clock skew) server time. Dead-banding follows location_policy.py.
+LOCATION_BATCH_MAX = 500
+LOCATION_BATCH_MAX_AGE_SECONDS = 6 * 3600
+LOCATION_BATCH_MAX_SKEW_SECONDS = 120
+
+# Driver within this distance (km) of the passenger's nav target is "near pickup" (confirmation prompt)
+NEAR_PICKUP_KM = 0.5
+
+# Long-poll (?since=<version>&wait=<s>) on the matched-state endpoints: max seconds a request is held
+LONG_POLL_MAX_WAIT_SECONDS = float(os.getenv("LONG_POLL_MAX_WAIT_SECONDS", "30"))
+
 # --- MATH UTILITIES ---
 def haversine(lat1, lon1, lat2, lon2):
     R = 6371 # km
@@ -277,60 +493,94 @@ def health():
 # --- UTILITY ENDPOINTS ---
 @app.get("/resorts/")
 def get_resorts():
-    return [r["name"] for r in RESORTS_DATA]
+    return hubs.get_registry().resort_names()
 
 @app.get("/hubs-for-resort/")
 def get_hubs_for_resort(resort: str):
-    allowed_ids = RESORT_HUB_MAP.get(resort, [])
-    return {hid: HUBS[hid] for hid in allowed_ids if hid in HUBS}
+    return {hid: hub for hid, hub in hubs.get_registry().hubs_for_resort(resort)}
+
+@app.get("/hubs/nearest/")
+def get_nearest_hubs(
+    lat: float,
+    lng: float,
+    k: int = Query(3, ge=1, le=50),
+    radius_km: Optional[float] = None,
+    resort: Optional[str] = None,
+):
+    """Nearest hubs to a point via the registry's KD-tree.
+    radius_km: return every hub within that distance instead of the k nearest.
+    resort: limit k-nearest results to that resort's hubs."""
+    registry = hubs.get_registry()
+    if radius_km is not None:
+        found = registry.within_radius(lat, lng, radius_km)
+        if resort:
+            allowed = {hid for hid, _ in registry.hubs_for_resort(resort)}
+            found = [(hid, d) for hid, d in found if hid in allowed]
+    else:
+        found = registry.nearest(lat, lng, k=k, resort=resort)
+    return {
+        "registry_version": registry.version,
+        "hubs": [
+            {"id": hid, **registry.hubs[hid], "distance_km": round(dist, 2)}
+            for hid, dist in found
+        ],
+    }
+
+@app.post("/admin/hubs/reload")
+def reload_hub_registry():
+    """Reload hubs.json (or HUB_REGISTRY_PATH) and atomically swap it in. Keeps the old registry on error."""
+    try:
+        registry = hubs.reload()
+    except Exception as e:
+        logger.error(f"Hub registry reload failed: {e}")
+        raise HTTPException(status_code=400, detail=f"Hub registry reload failed: {e}")
+    return {
+        "registry_version": registry.version,
+        "hubs": len(registry.hubs),
+        "resorts": len(registry.resorts),
+    }
 
 @app.get("/hubs-for-match/")
 def get_hubs_for_match(trip_id: int, request_id: int, db: Session = Depends(get_db)):
     """Get all valid hubs for a specific trip-request match pair, scored by distance.
     Allows passenger to see all options and choose if auto-selected hub doesn't work."""
-    trip = db.query(Trip).filter(Trip.id == trip_id).first()
+    trip, request = _trip_and_request(db, trip_id, request_id)
     if not trip:
         raise HTTPException(status_code=404, detail="Trip not found")
     
-    request = db.query(RideRequest).filter(RideRequest.id == request_id).first()
     if not request:
         raise HTTPException(status_code=404, detail="Ride request not found")
     
     if not trip.start_lat or not trip.start_lng or not request.pickup_lat or not request.pickup_lng:
         raise HTTPException(status_code=400, detail="Missing location data for trip or request")
     
-    resort_coords = next((r for r in RESORTS_DATA if r["name"] == trip.resort), None)
+    registry = hubs.get_registry()
+    resort_coords = registry.resort(trip.resort)
     if not resort_coords:
         raise HTTPException(status_code=404, detail="Resort not found")
     
-    valid_hub_ids = RESORT_HUB_MAP.get(trip.resort, [])
-    HUB_ROUTE_KM = 5.0
     scored_hubs = []
     
+    # Cross-track and distances for all of the resort's hubs at once (arrays aligned with hubs_for_resort)
+    matrix = registry.matrix
+    idx = matrix.indices_for_resort(trip.resort)
+    driver_xtds = matrix.route_xtd_km(trip.resort, trip.start_lat, trip.start_lng, idx)
+    driver_dists = matrix.point_to_hubs_km(trip.start_lat, trip.start_lng, idx)
+    passenger_dists = matrix.point_to_hubs_km(request.pickup_lat, request.pickup_lng, idx)
+    
+    # Parse departure times for time difference
+    time_diff = time_difference_minutes(trip.departure_time or "", request.departure_time or "")
+    if time_diff is None:
+        time_diff = 0
+    
     # Score all valid hubs for this resort
-    for hub_id in valid_hub_ids:
-        if hub_id not in HUBS:
-            continue
-        hub = HUBS[hub_id]
-        
+    for k, (hub_id, hub) in enumerate(registry.hubs_for_resort(trip.resort)):
         # Check if hub is within 5km cross-track of driver's route
-        driver_xtd = get_cross_track_distance(
-            trip.start_lat, trip.start_lng,
-            resort_coords["lat"], resort_coords["lng"],
-            hub["lat"], hub["lng"]
-        )
-        
-        if driver_xtd > HUB_ROUTE_KM:
+        if driver_xtds[k] > HUB_ROUTE_KM:
             continue
         
-        # Calculate distances
-        dist_driver = haversine(trip.start_lat, trip.start_lng, hub["lat"], hub["lng"])
-        dist_passenger = haversine(request.pickup_lat, request.pickup_lng, hub["lat"], hub["lng"])
-        
-        # Parse departure times for time difference
-        time_diff = time_difference_minutes(trip.departure_time or "", request.departure_time or "")
-        if time_diff is None:
-            time_diff = 0
+        dist_driver = float(driver_dists[k])
+        dist_passenger = float(passenger_dists[k])
         
         # Score: lower is better (distance + small time factor)
         score = dist_driver + dist_passenger + (time_diff * 0.1)
@@ -405,6 +655,41 @@ def check_database_schema(db: Session = Depends(get_db)):
         }
 
 
+@app.get("/health/location-buffer")
+def check_location_buffer():
+    """Write-behind location buffer stats (pending rows, coalesced/overflow/failed counts, last flush) and location history buffer stats."""
+    return {
+        "enabled": location_buffer.LOCATION_WRITE_BEHIND,
+        "flush_seconds": location_buffer.LOCATION_FLUSH_SECONDS,
+        "trips": location_buffer.trip_locations.stats(),
+        "ride_requests": location_buffer.request_locations.stats(),
+        "history": location_history.buffer.stats(),
+        "match_context": match_context.cache.stats(),
+        "ingest_policy": location_policy.stats(),
+    }
+
+
+@app.get("/health/entity-cache")
+def check_entity_cache():
+    """Trip / RideRequest read cache stats: entries, hits/misses, invalidations, hit_ratio."""
+    return entity_cache.cache.stats()
+
+@app.get("/health/pubsub")
+def check_pubsub():
+    """Live-update bus stats: topics, subscribers, published/delivered/coalesced/dropped counts."""
+    return pubsub.bus.stats()
+
+@app.get("/health/push")
+def check_push():
+    """Expo push client stats (sent / ok / failed / errors, HTTP/2) and the dispatcher's batches in flight."""
+    return {**push.client.stats(), "dispatcher": push.dispatcher.stats()}
+
+@app.get("/health/outbox")
+def check_outbox(db: Session = Depends(get_db)):
+    """Notification outbox: rows by status, oldest undelivered, worker counters, receipt checks."""
+    return {**outbox.stats(db), "receipts": receipts.stats()}
+
+
 @app.get("/health/db")
 def check_database_health(db: Session = Depends(get_db)):
     """Test database connection and return status"""
@@ -443,43 +728,6 @@ def check_database_health(db: Session = Depends(get_db)):
             "timestamp": datetime.utcnow().isoformat()
         }
 
-# --- PUSH NOTIFICATION HELPERS ---
-async def send_expo_push_notification(push_token: str, title: str, body: str, data: dict = None):
-    """Send a push notification via Expo's push service"""
-    if not push_token or not push_token.startswith('ExponentPushToken'):
-        logger.warning(f"Invalid push token format: {push_token}")
-        return False
-    
-    try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                'https://exp.host/--/api/v2/push/send',
-                json={
-                    'to': push_token,
-                    'sound': 'default',
-                    'title': title,
-                    'body': body,
-                    'data': data or {},
-                },
-                headers={'Content-Type': 'application/json'},
-                timeout=10.0
-            )
-            
-            if response.status_code == 200:
-                result = response.json()
-                if result.get('data', {}).get('status') == 'ok':
-                    logger.info(f"Push notification sent successfully to {push_token[:20]}...")
-                    return True
-                else:
-                    logger.warning(f"Push notification failed: {result}")
-                    return False
-            else:
-                logger.error(f"Expo push API error: {response.status_code} - {response.text}")
-                return False
-    except Exception as e:
-        logger.error(f"Error sending push notification: {e}")
-        return False
-
 # --- PUSH NOTIFICATION ENDPOINTS ---
 @app.post("/register-push-token")
 def register_push_token(
@@ -510,6 +758,8 @@ def register_push_token(
             request.push_token = token
             logger.info(f"Registered push token for request {request_id}")
         
+        # A (re-)registered token is live again: forget earlier delivery failures
+        receipts.forget(db, token)
         db.commit()
         return {"success": True, "message": "Push token registered"}
     except HTTPException:
@@ -560,18 +810,53 @@ def create_trip(trip: schemas.TripCreate, db: Session = Depends(get_db)):
         last_location_update=datetime.utcnow() if trip.is_realtime and current_lat else None
     )
     db.add(new_trip)
+    _invalidate_trip_snapshot(db, new_trip)
     db.commit()
     db.refresh(new_trip)
     elapsed = time.perf_counter() - t0
     logger.info(f"✅ POST /trips/ completed in {elapsed:.2f}s (trip_id={new_trip.id})")
     return new_trip
 
+# Declared before /trips/{trip_id} so "active" is not parsed as a trip id
+@app.get("/trips/active")
+def get_active_trips(
+    is_realtime: Optional[bool] = None,
+    bbox: Optional[str] = Query(None, description="Viewport: min_lng,min_lat,max_lng,max_lat"),
+    zoom: Optional[int] = Query(None, ge=0, le=22, description=f"Map zoom; below {MAP_CLUSTER_BELOW_ZOOM} trips are grid-clustered"),
+    fields: Optional[str] = Query(None, description="Comma-separated subset of: " + ", ".join(ACTIVE_TRIP_FIELDS)),
+    cursor: Optional[str] = Query(None, description="next_cursor from the previous page"),
+    limit: Optional[int] = Query(None, ge=1, le=MAP_PAGE_MAX, description=f"Page size (default {MAP_PAGE_DEFAULT})"),
+    accept: Optional[str] = Header(None),
+    db: Session = Depends(get_db),
+):
+    """Get active trips for map display.
+
+    Without viewport parameters: every active trip (Accept: application/x-ndjson streams one per line).
+    With any of bbox / zoom / fields / cursor / limit: only trips positioned in bbox, as grid clusters
+    (count per cell) below the cluster zoom, else as a page of trips with the requested fields.
+    """
+    if any(p is not None for p in (bbox, zoom, fields, cursor, limit)):
+        return _map_response(
+            db, lambda s: _active_trips_query(s, is_realtime), Trip, _trip_map_position(),
+            _active_trip_row, ACTIVE_TRIP_FIELDS, bbox, zoom, fields, cursor, limit, accept,
+        )
+    if _wants_ndjson(accept):
+        return StreamingResponse(
+            _ndjson_stream(lambda s: _active_trips_query(s, is_realtime), _active_trip_row),
+            media_type=NDJSON_MEDIA_TYPE,
+        )
+    return [_active_trip_row(trip) for trip in _active_trips_query(db, is_realtime).all()]
+
 @app.get("/trips/{trip_id}", response_model=schemas.Trip)
-def get_trip(trip_id: int, db: Session = Depends(get_db)):
-    """Get a trip by ID"""
-    trip = db.query(Trip).filter(Trip.id == trip_id).first()
+def get_trip(trip_id: int, response: Response, if_none_match: Optional[str] = Header(None), db: Session = Depends(get_db)):
+    """Get a trip by ID (send the ETag back in If-None-Match to get a 304 while unchanged)"""
+    trip = _cached_trip(db, trip_id)
     if not trip:
         raise HTTPException(status_code=404, detail="Trip not found")
+    etag = _etag("trip", _row_version(trip))
+    if _etag_matches(if_none_match, etag):
+        return _not_modified(etag)
+    response.headers["ETag"] = etag
     return trip
 
 @app.patch("/trips/{trip_id}")
@@ -583,9 +868,11 @@ def update_trip(trip_id: int, updates: dict, db: Session = Depends(get_db)):
     
     # Only allow safe fields to be updated
     allowed_fields = {'is_realtime', 'status', 'available_seats'}
+    _invalidate_trip_snapshot(db, db_trip)
     for key, value in updates.items():
         if key in allowed_fields and hasattr(db_trip, key):
             setattr(db_trip, key, value)
+    _invalidate_trip_snapshot(db, db_trip)
     
     db.commit()
     db.refresh(db_trip)
@@ -603,8 +890,13 @@ def delete_trip(trip_id: int, db: Session = Depends(get_db)):
         synchronize_session=False
     )
     
+    _invalidate_trip_snapshot(db, db_trip)
     db.delete(db_trip)
     db.commit()
+    entity_cache.cache.invalidate_where(entity_cache.REQUEST, lambda snap: snap["matched_trip_id"] == trip_id)
+    location_buffer.trip_locations.discard(trip_id)
+    location_history.buffer.discard(trip_id)
+    _match_changed(trip_id)
     return {"message": "Trip deleted successfully"}
 
 @app.delete("/ride-requests/{request_id}")
@@ -613,8 +905,12 @@ def delete_ride_request(request_id: int, db: Session = Depends(get_db)):
     if not db_request:
         raise HTTPException(status_code=404, detail="Ride request not found")
     
+    matched_trip_id = db_request.matched_trip_id
+    _invalidate_request_snapshot(db, db_request)
     db.delete(db_request)
     db.commit()
+    location_buffer.request_locations.discard(request_id)
+    _match_changed(matched_trip_id, request_id)
     return {"message": "Ride request deleted successfully"}
 
 @app.post("/trips/{trip_id}/book")
@@ -624,6 +920,7 @@ def book_trip(trip_id: int, db: Session = Depends(get_db)):
         raise HTTPException(status_code=404, detail="Trip not found")
     if db_trip.available_seats > 0:
         db_trip.available_seats -= 1
+        _invalidate_trip_snapshot(db, db_trip)
         db.commit()
         return {"remaining": db_trip.available_seats}
     raise HTTPException(status_code=400, detail="Unable to book - no available seats")
@@ -631,13 +928,12 @@ def book_trip(trip_id: int, db: Session = Depends(get_db)):
 @app.post("/ride-requests/{request_id}/accept-driver")
 def accept_driver_match(request_id: int, trip_id: int = Query(...), db: Session = Depends(get_db)):
     """Accept a driver match for Ride Now - links passenger to driver"""
-    request = db.query(RideRequest).filter(RideRequest.id == request_id).first()
+    trip, request = _trip_and_request(db, trip_id, request_id)
     if not request:
         raise HTTPException(status_code=404, detail="Ride request not found")
     if not _is_departure_now(request.departure_time):
         raise HTTPException(status_code=400, detail="This endpoint is only for real-time ride requests")
     
-    trip = db.query(Trip).filter(Trip.id == trip_id).first()
     if not trip:
         raise HTTPException(status_code=404, detail="Trip not found")
     if not trip.is_realtime:
@@ -649,21 +945,28 @@ def accept_driver_match(request_id: int, trip_id: int = Query(...), db: Session
     request.status = "matched"
     trip.status = "matched"
     trip.available_seats -= 1
+    _outbox_match(db, trip, request, notify_driver=True, notify_passenger=False)
     db.commit()
     db.refresh(request)
     db.refresh(trip)
+    outbox.wake()
+    _match_changed(trip_id, request_id)
+    _publish_status(trip_id, request_id, "matched")
     return {"message": "Match accepted", "matched_trip_id": trip_id, "remaining_seats": trip.available_seats}
 
 @app.get("/ride-requests/{request_id}/matched-driver")
-def get_matched_driver_location(request_id: int, db: Session = Depends(get_db)):
-    """Get the matched driver's current location for a passenger"""
-    request = db.query(RideRequest).filter(RideRequest.id == request_id).first()
+def get_matched_driver_location(request_id: int, response: Response, if_none_match: Optional[str] = Header(None), db: Session = Depends(get_db)):
+    """Get the matched driver's current location for a passenger (conditional: ETag / If-None-Match)"""
+    request, trip = _cached_request_with_trip(db, request_id)
     if not request:
         raise HTTPException(status_code=404, detail="Ride request not found")
+    etag = _etag("matched-driver", _row_version(request), _row_version(trip))
+    if _etag_matches(if_none_match, etag):
+        return _not_modified(etag)
+    response.headers["ETag"] = etag
     if not request.matched_trip_id:
         return {"matched": False}
     
-    trip = db.query(Trip).filter(Trip.id == request.matched_trip_id).first()
     if not trip:
         return {"matched": False}
     
@@ -680,7 +983,7 @@ def get_matched_driver_location(request_id: int, db: Session = Depends(get_db)):
 @app.post("/trips/{trip_id}/accept-passenger")
 def accept_passenger_match(trip_id: int, request_id: int = Query(...), db: Session = Depends(get_db)):
     """Accept a passenger match for Ride Now - links driver to passenger"""
-    trip = db.query(Trip).filter(Trip.id == trip_id).first()
+    trip, request = _trip_and_request(db, trip_id, request_id)
     if not trip:
         raise HTTPException(status_code=404, detail="Trip not found")
     if not trip.is_realtime:
@@ -688,7 +991,6 @@ def accept_passenger_match(trip_id: int, request_id: int = Query(...), db: Sessi
     if trip.available_seats <= 0:
         raise HTTPException(status_code=400, detail="No available seats")
     
-    request = db.query(RideRequest).filter(RideRequest.id == request_id).first()
     if not request:
         raise HTTPException(status_code=404, detail="Ride request not found")
     if not _is_departure_now(request.departure_time):
@@ -698,35 +1000,129 @@ def accept_passenger_match(trip_id: int, request_id: int = Query(...), db: Sessi
     request.status = "matched"
     trip.status = "matched"
     trip.available_seats -= 1
+    _outbox_match(db, trip, request, notify_driver=False, notify_passenger=True)
     db.commit()
     db.refresh(request)
     db.refresh(trip)
+    outbox.wake()
+    _match_changed(trip_id, request_id)
+    _publish_status(trip_id, request_id, "matched")
     return {"message": "Match accepted", "matched_request_id": request_id, "remaining_seats": trip.available_seats}
 
-@app.get("/trips/{trip_id}/matched-passenger")
-def get_matched_passenger_location(trip_id: int, db: Session = Depends(get_db)):
-    """Get the matched passenger's current location for a driver.
-    
-    Returns passenger navigation target (pickup for Ride Now, hub/current for scheduled),
-    plus distance_km and near_pickup flag to trigger pickup confirmation prompt.
+def _nav_target(request: RideRequest) -> Tuple[Optional[float], Optional[float]]:
+    """Where the driver navigates to for a matched request.
+
+    Ride Now: passenger is at pickup. Driver navigates to pickup (no tracking).
+    Scheduled en-route: we use current_lat/lng if updated, else pickup.
     """
-    trip = db.query(Trip).filter(Trip.id == trip_id).first()
+    if _is_departure_now(request.departure_time):
+        return request.pickup_lat, request.pickup_lng
+    return (request.current_lat or request.pickup_lat), (request.current_lng or request.pickup_lng)
+
+def _long_poll_topics(trip_id: Optional[int], request_id: Optional[int]) -> List[str]:
+    topics = []
+    if trip_id is not None:
+        topics.append(pubsub.trip_topic(trip_id))
+    if request_id is not None:
+        topics.append(pubsub.request_topic(request_id))
+    return topics
+
+def _long_poll_relevant(messages: List[dict], ignore_locations_on: Optional[str]) -> bool:
+    """True if any message can change the polled answer (a caller's own position usually can't)."""
+    return any(not (m.get("type") == "location" and m.get("topic") == ignore_locations_on) for m in messages)
+
+# Pair version: columns that move on every write (a flush of the caller's own positions included)
+# without changing the answer, and the position columns of a side whose locations are ignored
+_VERSION_SKIP_COLUMNS = {"updated_at", "change_seq"}
+_POSITION_COLUMNS = {"current_lat", "current_lng", "last_location_update"}
+
+def _pair_version(tag: tuple, trip: Optional[Trip], request: Optional[RideRequest], ignore_locations_on: Optional[str]) -> str:
+    """Version of a polled pair as served: a digest of both rows' columns (positions overlaid).
+    Derived from the shared rows, not from this process, so it means the same on every instance."""
+    parts = list(tag)
+    for obj, topic_of in ((trip, pubsub.trip_topic), (request, pubsub.request_topic)):
+        if obj is None:
+            parts.append("-")
+            continue
+        skip = _VERSION_SKIP_COLUMNS | (_POSITION_COLUMNS if topic_of(obj.id) == ignore_locations_on else set())
+        parts.append(sorted((k, repr(v)) for k, v in entity_cache.snapshot(obj).items() if k not in skip))
+    return hashlib.sha1(repr(parts).encode()).hexdigest()[:16]
+
+async def _long_poll(
+    response: Response,
+    since: Optional[str],
+    wait: float,
+    if_none_match: Optional[str],
+    load,
+    render,
+    tag: tuple,
+    key: Tuple[Optional[int], Optional[int]],
+    ignore_locations_on: Optional[str] = None,
+):
+    """Answer a matched-state poll, holding it until the state changes when the client is up to date.
+
+    load(db) returns the (trip, request) pair behind the answer and render(trip, request) builds the
+    body; key is the polled (trip_id, request_id). The body gets a "version" (also in X-State-Version)
+    from _pair_version(), so any instance can tell whether a client is up to date. With
+    ?since=<version>&wait=<s>, if the pair's version still equals since, the request waits up to
+    wait seconds for a relevant pub/sub message on the pair's topics and answers once the version
+    moves; any other since is answered immediately, so clients just echo back what they got.
+
+    The ETag covers tag, both row versions and the version; a matching If-None-Match is answered
+    with a 304 before render() runs.
+    """
+    def run_load():
+        db = SessionLocal()
+        try:
+            return load(db)
+        finally:
+            db.close()
+
+    def topics_of(trip, request):
+        return _long_poll_topics(trip.id if trip else key[0], request.id if request else key[1])
+
+    trip, request = await asyncio.to_thread(run_load)
+    version = _pair_version(tag, trip, request, ignore_locations_on)
+    wait = min(max(wait, 0.0), LONG_POLL_MAX_WAIT_SECONDS)
+    if since and since.strip() == version and wait > 0:
+        sub = pubsub.bus.subscribe(topics_of(trip, request))
+        try:
+            # Read again once subscribed: a change committed in between is in this read or in sub
+            trip, request = await asyncio.to_thread(run_load)
+            version = _pair_version(tag, trip, request, ignore_locations_on)
+            deadline = time.monotonic() + wait
+            while version == since.strip():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    messages, lagged = await asyncio.wait_for(sub.get(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    break
+                if lagged or _long_poll_relevant(messages, ignore_locations_on):
+                    trip, request = await asyncio.to_thread(run_load)
+                    version = _pair_version(tag, trip, request, ignore_locations_on)
+                    sub.set_topics(topics_of(trip, request))
+        finally:
+            sub.close()
+    etag = _etag(*tag, _row_version(trip), _row_version(request), version)
+    if _etag_matches(if_none_match, etag):
+        return _not_modified(etag, {"X-State-Version": version})
+    response.headers["X-State-Version"] = version
+    response.headers["ETag"] = etag
+    return {**render(trip, request), "version": version}
+
+def _matched_passenger_pair(db: Session, trip_id: int) -> Tuple[Trip, Optional[RideRequest]]:
+    trip, request = _cached_trip_with_request(db, trip_id)
     if not trip:
         raise HTTPException(status_code=404, detail="Trip not found")
-    
-    request = db.query(RideRequest).filter(
-        RideRequest.matched_trip_id == trip_id,
-        RideRequest.status == "matched"
-    ).first()
-    
+    return trip, request
+
+def _matched_passenger_state(trip: Trip, request: Optional[RideRequest]) -> dict:
     if not request:
         return {"matched": False}
     
-    # Ride Now: passenger is at pickup. Driver navigates to pickup (no tracking).
-    # Scheduled en-route: we use current_lat/lng if updated, else pickup.
-    use_pickup = _is_departure_now(request.departure_time)
-    nav_lat = request.pickup_lat if use_pickup else (request.current_lat or request.pickup_lat)
-    nav_lng = request.pickup_lng if use_pickup else (request.current_lng or request.pickup_lng)
+    nav_lat, nav_lng = _nav_target(request)
     
     # Calculate driver distance to pickup/nav target for proximity notifications
     distance_km = None
@@ -739,7 +1135,7 @@ def get_matched_passenger_location(trip_id: int, db: Session = Depends(get_db)):
     if driver_lat and driver_lng and nav_lat and nav_lng:
         distance_km = haversine(driver_lat, driver_lng, nav_lat, nav_lng)
         # Within 500m (0.5 km) - show pickup confirmation prompt; stays active until driver confirms
-        near_pickup = distance_km < 0.5
+        near_pickup = distance_km < NEAR_PICKUP_KM
     
     return {
         "matched": True,
@@ -753,20 +1149,30 @@ def get_matched_passenger_location(trip_id: int, db: Session = Depends(get_db)):
         "near_pickup": near_pickup
     }
 
-@app.get("/trips/{trip_id}/scheduled-match")
-def get_scheduled_match_driver(trip_id: int, db: Session = Depends(get_db)):
-    """Get confirmed scheduled match + meeting hub for a driver (en-route screen)."""
-    trip = db.query(Trip).filter(Trip.id == trip_id).first()
-    if not trip or trip.is_realtime:
-        return {"matched": False}
-    request = db.query(RideRequest).filter(
-        RideRequest.matched_trip_id == trip_id,
-        RideRequest.status == "matched"
-    ).first()
-    if not request or not request.suggested_hub_id:
-        return {"matched": False}
+@app.get("/trips/{trip_id}/matched-passenger")
+async def get_matched_passenger_location(
+    trip_id: int,
+    response: Response,
+    since: Optional[str] = Query(None, description="version from the previous response"),
+    wait: float = Query(0, ge=0, description="Seconds to hold the request until the state changes"),
+    if_none_match: Optional[str] = Header(None),
+):
+    """Get the matched passenger's current location for a driver.
+    
+    Returns passenger navigation target (pickup for Ride Now, hub/current for scheduled),
+    plus distance_km and near_pickup flag to trigger pickup confirmation prompt.
+    Long-poll with ?since=<version>&wait=25 instead of re-polling on a timer; conditional on ETag.
+    """
+    return await _long_poll(
+        response, since, wait, if_none_match,
+        lambda db: _matched_passenger_pair(db, trip_id), _matched_passenger_state,
+        ("matched-passenger",), (trip_id, None),
+    )
+
+def _meeting_hub(trip: Trip, request: RideRequest) -> Optional[dict]:
+    """Meeting point of a scheduled pair (registry hub or the driver's start), or None if unknown."""
     if request.suggested_hub_id == "driver_start" and trip.start_lat and trip.start_lng:
-        hub = {
+        return {
             "id": "driver_start",
             "name": "Meet at driver's start",
             "lat": trip.start_lat,
@@ -776,20 +1182,28 @@ def get_scheduled_match_driver(trip_id: int, db: Session = Depends(get_db)):
             "bus_routes": [],
             "description": "Meet at the driver's starting location (no return transit available)"
         }
-    else:
-        hub_data = HUBS.get(request.suggested_hub_id)
-        if not hub_data:
-            return {"matched": False}
-        hub = {
-            "id": request.suggested_hub_id,
-            "name": hub_data["name"],
-            "lat": hub_data["lat"],
-            "lng": hub_data["lng"],
-            "address": hub_data.get("address", ""),
-            "transit": hub_data.get("transit", False),
-            "bus_routes": hub_data.get("bus_routes", []),
-            "description": hub_data.get("description", "")
-        }
+    hub_data = hubs.get_registry().hubs.get(request.suggested_hub_id) if request.suggested_hub_id else None
+    if not hub_data:
+        return None
+    return {
+        "id": request.suggested_hub_id,
+        "name": hub_data["name"],
+        "lat": hub_data["lat"],
+        "lng": hub_data["lng"],
+        "address": hub_data.get("address", ""),
+        "transit": hub_data.get("transit", False),
+        "bus_routes": hub_data.get("bus_routes", []),
+        "description": hub_data.get("description", "")
+    }
+
+def _driver_scheduled_match_state(trip: Optional[Trip], request: Optional[RideRequest]) -> dict:
+    if not trip or trip.is_realtime:
+        return {"matched": False}
+    if not request or not request.suggested_hub_id:
+        return {"matched": False}
+    hub = _meeting_hub(trip, request)
+    if not hub:
+        return {"matched": False}
     return {
         "matched": True,
         "trip_id": trip.id,
@@ -804,10 +1218,26 @@ def get_scheduled_match_driver(trip_id: int, db: Session = Depends(get_db)):
         "current_lng": request.current_lng,
     }
 
+@app.get("/trips/{trip_id}/scheduled-match")
+async def get_scheduled_match_driver(
+    trip_id: int,
+    response: Response,
+    since: Optional[str] = Query(None, description="version from the previous response"),
+    wait: float = Query(0, ge=0, description="Seconds to hold the request until the state changes"),
+    if_none_match: Optional[str] = Header(None),
+):
+    """Get confirmed scheduled match + meeting hub for a driver (en-route screen). Supports long-poll and ETags."""
+    return await _long_poll(
+        response, since, wait, if_none_match,
+        lambda db: _cached_trip_with_request(db, trip_id), _driver_scheduled_match_state,
+        ("scheduled-match:trip", hubs.get_registry().version), (trip_id, None),
+        ignore_locations_on=pubsub.trip_topic(trip_id),
+    )
+
 @app.post("/trips/{trip_id}/start-en-route")
-async def start_trip_en_route(trip_id: int, db: Session = Depends(get_db)):
+def start_trip_en_route(trip_id: int, db: Session = Depends(get_db)):
     """Driver marks scheduled trip as 'On the way'. Only allowed on the scheduled day. Enables sharing driver location to matched passenger(s)."""
-    trip = db.query(Trip).filter(Trip.id == trip_id).first()
+    trip = db.query(Trip).options(joinedload(Trip.ride_requests)).filter(Trip.id == trip_id).first()
     if not trip:
         raise HTTPException(status_code=404, detail="Trip not found")
     if trip.is_realtime:
@@ -824,27 +1254,28 @@ async def start_trip_en_route(trip_id: int, db: Session = Depends(get_db)):
         trip.current_lat = trip.start_lat
         trip.current_lng = trip.start_lng
         trip.last_location_update = datetime.utcnow()
+    # Push to matched passenger(s), committed with the state change (delivered by outbox.py)
+    matched = [r for r in trip.ride_requests if r.status == "matched"]
+    for r in matched:
+        outbox.add(
+            db, f"en_route:{trip_id}:{r.id}", r.push_token,
+            title="Your driver is on the way!",
+            body=f"{trip.driver_name} is heading to the meeting point. Track their location in the app.",
+            data={
+                "request_id": r.id,
+                "trip_id": trip_id,
+                "action": "track_driver"
+            }
+        )
+    matched_ids = [r.id for r in matched]  # Read before commit expires the loaded rows
     db.commit()
     db.refresh(trip)
+    outbox.wake()
     
-    # Send push notification to matched passenger(s)
-    matched_requests = db.query(RideRequest).filter(
-        RideRequest.matched_trip_id == trip_id,
-        RideRequest.status == "matched"
-    ).all()
-    
-    for request in matched_requests:
-        if request.push_token:
-            await send_expo_push_notification(
-                push_token=request.push_token,
-                title="Your driver is on the way!",
-                body=f"{trip.driver_name} is heading to the meeting point. Track their location in the app.",
-                data={
-                    "request_id": request.id,
-                    "trip_id": trip_id,
-                    "action": "track_driver"
-                }
-            )
+    if not matched_ids:
+        _publish_status(trip_id, None, "en_route")
+    for request_id in matched_ids:
+        _publish_status(trip_id, request_id, "en_route")
     
     return {"en_route": True, "started_at": trip.driver_en_route_at.isoformat()}
 
@@ -852,15 +1283,11 @@ async def start_trip_en_route(trip_id: int, db: Session = Depends(get_db)):
 def confirm_trip_pickup(trip_id: int, db: Session = Depends(get_db)):
     """Driver confirms they picked up the passenger. Sets picked_up_at on trip.
     Only allowed when matched. For Ride Now: always. For Scheduled: after 'On the way'."""
-    trip = db.query(Trip).filter(Trip.id == trip_id).first()
+    trip, request = _trip_with_request(db, trip_id)
     if not trip:
         raise HTTPException(status_code=404, detail="Trip not found")
     
-    # Find matched passenger
-    request = db.query(RideRequest).filter(
-        RideRequest.matched_trip_id == trip_id,
-        RideRequest.status == "matched"
-    ).first()
+    # Matched passenger (loaded with the trip)
     if not request:
         raise HTTPException(status_code=400, detail="No matched passenger found for this trip")
     
@@ -868,9 +1295,16 @@ def confirm_trip_pickup(trip_id: int, db: Session = Depends(get_db)):
     if not trip.is_realtime and not trip.driver_en_route_at:
         raise HTTPException(status_code=400, detail="Driver must be 'On the way' before confirming pickup for scheduled rides")
     
-    # Set driver's pickup confirmation
+    # Set driver's pickup confirmation; prompt the passenger to confirm too
     if not trip.picked_up_at:
         trip.picked_up_at = datetime.utcnow()
+        if not request.picked_up_at:
+            outbox.add(
+                db, f"{_pair_event_key('pickup', trip, request)}:driver", request.push_token,
+                title="Pickup confirmed",
+                body=f"{trip.driver_name} confirmed your pickup. Tap to confirm you're in the car.",
+                data={"request_id": request.id, "trip_id": trip.id, "action": "confirm_pickup"}
+            )
     
     # If both parties confirmed, transition status to picked_up
     if trip.picked_up_at and request.picked_up_at:
@@ -882,6 +1316,9 @@ def confirm_trip_pickup(trip_id: int, db: Session = Depends(get_db)):
     db.commit()
     db.refresh(trip)
     db.refresh(request)
+    outbox.wake()
+    _match_changed(trip.id, request.id)
+    _publish_status(trip.id, request.id, request.status if request.status == "picked_up" else "pickup_confirmed_by_driver")
     
     return {
         "message": "Pickup confirmed by driver",
@@ -895,20 +1332,27 @@ def confirm_trip_pickup(trip_id: int, db: Session = Depends(get_db)):
 def confirm_request_pickup(request_id: int, db: Session = Depends(get_db)):
     """Passenger confirms they were picked up. Sets picked_up_at on request.
     If both parties confirm, status transitions to picked_up."""
-    request = db.query(RideRequest).filter(RideRequest.id == request_id).first()
+    request = _request_with_trip(db, request_id)
     if not request:
         raise HTTPException(status_code=404, detail="Ride request not found")
     
     if not request.matched_trip_id:
         raise HTTPException(status_code=400, detail="Ride request has no matched trip")
     
-    trip = db.query(Trip).filter(Trip.id == request.matched_trip_id).first()
+    trip = request.matched_trip
     if not trip:
         raise HTTPException(status_code=404, detail="Matched trip not found")
     
-    # Set passenger's pickup confirmation
+    # Set passenger's pickup confirmation; prompt the driver to confirm too
     if not request.picked_up_at:
         request.picked_up_at = datetime.utcnow()
+        if not trip.picked_up_at:
+            outbox.add(
+                db, f"{_pair_event_key('pickup', trip, request)}:passenger", trip.push_token,
+                title="Passenger is in the car",
+                body=f"{request.passenger_name} confirmed pickup. Tap to confirm and start the ride.",
+                data={"request_id": request.id, "trip_id": trip.id, "action": "confirm_pickup"}
+            )
     
     # If both parties confirmed, transition status to picked_up
     if trip.picked_up_at and request.picked_up_at:
@@ -920,6 +1364,9 @@ def confirm_request_pickup(request_id: int, db: Session = Depends(get_db)):
     db.commit()
     db.refresh(trip)
     db.refresh(request)
+    outbox.wake()
+    _match_changed(trip.id, request.id)
+    _publish_status(trip.id, request.id, request.status if request.status == "picked_up" else "pickup_confirmed_by_passenger")
     
     return {
         "message": "Pickup confirmed by passenger",
@@ -932,17 +1379,16 @@ def confirm_request_pickup(request_id: int, db: Session = Depends(get_db)):
 @app.post("/trips/{trip_id}/complete")
 def complete_trip(trip_id: int, db: Session = Depends(get_db)):
     """Driver marks ride as completed (arrived at resort). Sets completed_at, status to completed, and frees the seat."""
-    trip = db.query(Trip).filter(Trip.id == trip_id).first()
+    trip = db.query(Trip).options(joinedload(Trip.ride_requests)).filter(Trip.id == trip_id).first()
     if not trip:
         raise HTTPException(status_code=404, detail="Trip not found")
     
     if trip.status == "completed":
         return {"message": "Trip already completed", "completed_at": trip.completed_at.isoformat() if trip.completed_at else None}
     
-    # Find matched passenger(s)
-    requests = db.query(RideRequest).filter(
-        RideRequest.matched_trip_id == trip_id
-    ).all()
+    # Matched passenger(s), loaded with the trip
+    requests = list(trip.ride_requests)
+    request_ids = [r.id for r in requests]
     
     # Mark trip as completed
     trip.completed_at = datetime.utcnow()
@@ -956,6 +1402,11 @@ def complete_trip(trip_id: int, db: Session = Depends(get_db)):
     
     db.commit()
     db.refresh(trip)
+    _match_changed(trip_id)
+    for request_id in request_ids:
+        _publish_status(trip_id, request_id, "completed")
+    if not requests:
+        _publish_status(trip_id, None, "completed")
     
     return {
         "message": "Ride completed",
@@ -980,6 +1431,8 @@ def complete_ride_request(request_id: int, db: Session = Depends(get_db)):
     
     db.commit()
     db.refresh(request)
+    _match_changed(request.matched_trip_id, request_id)
+    _publish_status(request.matched_trip_id, request_id, "completed")
     
     return {
         "message": "Ride completed by passenger",
@@ -987,42 +1440,21 @@ def complete_ride_request(request_id: int, db: Session = Depends(get_db)):
         "completed_at": request.completed_at.isoformat() if request.completed_at else None
     }
 
-@app.get("/ride-requests/{request_id}/scheduled-match")
-def get_scheduled_match_passenger(request_id: int, db: Session = Depends(get_db)):
-    """Get confirmed scheduled match + meeting hub for a passenger (en-route screen)."""
-    request = db.query(RideRequest).filter(RideRequest.id == request_id).first()
+def _pair_for_request(db: Session, request_id: int) -> Tuple[Optional[Trip], Optional[RideRequest]]:
+    """_cached_request_with_trip() in (trip, request) order, for _long_poll()."""
+    request, trip = _cached_request_with_trip(db, request_id)
+    return trip, request
+
+def _passenger_scheduled_match_state(trip: Optional[Trip], request: Optional[RideRequest]) -> dict:
     if not request or _is_departure_now(request.departure_time):
         return {"matched": False}
     if not request.matched_trip_id or request.status != "matched":
         return {"matched": False}
-    trip = db.query(Trip).filter(Trip.id == request.matched_trip_id).first()
     if not trip:
         return {"matched": False}
-    if request.suggested_hub_id == "driver_start" and trip.start_lat and trip.start_lng:
-        hub = {
-            "id": "driver_start",
-            "name": "Meet at driver's start",
-            "lat": trip.start_lat,
-            "lng": trip.start_lng,
-            "address": trip.start_location_text or "Driver's starting location",
-            "transit": False,
-            "bus_routes": [],
-            "description": "Meet at the driver's starting location (no return transit available)"
-        }
-    else:
-        hub_data = HUBS.get(request.suggested_hub_id) if request.suggested_hub_id else None
-        if not hub_data:
-            return {"matched": False}
-        hub = {
-            "id": request.suggested_hub_id,
-            "name": hub_data["name"],
-            "lat": hub_data["lat"],
-            "lng": hub_data["lng"],
-            "address": hub_data.get("address", ""),
-            "transit": hub_data.get("transit", False),
-            "bus_routes": hub_data.get("bus_routes", []),
-            "description": hub_data.get("description", "")
-        }
+    hub = _meeting_hub(trip, request)
+    if not hub:
+        return {"matched": False}
     return {
         "matched": True,
         "trip_id": trip.id,
@@ -1037,55 +1469,573 @@ def get_scheduled_match_passenger(request_id: int, db: Session = Depends(get_db)
         "current_lng": trip.current_lng if trip.driver_en_route_at else None,
     }
 
-@app.put("/trips/{trip_id}/location", response_model=schemas.Trip)
-def update_trip_location(trip_id: int, location: schemas.LocationUpdate, db: Session = Depends(get_db)):
-    """Update driver's current location. Ride Now: always. Scheduled: only on the day-of after driver has tapped 'On the way'."""
-    db_trip = db.query(Trip).filter(Trip.id == trip_id).first()
-    if not db_trip:
-        raise HTTPException(status_code=404, detail="Trip not found")
-    today = date.today()
+@app.get("/ride-requests/{request_id}/scheduled-match")
+async def get_scheduled_match_passenger(
+    request_id: int,
+    response: Response,
+    since: Optional[str] = Query(None, description="version from the previous response"),
+    wait: float = Query(0, ge=0, description="Seconds to hold the request until the state changes"),
+    if_none_match: Optional[str] = Header(None),
+):
+    """Get confirmed scheduled match + meeting hub for a passenger (en-route screen). Supports long-poll and ETags."""
+    return await _long_poll(
+        response, since, wait, if_none_match,
+        lambda db: _pair_for_request(db, request_id), _passenger_scheduled_match_state,
+        ("scheduled-match:request", hubs.get_registry().version), (None, request_id),
+        ignore_locations_on=pubsub.request_topic(request_id),
+    )
+
+# --- RIDE STATE ---
+# One call per en-route screen refresh instead of /trips/{id} + matched-passenger + scheduled-match
+# (or the passenger-side trio): the pair is loaded with one joined query.
+RIDE_STATE_FIELDS = (
+    "matched", "status", "trip_id", "request_id", "trip", "request", "hub", "nav_target",
+    "distance_km", "near_pickup", "driver_on_the_way", "confirmations",
+)
+
+def _ride_state_pair(db: Session, trip_id: Optional[int], request_id: Optional[int]) -> Tuple[Optional[Trip], Optional[RideRequest]]:
+    """The pair around a trip (its matched / picked-up request) or a request (its matched trip)."""
+    if trip_id is not None:
+        trip, request = _trip_with_request(db, trip_id, ("matched", "picked_up"))
+        if not trip:
+            raise HTTPException(status_code=404, detail="Trip not found")
+        return _live_trip(trip), _live_request(request)
+    request, trip = _cached_request_with_trip(db, request_id)
+    if not request:
+        raise HTTPException(status_code=404, detail="Ride request not found")
+    return trip, request
+
+def _ride_state(trip: Optional[Trip], request: Optional[RideRequest], fields: Optional[set]) -> dict:
+    state = {
+        "matched": bool(trip and request),
+        "status": request.status if (trip and request) else (trip or request).status,
+        "trip_id": trip.id if trip else None,
+        "request_id": request.id if request else None,
+        "trip": schemas.Trip.model_validate(trip).model_dump(mode="json") if trip else None,
+        "request": schemas.RideRequest.model_validate(request).model_dump(mode="json") if request else None,
+        "hub": None,
+        "nav_target": None,
+        "distance_km": None,
+        "near_pickup": False,
+        "driver_on_the_way": bool(trip and (trip.is_realtime or trip.driver_en_route_at is not None)),
+        "confirmations": None,
+    }
+    if trip and request:
+        if not trip.is_realtime:
+            state["hub"] = _meeting_hub(trip, request)
+        nav_lat, nav_lng = _nav_target(request)
+        state["nav_target"] = {"lat": nav_lat, "lng": nav_lng}
+        driver_lat = trip.current_lat if trip.current_lat else trip.start_lat
+        driver_lng = trip.current_lng if trip.current_lng else trip.start_lng
+        if driver_lat and driver_lng and nav_lat and nav_lng:
+            distance_km = haversine(driver_lat, driver_lng, nav_lat, nav_lng)
+            state["distance_km"] = round(distance_km, 2)
+            state["near_pickup"] = distance_km < NEAR_PICKUP_KM
+        state["confirmations"] = {
+            "driver": trip.picked_up_at is not None,
+            "passenger": request.picked_up_at is not None,
+            "both": trip.picked_up_at is not None and request.picked_up_at is not None,
+        }
+    if fields:
+        state = {k: v for k, v in state.items() if k in fields}
+    return state
+
+@app.get("/rides/state")
+async def get_ride_state(
+    response: Response,
+    trip_id: Optional[int] = Query(None, description="Driver view: the trip and its matched passenger"),
+    request_id: Optional[int] = Query(None, description="Passenger view: the request and its matched trip"),
+    fields: Optional[str] = Query(None, description=f"Comma-separated subset of: {', '.join(RIDE_STATE_FIELDS)}"),
+    since: Optional[str] = Query(None, description="version from the previous response"),
+    wait: float = Query(0, ge=0, description="Seconds to hold the request until the state changes"),
+    if_none_match: Optional[str] = Header(None),
+):
+    """Everything the en-route screens need about a ride pair in one round trip (and one query).
+
+    Pass exactly one of trip_id / request_id. Derived fields: hub (scheduled meeting point),
+    nav_target (where the driver is heading), distance_km / near_pickup, driver_on_the_way and
+    pickup confirmations. Supports the same ?since=&wait= long-poll and ETags as the matched-state
+    endpoints (the ETag also covers the fields selection).
+    """
+    if (trip_id is None) == (request_id is None):
+        raise HTTPException(status_code=400, detail="Pass exactly one of trip_id or request_id")
+    selected = None
+    if fields:
+        selected = {f.strip() for f in fields.split(",") if f.strip()}
+        unknown = selected - set(RIDE_STATE_FIELDS)
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+    return await _long_poll(
+        response, since, wait, if_none_match,
+        lambda db: _ride_state_pair(db, trip_id, request_id),
+        lambda trip, request: _ride_state(trip, request, selected),
+        ("ride-state", hubs.get_registry().version, ",".join(sorted(selected or RIDE_STATE_FIELDS))),
+        (trip_id, request_id),
+    )
+
+def _trip_accepts_location(db_trip: Trip) -> bool:
+    """Ride Now: always. Scheduled: only on the scheduled day after the driver has tapped 'On the way'."""
     if db_trip.is_realtime:
-        can_update = True
-    else:
-        # Scheduled: only on scheduled day and only after driver has started en route
-        can_update = (
-            db_trip.trip_date is not None
-            and _normalize_date(db_trip.trip_date) == today
-            and db_trip.driver_en_route_at is not None
-        )
-    if not can_update:
-        raise HTTPException(
-            status_code=400,
-            detail="Location updates only for Ride Now or for scheduled trips after you tap 'On the way' on the day of the ride."
-        )
+        return True
+    return (
+        db_trip.trip_date is not None
+        and _normalize_date(db_trip.trip_date) == date.today()
+        and db_trip.driver_en_route_at is not None
+    )
 
-    # When trip has a matched passenger, only accept updates that don't move driver farther from pickup.
-    # This prevents the app's location (e.g. simulator reporting start) from overwriting script/progress.
-    matched_req = db.query(RideRequest).filter(
+def _load_match_context(db: Session, trip_id: int) -> Optional[match_context.MatchContext]:
+    """Matched request of a trip and where the driver is navigating to (cache loader)."""
+    return _match_context_for(_live_request(db.query(RideRequest).filter(
         RideRequest.matched_trip_id == trip_id,
         RideRequest.status == "matched"
-    ).first()
-    if matched_req and matched_req.pickup_lat and matched_req.pickup_lng and location.current_lat and location.current_lng:
-        nav_lat = matched_req.pickup_lat if _is_departure_now(matched_req.departure_time) else (matched_req.current_lat or matched_req.pickup_lat)
-        nav_lng = matched_req.pickup_lng if _is_departure_now(matched_req.departure_time) else (matched_req.current_lng or matched_req.pickup_lng)
+    ).first()))
+
+def _match_context_for(matched_req: Optional[RideRequest]) -> Optional[match_context.MatchContext]:
+    if not matched_req:
+        return None
+    return match_context.MatchContext(
+        request_id=matched_req.id,
+        mode="pickup" if _is_departure_now(matched_req.departure_time) else "tracked",
+        pickup=(matched_req.pickup_lat, matched_req.pickup_lng),
+        nav=_nav_target(matched_req),
+    )
+
+def _match_changed(trip_id: Optional[int] = None, request_id: Optional[int] = None) -> None:
+    """A lifecycle write changed who is matched to whom: drop the cached match context. Call after commit."""
+    match_context.cache.invalidate(trip_id=trip_id, request_id=request_id)
+
+def _moves_away_from_pickup(db: Session, db_trip: Trip, lat: float, lng: float) -> bool:
+    """True if (lat, lng) is farther from the matched passenger's pickup than the driver's current position."""
+    ctx = match_context.cache.get(db_trip.id, lambda tid: _load_match_context(db, tid))
+    if ctx and ctx.pickup[0] and ctx.pickup[1] and lat and lng:
+        nav_lat, nav_lng = ctx.nav
         if nav_lat and nav_lng:
             driver_lat = db_trip.current_lat or db_trip.start_lat
             driver_lng = db_trip.current_lng or db_trip.start_lng
-            dist_new = haversine(location.current_lat, location.current_lng, nav_lat, nav_lng)
+            dist_new = haversine(lat, lng, nav_lat, nav_lng)
             if driver_lat is not None and driver_lng is not None:
                 dist_current = haversine(driver_lat, driver_lng, nav_lat, nav_lng)
-                if dist_new > dist_current:
-                    # Reject update that moves driver farther from pickup (e.g. app sending stale start)
-                    db.refresh(db_trip)
-                    return db_trip
-
-    db_trip.current_lat = location.current_lat
-    db_trip.current_lng = location.current_lng
-    db_trip.last_location_update = datetime.utcnow()
+                return dist_new > dist_current
+    return False
+
+def _trip_nav_target(db: Session, db_trip: Trip) -> Tuple[Optional[float], Optional[float]]:
+    """Where the driver is heading (matched passenger's nav target), from the match context cache."""
+    ctx = match_context.cache.get(db_trip.id, lambda tid: _load_match_context(db, tid))
+    return ctx.nav if ctx else (None, None)
+
+def _km_to(lat: float, lng: float, target: Tuple[Optional[float], Optional[float]]) -> Optional[float]:
+    if target[0] is None or target[1] is None or lat is None or lng is None:
+        return None
+    return haversine(lat, lng, target[0], target[1])
+
+def _since_last_fix(prev_lat, prev_lng, prev_time, lat, lng, fix_time) -> Tuple[Optional[float], Optional[float]]:
+    """(meters moved, seconds elapsed) since the last accepted fix, or (None, None) if there isn't one."""
+    if prev_lat is None or prev_lng is None or prev_time is None:
+        return None, None
+    return haversine(prev_lat, prev_lng, lat, lng) * 1000, (fix_time - prev_time).total_seconds()
+
+def _set_trip_location(db: Session, db_trip: Trip, lat: float, lng: float, fix_time: datetime = None) -> Trip:
+    """Apply a position: buffered (write-behind) when possible, otherwise written through."""
+    fix_time = fix_time or datetime.utcnow()
+    # Publish once the position is readable (buffered or committed): woken long-polls reload it
+    if location_buffer.LOCATION_WRITE_BEHIND and location_buffer.trip_locations.put(db_trip.id, lat, lng, fix_time):
+        _publish_location(pubsub.trip_topic(db_trip.id), lat, lng, fix_time, resort=db_trip.resort)
+        return _live_trip(db_trip)
+    db_trip.current_lat = lat
+    db_trip.current_lng = lng
+    db_trip.last_location_update = fix_time
     db.commit()
     db.refresh(db_trip)
+    _publish_location(pubsub.trip_topic(db_trip.id), lat, lng, fix_time, resort=db_trip.resort)
     return db_trip
 
+@app.put("/trips/{trip_id}/location", response_model=schemas.Trip)
+def update_trip_location(trip_id: int, location: schemas.LocationUpdate, response: Response, db: Session = Depends(get_db)):
+    """Update driver's current location. Ride Now: always. Scheduled: only on the day-of after driver has tapped 'On the way'.
+
+    Redundant fixes (see location_policy.py) are dropped before they reach the DB. Headers:
+    X-Location-Ingest (accepted / dropped / rejected) and X-Next-Report-Seconds (when to report next).
+    """
+    db_trip = _live_trip(db.query(Trip).filter(Trip.id == trip_id).first())
+    if not db_trip:
+        raise HTTPException(status_code=404, detail="Trip not found")
+    if not _trip_accepts_location(db_trip):
+        raise HTTPException(
+            status_code=400,
+            detail="Location updates only for Ride Now or for scheduled trips after you tap 'On the way' on the day of the ride."
+        )
+
+    now = datetime.utcnow()
+    target_km = _km_to(location.current_lat, location.current_lng, _trip_nav_target(db, db_trip))
+    response.headers["X-Next-Report-Seconds"] = str(location_policy.next_report_seconds(target_km))
+
+    # When trip has a matched passenger, only accept updates that don't move driver farther from pickup.
+    # This prevents the app's location (e.g. simulator reporting start) from overwriting script/progress.
+    if _moves_away_from_pickup(db, db_trip, location.current_lat, location.current_lng):
+        # Reject update that moves driver farther from pickup (e.g. app sending stale start)
+        response.headers["X-Location-Ingest"] = "rejected"
+        return db_trip
+
+    moved_m, age_s = _since_last_fix(
+        db_trip.current_lat, db_trip.current_lng, db_trip.last_location_update,
+        location.current_lat, location.current_lng, now,
+    )
+    if not location_policy.evaluate(moved_m, age_s, target_km):
+        response.headers["X-Location-Ingest"] = "dropped"
+        return db_trip
+    response.headers["X-Location-Ingest"] = "accepted"
+
+    location_history.append_trip_fixes(trip_id, [(location.current_lat, location.current_lng, now)])
+    # Write-behind: buffer the fix (flushed in batches); write through if disabled or the buffer is full
+    return _set_trip_location(db, db_trip, location.current_lat, location.current_lng, now)
+
+@app.get("/trips/{trip_id}/trace")
+def get_trip_trace(trip_id: int, db: Session = Depends(get_db)):
+    """Recorded driver track for a trip (ETA analysis, disputes, simulation replays), oldest first."""
+    if not db.query(Trip.id).filter(Trip.id == trip_id).first():
+        raise HTTPException(status_code=404, detail="Trip not found")
+    trace = location_history.read_trip_trace(db, trip_id)
+    return {
+        "trip_id": trip_id,
+        "points": len(trace.t),
+        "t": [str(t) for t in trace.t],
+        "lat": trace.lat.tolist(),
+        "lng": trace.lng.tolist(),
+    }
+
+def _to_utc_naive(ts: datetime) -> datetime:
+    """Client timestamps may carry an offset; the DB stores naive UTC."""
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+    return ts
+
+def _filter_location_batch(
+    fixes: List[schemas.LocationFix],
+    now: datetime,
+    nav: Tuple[Optional[float], Optional[float]] = (None, None),
+) -> Tuple[List[Tuple[float, float, datetime]], int, int]:
+    """Validate and dead-band a batch in one pass over the time-ordered fixes.
+
+    Drops fixes with out-of-range coordinates or timestamps too far in the future / past, and
+    fixes the ingest policy (location_policy.py) finds redundant against the last kept one,
+    using the tighter thresholds near the nav target. The newest valid fix is always kept so
+    the trip's current position ends up at the latest report.
+    Returns (kept [(lat, lng, ts)] oldest first, dropped_invalid, dropped_deadband).
+    """
+    valid = []
+    dropped_invalid = 0
+    oldest = now - timedelta(seconds=LOCATION_BATCH_MAX_AGE_SECONDS)
+    newest = now + timedelta(seconds=LOCATION_BATCH_MAX_SKEW_SECONDS)
+    for fix in fixes:
+        ts = _to_utc_naive(fix.timestamp)
+        if not (-90 <= fix.lat <= 90 and -180 <= fix.lng <= 180) or not (oldest <= ts <= newest):
+            dropped_invalid += 1
+            continue
+        valid.append((fix.lat, fix.lng, min(ts, now)))
+    valid.sort(key=lambda f: f[2])
+
+    kept = []
+    dropped_deadband = 0
+    for i, fix in enumerate(valid):
+        is_newest = i == len(valid) - 1
+        if kept and not is_newest:
+            moved_m, age_s = _since_last_fix(kept[-1][0], kept[-1][1], kept[-1][2], fix[0], fix[1], fix[2])
+            if not location_policy.evaluate(moved_m, age_s, _km_to(fix[0], fix[1], nav)):
+                dropped_deadband += 1
+                continue
+        kept.append(fix)
+    return kept, dropped_invalid, dropped_deadband
+
+@app.post("/trips/{trip_id}/locations")
+def update_trip_locations(trip_id: int, batch: schemas.LocationBatch, db: Session = Depends(get_db)):
+    """Batched driver location ingest (e.g. fixes queued while the app was offline or backgrounded).
+
+    Fixes carry device timestamps. Only the newest accepted fix becomes the trip's current position
+    (and only if it is newer than the position we already have); every accepted fix is queued for
+    the trip's location history. Same eligibility rules as PUT /trips/{id}/location.
+    """
+    if not batch.fixes:
+        raise HTTPException(status_code=400, detail="No fixes in batch")
+    if len(batch.fixes) > LOCATION_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"Too many fixes (max {LOCATION_BATCH_MAX})")
+    db_trip = _live_trip(db.query(Trip).filter(Trip.id == trip_id).first())
+    if not db_trip:
+        raise HTTPException(status_code=404, detail="Trip not found")
+    if not _trip_accepts_location(db_trip):
+        raise HTTPException(
+            status_code=400,
+            detail="Location updates only for Ride Now or for scheduled trips after you tap 'On the way' on the day of the ride."
+        )
+
+    nav = _trip_nav_target(db, db_trip)
+    kept, dropped_invalid, dropped_deadband = _filter_location_batch(batch.fixes, datetime.utcnow(), nav)
+    applied = None
+    if kept:
+        lat, lng, ts = kept[-1]
+        is_newer = db_trip.last_location_update is None or ts > db_trip.last_location_update
+        if is_newer and not _moves_away_from_pickup(db, db_trip, lat, lng):
+            applied = {"lat": lat, "lng": lng, "timestamp": ts.isoformat()}
+    history_queued = location_history.append_trip_fixes(trip_id, kept)
+    if applied:
+        _set_trip_location(db, db_trip, applied["lat"], applied["lng"], kept[-1][2])
+
+    return {
+        "trip_id": trip_id,
+        "received": len(batch.fixes),
+        "accepted": len(kept),
+        "dropped_invalid": dropped_invalid,
+        "dropped_deadband": dropped_deadband,
+        "applied": applied,
+        "history_queued": history_queued,
+        "next_report_seconds": location_policy.next_report_seconds(_km_to(kept[-1][0], kept[-1][1], nav) if kept else None),
+    }
+
+# --- LIVE TRACKING (WebSocket) ---
+# Replaces timer polling of /ride-requests/{id}/matched-driver and /trips/{id}/matched-passenger.
+# The DB is read only on connect and on resync (lifecycle change or subscriber lag); positions
+# arrive through pubsub from the location-update endpoints.
+
+def _tracking_snapshot(trip_id: Optional[int] = None, request_id: Optional[int] = None) -> Optional[dict]:
+    """Current state of the pair around a trip or a request, or None if that row doesn't exist."""
+    db = SessionLocal()
+    try:
+        if trip_id is not None:
+            trip, request = _trip_with_request(db, trip_id, ("matched", "picked_up"))
+            if not trip:
+                return None
+        else:
+            request = _request_with_trip(db, request_id)
+            if not request:
+                return None
+            trip = request.matched_trip
+        trip, request = _live_trip(trip), _live_request(request)
+        if not trip or not request:
+            return {
+                "matched": False,
+                "trip_id": trip.id if trip else None,
+                "request_id": request.id if request else None,
+                "status": (trip or request).status,
+            }
+        nav_lat, nav_lng = _nav_target(request)
+        return {
+            "matched": True,
+            "trip_id": trip.id,
+            "request_id": request.id,
+            "status": request.status,
+            "driver_on_the_way": trip.is_realtime or trip.driver_en_route_at is not None,
+            "driver": {
+                "name": trip.driver_name,
+                "lat": trip.current_lat or trip.start_lat,
+                "lng": trip.current_lng or trip.start_lng,
+                "last_location_update": trip.last_location_update.isoformat() if trip.last_location_update else None,
+            },
+            "passenger": {
+                "name": request.passenger_name,
+                "lat": nav_lat,
+                "lng": nav_lng,
+                "pickup_lat": request.pickup_lat,
+                "pickup_lng": request.pickup_lng,
+                "tracked": not _is_departure_now(request.departure_time),
+                "last_location_update": request.last_location_update.isoformat() if request.last_location_update else None,
+            },
+        }
+    finally:
+        db.close()
+
+def _tracking_proximity(snapshot: dict) -> dict:
+    """distance_km / near_pickup between the driver and the passenger's nav target."""
+    driver, passenger = snapshot["driver"], snapshot["passenger"]
+    if driver["lat"] and driver["lng"] and passenger["lat"] and passenger["lng"]:
+        distance_km = haversine(driver["lat"], driver["lng"], passenger["lat"], passenger["lng"])
+        return {"distance_km": round(distance_km, 2), "near_pickup": distance_km < NEAR_PICKUP_KM}
+    return {"distance_km": None, "near_pickup": False}
+
+def _tracking_topics(snapshot: dict) -> List[str]:
+    """pubsub topics of both sides of the pair in a snapshot."""
+    topics = []
+    if snapshot["trip_id"] is not None:
+        topics.append(pubsub.trip_topic(snapshot["trip_id"]))
+    if snapshot["request_id"] is not None:
+        topics.append(pubsub.request_topic(snapshot["request_id"]))
+    return topics
+
+def _apply_tracking_location(snapshot: dict, message: dict) -> Optional[str]:
+    """Fold a pubsub location message into a snapshot. Returns the side that moved ("driver" /
+    "passenger"), or None if it doesn't change anything (unmatched, or Ride Now passenger)."""
+    if not snapshot["matched"]:
+        return None
+    role = "driver" if message["topic"] == pubsub.trip_topic(snapshot["trip_id"]) else "passenger"
+    side = snapshot[role]
+    if role == "passenger" and not side["tracked"]:
+        return None  # Ride Now: nav target stays the pickup point
+    side.update(lat=message["lat"], lng=message["lng"], last_location_update=message["last_location_update"])
+    return role
+
+async def _tracking_resync(websocket: WebSocket, sub: pubsub.Subscription, trip_id: Optional[int], request_id: Optional[int]) -> Optional[dict]:
+    """Reload the pair, point the subscription at both sides' topics and send a snapshot."""
+    snapshot = await asyncio.to_thread(_tracking_snapshot, trip_id, request_id)
+    if snapshot is None:
+        return None
+    sub.set_topics(_tracking_topics(snapshot))
+    payload = dict(snapshot)
+    if snapshot["matched"]:
+        payload.update(_tracking_proximity(snapshot))
+    await websocket.send_json({"type": "snapshot", **payload})
+    return snapshot
+
+async def _run_tracking_socket(websocket: WebSocket, trip_id: Optional[int] = None, request_id: Optional[int] = None):
+    await websocket.accept()
+    sub = pubsub.bus.subscribe()
+    # Clients don't need to send anything; reading just notices the disconnect
+    receiver = asyncio.create_task(websocket.receive_text())
+    try:
+        snapshot = await _tracking_resync(websocket, sub, trip_id, request_id)
+        if snapshot is None:
+            await websocket.close(code=4404, reason="Not found")
+            return
+        while True:
+            getter = asyncio.create_task(sub.get())
+            done, _ = await asyncio.wait({getter, receiver}, return_when=asyncio.FIRST_COMPLETED)
+            if receiver in done:
+                getter.cancel()
+                if receiver.exception() is not None:
+                    break
+                receiver = asyncio.create_task(websocket.receive_text())
+                continue
+            messages, lagged = getter.result()
+            resync = lagged
+            for message in messages:
+                if message["type"] == "status":
+                    await websocket.send_json(message)
+                    resync = True
+                elif message["type"] == "location" and not resync:
+                    role = _apply_tracking_location(snapshot, message)
+                    if role is None:
+                        continue
+                    await websocket.send_json({
+                        "type": "location",
+                        "role": role,
+                        "lat": message["lat"],
+                        "lng": message["lng"],
+                        "last_location_update": message["last_location_update"],
+                        **_tracking_proximity(snapshot),
+                    })
+            if resync:
+                snapshot = await _tracking_resync(websocket, sub, trip_id, request_id)
+                if snapshot is None:
+                    await websocket.close(code=4404, reason="Not found")
+                    return
+    except WebSocketDisconnect:
+        pass
+    finally:
+        receiver.cancel()
+        sub.close()
+
+@app.websocket("/ws/trips/{trip_id}")
+async def track_trip_socket(websocket: WebSocket, trip_id: int):
+    """Driver's live channel: matched passenger's position, distance/near_pickup and lifecycle events."""
+    await _run_tracking_socket(websocket, trip_id=trip_id)
+
+@app.websocket("/ws/ride-requests/{request_id}")
+async def track_request_socket(websocket: WebSocket, request_id: int):
+    """Passenger's live channel: matched driver's position, distance/near_pickup and lifecycle events."""
+    await _run_tracking_socket(websocket, request_id=request_id)
+
+# --- LIVE TRACKING (Server-Sent Events) ---
+# Same pubsub feed as the WebSocket channel, for clients that can't use WebSockets. Every event
+# carries an id (a pubsub cursor); reconnecting with Last-Event-ID replays only what changed since
+# (lifecycle events in order, then the latest position) or, if that's no longer known, a fresh state.
+
+SSE_MEDIA_TYPE = "text/event-stream"
+SSE_KEEPALIVE_SECONDS = 15
+SSE_RETRY_MS = 3000
+
+def _sse_event(event: str, data: dict, seq: int) -> str:
+    return f"id: {pubsub.bus.cursor(seq)}\nevent: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+def _sse_state(snapshot: dict) -> dict:
+    state = dict(snapshot)
+    if snapshot["matched"]:
+        state.update(_tracking_proximity(snapshot))
+    return state
+
+async def _ride_request_event_stream(http_request: Request, request_id: int, snapshot: dict, snapshot_seq: int, resume_seq: Optional[int]):
+    sub = pubsub.bus.subscribe(_tracking_topics(snapshot))
+    try:
+        yield f"retry: {SSE_RETRY_MS}\n\n"
+        pending = pubsub.bus.since(_tracking_topics(snapshot), resume_seq) if resume_seq is not None else None
+        if pending is None:
+            # Fresh connection, or a cursor we can't resume from: send the whole state, then
+            # whatever was published between reading it and subscribing
+            yield _sse_event("state", _sse_state(snapshot), snapshot_seq)
+            last_seq = snapshot_seq
+            pending = pubsub.bus.since(_tracking_topics(snapshot), snapshot_seq) or []
+        else:
+            last_seq = resume_seq
+        near_pickup = _sse_state(snapshot).get("near_pickup", False)
+
+        while True:
+            resync = False
+            for message in pending or []:
+                if message["seq"] <= last_seq:
+                    continue  # Already sent (overlap between since() and the mailbox)
+                last_seq = message["seq"]
+                if message["type"] == "status":
+                    yield _sse_event("status", {k: message[k] for k in ("status", "trip_id", "request_id")}, message["seq"])
+                    resync = True
+                elif message["type"] == "location" and not resync:
+                    role = _apply_tracking_location(snapshot, message)
+                    if role is None:
+                        continue
+                    proximity = _tracking_proximity(snapshot)
+                    if role == "driver":
+                        yield _sse_event("driver_location", {**snapshot["driver"], **proximity}, message["seq"])
+                    if proximity["near_pickup"] != near_pickup:
+                        near_pickup = proximity["near_pickup"]
+                        yield _sse_event("near_pickup", proximity, message["seq"])
+
+            if resync or pending is None:
+                snapshot_seq = pubsub.bus.current_seq()
+                snapshot = await asyncio.to_thread(_tracking_snapshot, None, request_id)
+                if snapshot is None:
+                    return
+                sub.set_topics(_tracking_topics(snapshot))
+                last_seq = max(last_seq, snapshot_seq)
+                yield _sse_event("state", _sse_state(snapshot), last_seq)
+                near_pickup = _sse_state(snapshot).get("near_pickup", False)
+                pending = pubsub.bus.since(_tracking_topics(snapshot), snapshot_seq) or []
+                continue
+
+            try:
+                pending, lagged = await asyncio.wait_for(sub.get(), SSE_KEEPALIVE_SECONDS)
+                if lagged:
+                    pending = None
+            except asyncio.TimeoutError:
+                if await http_request.is_disconnected():
+                    return
+                yield ": keepalive\n\n"
+                pending = []
+    finally:
+        sub.close()
+
+@app.get("/ride-requests/{request_id}/events")
+async def ride_request_events(
+    request_id: int,
+    http_request: Request,
+    last_event_id: Optional[str] = Header(None),
+):
+    """SSE stream for a passenger: matched driver's location, near_pickup changes and lifecycle
+    transitions (matched, en_route, picked_up, completed, ...). Supports Last-Event-ID resume."""
+    snapshot_seq = pubsub.bus.current_seq()
+    snapshot = await asyncio.to_thread(_tracking_snapshot, None, request_id)
+    if snapshot is None:
+        raise HTTPException(status_code=404, detail="Ride request not found")
+    return StreamingResponse(
+        _ride_request_event_stream(http_request, request_id, snapshot, snapshot_seq, pubsub.bus.parse_cursor(last_event_id)),
+        media_type=SSE_MEDIA_TYPE,
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 # --- MATCHING & SEARCH ---
 @app.get("/match-nearby-passengers/")
 def match_passengers(trip_id: int, resort: str, db: Session = Depends(get_db)):
@@ -1094,7 +2044,7 @@ def match_passengers(trip_id: int, resort: str, db: Session = Depends(get_db)):
     Uses driver's current location from the trip to find passengers along their route.
     """
     # Get the driver's trip and current location
-    trip = db.query(Trip).filter(Trip.id == trip_id).first()
+    trip = _live_trip(db.query(Trip).filter(Trip.id == trip_id).first())
     if not trip:
         raise HTTPException(status_code=404, detail="Trip not found")
     if not trip.is_realtime:
@@ -1107,7 +2057,7 @@ def match_passengers(trip_id: int, resort: str, db: Session = Depends(get_db)):
     if not driver_lat or not driver_lng:
         return []  # No location available
     
-    resort_coords = next((r for r in RESORTS_DATA if r["name"] == resort), None)
+    resort_coords = hubs.get_registry().resort(resort)
     if not resort_coords: 
         return []
 
@@ -1154,7 +2104,7 @@ def match_passengers(trip_id: int, resort: str, db: Session = Depends(get_db)):
 @app.get("/match-nearby-passengers/debug")
 def match_passengers_debug(trip_id: int, resort: str, db: Session = Depends(get_db)):
     """Debug why match-nearby-passengers returns no matches."""
-    trip = db.query(Trip).filter(Trip.id == trip_id).first()
+    trip = _live_trip(db.query(Trip).filter(Trip.id == trip_id).first())
     if not trip:
         return {"error": "Trip not found", "trip_id": trip_id}
     if not trip.is_realtime:
@@ -1172,7 +2122,7 @@ def match_passengers_debug(trip_id: int, resort: str, db: Session = Depends(get_
             "start_lng": trip.start_lng,
         }
 
-    resort_coords = next((r for r in RESORTS_DATA if r["name"] == resort), None)
+    resort_coords = hubs.get_registry().resort(resort)
     if not resort_coords:
         return {"error": "Resort not found", "resort": resort}
 
@@ -1247,7 +2197,7 @@ def match_drivers(request_id: int, resort: str, db: Session = Depends(get_db)):
     if not passenger_lat or not passenger_lng:
         return []  # No location available
     
-    resort_coords = next((r for r in RESORTS_DATA if r["name"] == resort), None)
+    resort_coords = hubs.get_registry().resort(resort)
     if not resort_coords: 
         return []
 
@@ -1260,6 +2210,7 @@ def match_drivers(request_id: int, resort: str, db: Session = Depends(get_db)):
 
     matches = []
     for trip in trips:
+        _live_trip(trip)
         # Use driver's current location, fallback to start (so trips with only start still match)
         driver_lat = trip.current_lat or trip.start_lat
         driver_lng = trip.current_lng or trip.start_lng
@@ -1300,58 +2251,190 @@ def match_drivers(request_id: int, resort: str, db: Session = Depends(get_db)):
                 })
     return matches
 
-@app.get("/trips/active")
-def get_active_trips(is_realtime: Optional[bool] = None, db: Session = Depends(get_db)):
-    """Get all active trips for map display"""
+def _wants_ndjson(accept: Optional[str]) -> bool:
+    """True if the client asked for a streamed NDJSON response."""
+    return bool(accept) and NDJSON_MEDIA_TYPE in accept.lower()
+
+def _ndjson_stream(build_query, serialize):
+    """Yield one JSON line per row from a server-side cursor (yield_per), keeping memory flat.
+    Uses its own session so the cursor outlives the request-scoped dependency."""
+    db = SessionLocal()
+    try:
+        for row in build_query(db).yield_per(STREAM_YIELD_PER):
+            yield json.dumps(serialize(row), default=str) + "\n"
+    finally:
+        db.close()
+
+def _active_trips_query(db: Session, is_realtime: Optional[bool]):
     query = db.query(Trip).filter(Trip.available_seats > 0)
-    
     if is_realtime is not None:
         query = query.filter(Trip.is_realtime == is_realtime)
-    
-    trips = query.all()
-    return [
-        {
-            "id": trip.id,
-            "driver_name": trip.driver_name,
-            "resort": trip.resort,
-            "start_lat": trip.start_lat,
-            "start_lng": trip.start_lng,
-            "current_lat": trip.current_lat,
-            "current_lng": trip.current_lng,
-            "available_seats": trip.available_seats,
-            "is_realtime": trip.is_realtime,
-            "departure_time": trip.departure_time
-        }
-        for trip in trips
-    ]
+    return query
 
-@app.get("/ride-requests/active")
-def get_active_requests(is_realtime: Optional[bool] = None, db: Session = Depends(get_db)):
-    """Get all active ride requests for map display"""
+def _active_trip_row(trip: Trip, fields: Tuple[str, ...] = ACTIVE_TRIP_FIELDS) -> dict:
+    _live_trip(trip)
+    return {f: getattr(trip, f) for f in fields}
+
+def _trip_map_position():
+    """Where a trip is drawn: the driver's last known position, else the start."""
+    return func.coalesce(Trip.current_lat, Trip.start_lat), func.coalesce(Trip.current_lng, Trip.start_lng)
+
+def _active_requests_query(db: Session, is_realtime: Optional[bool]):
     query = db.query(RideRequest).filter(RideRequest.status == "pending")
-    
     if is_realtime is not None:
         now_expr = func.lower(func.trim(func.coalesce(RideRequest.departure_time, ""))) == "now"
         if is_realtime:
             query = query.filter(now_expr)
         else:
             query = query.filter(~now_expr)
-    
-    requests = query.all()
-    return [
-        {
-            "id": req.id,
-            "passenger_name": req.passenger_name,
-            "resort": req.resort,
-            "pickup_lat": req.pickup_lat,
-            "pickup_lng": req.pickup_lng,
-            "current_lat": req.current_lat,
-            "current_lng": req.current_lng,
-            "departure_time": req.departure_time,
-            "status": req.status
+    return query
+
+def _active_request_row(req: RideRequest, fields: Tuple[str, ...] = ACTIVE_REQUEST_FIELDS) -> dict:
+    _live_request(req)
+    return {f: getattr(req, f) for f in fields}
+
+def _request_map_position():
+    """Where a request is drawn: the passenger's last known position, else the pickup."""
+    return func.coalesce(RideRequest.current_lat, RideRequest.pickup_lat), func.coalesce(RideRequest.current_lng, RideRequest.pickup_lng)
+
+def _parse_bbox(bbox: str) -> Tuple[float, float, float, float]:
+    """min_lng,min_lat,max_lng,max_lat (min_lng > max_lng means the box crosses the antimeridian)."""
+    try:
+        min_lng, min_lat, max_lng, max_lat = (float(v) for v in bbox.split(","))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="bbox must be min_lng,min_lat,max_lng,max_lat")
+    if not (-90 <= min_lat <= max_lat <= 90) or not (-180 <= min_lng <= 180 and -180 <= max_lng <= 180):
+        raise HTTPException(status_code=400, detail="bbox out of range")
+    return min_lng, min_lat, max_lng, max_lat
+
+def _map_response(db: Session, build_query, model, position, serialize, all_fields, bbox, zoom, fields, cursor, limit, accept):
+    """Viewport form of the map endpoints: payload follows what is visible, not fleet size.
+
+    Rows are placed by position (lat, lng SQL expressions; buffered fixes not yet flushed are
+    shown in the rows but not used for placement). Below MAP_CLUSTER_BELOW_ZOOM the DB groups them
+    into a grid (cell size follows the zoom) and only counts per cell come back; otherwise rows are
+    paged by id with the requested fields (id always included).
+    """
+    selected = all_fields
+    if fields:
+        requested = {f.strip() for f in fields.split(",") if f.strip()}
+        unknown = requested - set(all_fields)
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+        selected = tuple(f for f in all_fields if f == "id" or f in requested)
+    after_id = None
+    if cursor is not None:
+        if not cursor.isdigit():
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        after_id = int(cursor)
+    view = _parse_bbox(bbox) if bbox else None
+    lat, lng = position
+
+    def scoped(s: Session):
+        query = build_query(s).filter(lat.isnot(None), lng.isnot(None))
+        if view:
+            min_lng, min_lat, max_lng, max_lat = view
+            query = query.filter(lat.between(min_lat, max_lat))
+            if min_lng <= max_lng:
+                query = query.filter(lng.between(min_lng, max_lng))
+            else:
+                query = query.filter((lng >= min_lng) | (lng <= max_lng))
+        return query
+
+    if zoom is not None and zoom < MAP_CLUSTER_BELOW_ZOOM:
+        cell = 360.0 / (2 ** zoom) / MAP_CLUSTER_CELLS_PER_TILE
+        row_idx, col_idx = func.floor(lat / cell), func.floor(lng / cell)
+        cells = scoped(db).with_entities(
+            row_idx, col_idx, func.count(), func.avg(lat), func.avg(lng)
+        ).group_by(row_idx, col_idx).all()
+        return {
+            "clustered": True,
+            "cell_deg": cell,
+            "total": sum(c[2] for c in cells),
+            "clusters": [
+                {
+                    "lat": c[3],
+                    "lng": c[4],
+                    "count": c[2],
+                    "bbox": [c[1] * cell, c[0] * cell, (c[1] + 1) * cell, (c[0] + 1) * cell],
+                }
+                for c in cells
+            ],
         }
-        for req in requests
-    ]
+
+    columns = [getattr(model, f) for f in selected]
+
+    def page_query(s: Session):
+        query = scoped(s).options(load_only(*columns)).order_by(model.id)
+        if after_id is not None:
+            query = query.filter(model.id > after_id)
+        return query
+
+    if _wants_ndjson(accept):
+        return StreamingResponse(
+            _ndjson_stream(page_query, lambda row: serialize(row, selected)),
+            media_type=NDJSON_MEDIA_TYPE,
+        )
+    page_size = limit or MAP_PAGE_DEFAULT
+    rows = page_query(db).limit(page_size + 1).all()
+    more = len(rows) > page_size
+    rows = rows[:page_size]
+    return {
+        "clustered": False,
+        "items": [serialize(row, selected) for row in rows],
+        "next_cursor": str(rows[-1].id) if more else None,
+    }
+
+@app.get("/ride-requests/active")
+def get_active_requests(
+    is_realtime: Optional[bool] = None,
+    bbox: Optional[str] = Query(None, description="Viewport: min_lng,min_lat,max_lng,max_lat"),
+    zoom: Optional[int] = Query(None, ge=0, le=22, description=f"Map zoom; below {MAP_CLUSTER_BELOW_ZOOM} requests are grid-clustered"),
+    fields: Optional[str] = Query(None, description="Comma-separated subset of: " + ", ".join(ACTIVE_REQUEST_FIELDS)),
+    cursor: Optional[str] = Query(None, description="next_cursor from the previous page"),
+    limit: Optional[int] = Query(None, ge=1, le=MAP_PAGE_MAX, description=f"Page size (default {MAP_PAGE_DEFAULT})"),
+    accept: Optional[str] = Header(None),
+    db: Session = Depends(get_db),
+):
+    """Get active ride requests for map display.
+
+    Without viewport parameters: every pending request (Accept: application/x-ndjson streams one per line).
+    Viewport parameters work as on /trips/active (bbox filter, clusters at low zoom, paged projection).
+    """
+    if any(p is not None for p in (bbox, zoom, fields, cursor, limit)):
+        return _map_response(
+            db, lambda s: _active_requests_query(s, is_realtime), RideRequest, _request_map_position(),
+            _active_request_row, ACTIVE_REQUEST_FIELDS, bbox, zoom, fields, cursor, limit, accept,
+        )
+    if _wants_ndjson(accept):
+        return StreamingResponse(
+            _ndjson_stream(lambda s: _active_requests_query(s, is_realtime), _active_request_row),
+            media_type=NDJSON_MEDIA_TYPE,
+        )
+    return [_active_request_row(req) for req in _active_requests_query(db, is_realtime).all()]
+
+# Change feed (change_feed.py): same rows and "active" meaning as the map endpoints above
+CHANGE_FEEDS = (
+    change_feed.Feed("trips", entity_cache.TRIP, Trip, ACTIVE_TRIP_FIELDS, Trip.available_seats > 0),
+    change_feed.Feed("ride_requests", entity_cache.REQUEST, RideRequest, ACTIVE_REQUEST_FIELDS, RideRequest.status == "pending"),
+)
+
+@app.get("/changes")
+def get_changes(
+    since: Optional[str] = Query(None, description="cursor from the previous response; omit to start an initial sync"),
+    limit: int = Query(change_feed.CHANGE_FEED_PAGE, ge=1, le=5000, description="Max changes per response"),
+    db: Session = Depends(get_db),
+):
+    """Trips and ride requests inserted, updated or deleted since a cursor, for keeping a local mirror.
+
+    Per table: "fields" names the columns of each entry in "rows" (the map row plus "active", false
+    once it no longer belongs on the map) and "deleted" lists removed ids. Follow "cursor" while
+    "more" is true; on "reset" drop the mirror and start again without a cursor.
+    """
+    try:
+        return change_feed.read(db, CHANGE_FEEDS, since, limit)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
 
 def parse_time(time_str: str) -> Optional[int]:
     """Parse time string like '7:00 AM' or '7:00AM' to minutes since midnight"""
@@ -1429,25 +2512,195 @@ def _safe_float(x, default: float = 0.0) -> float:
     except (TypeError, ValueError):
         return default
 
+def _optimal_hub_candidates(registry: hubs.HubRegistry, trip: Trip) -> np.ndarray:
+    """Matrix column indices of the trip's eligible hubs: the resort's hubs within
+    OPTIMAL_HUB_ROUTE_KM of the driver's start -> resort route (resort_hubs order)."""
+    idx = registry.matrix.indices_for_resort(trip.resort)
+    if trip.start_lat is None or trip.start_lng is None or not len(idx):
+        return idx[:0]
+    xtd = registry.matrix.route_xtd_km(trip.resort, trip.start_lat, trip.start_lng, idx)
+    return idx[xtd < OPTIMAL_HUB_ROUTE_KM]
+
+def _optimal_hubs_for_points(registry: hubs.HubRegistry, candidates: np.ndarray, lats, lngs) -> List[Optional[dict]]:
+    """Closest candidate hub for each point, via one (N, K) distance matrix."""
+    if not len(candidates):
+        return [None] * len(lats)
+    dists = registry.matrix.points_to_hubs_km(lats, lngs, candidates)
+    best = np.argmin(dists, axis=1)
+    out = []
+    for row, k in enumerate(best):
+        hid = registry.matrix.hub_ids[int(candidates[k])]
+        hdata = registry.hubs[hid]
+        out.append({"id": hid, "name": hdata["name"], "lat": hdata["lat"], "lng": hdata["lng"], "dist": float(dists[row, k])})
+    return out
+
 @app.get("/get-optimal-hub/")
 def get_optimal_hub(p_lat: float, p_lng: float, trip_id: int, db: Session = Depends(get_db)):
+    """Closest of the trip's eligible hubs (resort hubs on the driver's route) to one passenger point."""
     trip = db.query(Trip).filter(Trip.id == trip_id).first()
     if not trip:
         raise HTTPException(status_code=404, detail="Trip not found")
-    resort = next(r for r in RESORTS_DATA if r["name"] == trip.resort)
-    
-    valid_hubs = []
-    for hid, hdata in HUBS.items():
-        xtd = get_cross_track_distance(trip.start_lat, trip.start_lng, resort["lat"], resort["lng"], hdata["lat"], hdata["lng"])
-        if xtd < 1.5:
-            dist = haversine(p_lat, p_lng, hdata["lat"], hdata["lng"])
-            valid_hubs.append({"id": hid, "name": hdata["name"], "lat": hdata["lat"], "lng": hdata["lng"], "dist": dist})
-    
-    return sorted(valid_hubs, key=lambda x: x["dist"])[0] if valid_hubs else None
+    registry = hubs.get_registry()
+    if not registry.resort(trip.resort):
+        raise HTTPException(status_code=404, detail="Resort not found")
+    candidates = _optimal_hub_candidates(registry, trip)
+    return _optimal_hubs_for_points(registry, candidates, [p_lat], [p_lng])[0]
+
+# Max passenger points per /get-optimal-hub/batch call
+OPTIMAL_HUB_BATCH_MAX = 200
+
+@app.post("/get-optimal-hub/batch")
+def get_optimal_hub_batch(body: schemas.OptimalHubBatchRequest, db: Session = Depends(get_db)):
+    """Best hub for each of N passenger points against one trip (one DB read, vectorized).
+    results[i] corresponds to passengers[i]; null where the trip has no eligible hub."""
+    if len(body.passengers) > OPTIMAL_HUB_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"Too many passengers (max {OPTIMAL_HUB_BATCH_MAX})")
+    trip = db.query(Trip).filter(Trip.id == body.trip_id).first()
+    if not trip:
+        raise HTTPException(status_code=404, detail="Trip not found")
+    registry = hubs.get_registry()
+    if not registry.resort(trip.resort):
+        raise HTTPException(status_code=404, detail="Resort not found")
+    candidates = _optimal_hub_candidates(registry, trip)
+    results = _optimal_hubs_for_points(
+        registry, candidates,
+        [p.lat for p in body.passengers],
+        [p.lng for p in body.passengers],
+    ) if body.passengers else []
+    return {
+        "trip_id": trip.id,
+        "resort": trip.resort,
+        "eligible_hub_ids": [registry.matrix.hub_ids[int(i)] for i in candidates],
+        "results": results,
+    }
+
+def _invalidate_trip_snapshot(db: Session, trip: Trip):
+    """Drop the prematch snapshot a scheduled trip write can affect (caller commits)."""
+    if trip is not None and not trip.is_realtime:
+        prematch.invalidate(db, trip.resort, _normalize_date(trip.trip_date))
+
+def _invalidate_request_snapshot(db: Session, request: RideRequest):
+    """Drop the prematch snapshot a scheduled ride request write can affect (caller commits)."""
+    if request is not None and not _is_departure_now(request.departure_time):
+        prematch.invalidate(db, request.resort, _normalize_date(request.request_date))
+
+def compute_scheduled_matches(db: Session, resort: str, target_date: date) -> List[schemas.ScheduledMatch]:
+    """Run the scheduled matcher for one resort and date (top 10 by total hub distance).
+    Shared by /match-scheduled/ and the prematch snapshot refresher."""
+    # Get scheduled trips (not real-time) for the target date
+    trips = db.query(Trip).filter(
+        Trip.resort == resort,
+        Trip.is_realtime == False,
+        Trip.available_seats > 0
+    ).all()
+    trips = [t for t in trips if _date_eq(t.trip_date, target_date)]
+
+    # Get scheduled ride requests for the target date (exclude Ride Now)
+    now_expr = func.lower(func.trim(func.coalesce(RideRequest.departure_time, ""))) == "now"
+    requests = db.query(RideRequest).filter(
+        RideRequest.resort == resort,
+        RideRequest.status == "pending",
+        ~now_expr
+    ).all()
+    requests = [r for r in requests if _date_eq(r.request_date, target_date)]
+
+    return _match_scheduled_partition(resort, trips, requests)
+
+def _match_scheduled_partition(resort: str, trips: List[Trip], requests: List[RideRequest]) -> List[schemas.ScheduledMatch]:
+    """Pure matcher over already-loaded rows for one resort/date partition (no DB access).
+    Safe to run in a worker thread once the rows are loaded."""
+    if not trips or not requests:
+        return []
+
+    registry = hubs.get_registry()
+    resort_coords = registry.resort(resort)
+    if not resort_coords:
+        return []
+    resort_hubs = registry.hubs_for_resort(resort)
+    matrix = registry.matrix
+    hub_idx = matrix.indices_for_resort(resort)
+    # Passenger -> hub distances depend only on the request; compute once per request, not per pair
+    passenger_dists = {}
+
+    matches = []
+    for trip in trips:
+        # Driver route cross-track and driver -> hub distances for every resort hub, once per trip
+        if trip.start_lat is not None and trip.start_lng is not None and len(hub_idx):
+            on_route = matrix.route_xtd_km(resort, trip.start_lat, trip.start_lng, hub_idx) <= HUB_ROUTE_KM
+            driver_dists = matrix.point_to_hubs_km(trip.start_lat, trip.start_lng, hub_idx)
+        else:
+            on_route = None
+        for req in requests:
+            if req.matched_trip_id:
+                continue
+            # Ensure str for time comparison (DB can have null)
+            t_dep = (trip.departure_time or "").strip() or "?"
+            r_dep = (req.departure_time or "").strip() or "?"
+            time_diff = time_difference_minutes(t_dep, r_dep)
+            if time_diff is None or time_diff > 60:
+                continue
+
+            seats_needed = req.seats_needed if hasattr(req, 'seats_needed') and req.seats_needed else 1
+            if trip.available_seats < seats_needed:
+                continue
+            if trip.start_lat is None or trip.start_lng is None or req.pickup_lat is None or req.pickup_lng is None:
+                continue
+
+            best_hub = None
+            if on_route is not None and on_route.any():
+                p_dists = passenger_dists.get(req.id)
+                if p_dists is None:
+                    p_dists = passenger_dists[req.id] = matrix.point_to_hubs_km(req.pickup_lat, req.pickup_lng, hub_idx)
+                scores = np.where(on_route, driver_dists + p_dists + (time_diff * 0.1), np.inf)
+                k = int(np.argmin(scores))  # first minimum, same tie-break as a strict < scan
+                hub_id, hub = resort_hubs[k]
+                best_hub = {
+                    "id": hub_id,
+                    "name": hub["name"],
+                    "lat": hub["lat"],
+                    "lng": hub["lng"],
+                    "driver_distance": float(driver_dists[k]),
+                    "passenger_distance": float(p_dists[k])
+                }
+
+            if not best_hub and trip.start_lat is not None and trip.start_lng is not None and req.pickup_lat is not None and req.pickup_lng is not None:
+                dist_driver = 0.0
+                dist_passenger = haversine(req.pickup_lat, req.pickup_lng, trip.start_lat, trip.start_lng)
+                best_hub = {
+                    "id": "driver_start",
+                    "name": "Meet at driver's start",
+                    "lat": trip.start_lat,
+                    "lng": trip.start_lng,
+                    "driver_distance": dist_driver,
+                    "passenger_distance": dist_passenger
+                }
+
+            if best_hub:
+                matches.append(schemas.ScheduledMatch(
+                    trip_id=trip.id,
+                    request_id=req.id,
+                    driver_name=trip.driver_name or "",
+                    passenger_name=req.passenger_name or "",
+                    resort=resort,
+                    suggested_hub={
+                        "id": str(best_hub["id"]),
+                        "name": str(best_hub["name"]),
+                        "lat": _safe_float(best_hub["lat"]),
+                        "lng": _safe_float(best_hub["lng"]),
+                    },
+                    driver_departure_time=t_dep,
+                    passenger_departure_time=r_dep,
+                    hub_distance_driver=_safe_float(best_hub.get("driver_distance")),
+                    hub_distance_passenger=_safe_float(best_hub.get("passenger_distance")),
+                ))
+
+    matches.sort(key=lambda x: x.hub_distance_driver + x.hub_distance_passenger)
+    return matches[:10]
 
 @app.get("/match-scheduled/", response_model=List[schemas.ScheduledMatch])
 def match_scheduled_rides(
     resort: str,
+    response: Response,
     target_date: Optional[str] = None,
     db: Session = Depends(get_db),
 ):
@@ -1455,172 +2708,209 @@ def match_scheduled_rides(
     Match scheduled trips and ride requests for a specific date.
     Optimizes for timing compatibility and closest hub.
     target_date: optional "YYYY-MM-DD" or ISO string (e.g. from JS toISOString()); defaults to tomorrow.
+    Served from the prematch snapshot when fresh; otherwise computed and stored as the new snapshot.
     Always returns JSON so clients never get parse errors.
     """
     try:
         target_date_parsed = _parse_target_date(target_date)
 
-        # Get scheduled trips (not real-time) for the target date
-        trips = db.query(Trip).filter(
-            Trip.resort == resort,
-            Trip.is_realtime == False,
-            Trip.available_seats > 0
-        ).all()
-        trips = [t for t in trips if _date_eq(t.trip_date, target_date_parsed)]
+        snap, generation = prematch.get_snapshot(db, resort, target_date_parsed)
+        if snap is not None:
+            response.headers["X-Match-Snapshot-Version"] = str(snap.version)
+            return snap.matches
 
-        # Get scheduled ride requests for the target date (exclude Ride Now)
-        now_expr = func.lower(func.trim(func.coalesce(RideRequest.departure_time, ""))) == "now"
-        requests = db.query(RideRequest).filter(
-            RideRequest.resort == resort,
-            RideRequest.status == "pending",
-            ~now_expr
-        ).all()
-        requests = [r for r in requests if _date_eq(r.request_date, target_date_parsed)]
-
-        if not trips or not requests:
-            return []
-
-        resort_coords = next((r for r in RESORTS_DATA if r["name"] == resort), None)
-        if not resort_coords:
-            return []
-
-        matches = []
-        for trip in trips:
-            for req in requests:
-                if req.matched_trip_id:
-                    continue
-                # Ensure str for time comparison (DB can have null)
-                t_dep = (trip.departure_time or "").strip() or "?"
-                r_dep = (req.departure_time or "").strip() or "?"
-                time_diff = time_difference_minutes(t_dep, r_dep)
-                if time_diff is None or time_diff > 60:
-                    continue
-
-                seats_needed = req.seats_needed if hasattr(req, 'seats_needed') and req.seats_needed else 1
-                if trip.available_seats < seats_needed:
-                    continue
-                if trip.start_lat is None or trip.start_lng is None or req.pickup_lat is None or req.pickup_lng is None:
-                    continue
-
-                valid_hub_ids = RESORT_HUB_MAP.get(resort, [])
-                best_hub = None
-                best_score = float('inf')
-                HUB_ROUTE_KM = 5.0
-
-                for hub_id in valid_hub_ids:
-                    if hub_id not in HUBS:
-                        continue
-                    hub = HUBS[hub_id]
-                    driver_xtd = get_cross_track_distance(
-                        trip.start_lat, trip.start_lng,
-                        resort_coords["lat"], resort_coords["lng"],
-                        hub["lat"], hub["lng"]
-                    )
-                    if driver_xtd > HUB_ROUTE_KM:
-                        continue
-                    dist_driver = haversine(trip.start_lat, trip.start_lng, hub["lat"], hub["lng"])
-                    dist_passenger = haversine(req.pickup_lat, req.pickup_lng, hub["lat"], hub["lng"])
-                    score = dist_driver + dist_passenger + (time_diff * 0.1)
-                    if score < best_score:
-                        best_score = score
-                        best_hub = {
-                            "id": hub_id,
-                            "name": hub["name"],
-                            "lat": hub["lat"],
-                            "lng": hub["lng"],
-                            "driver_distance": dist_driver,
-                            "passenger_distance": dist_passenger
-                        }
-
-                if not best_hub and trip.start_lat is not None and trip.start_lng is not None and req.pickup_lat is not None and req.pickup_lng is not None:
-                    dist_driver = 0.0
-                    dist_passenger = haversine(req.pickup_lat, req.pickup_lng, trip.start_lat, trip.start_lng)
-                    best_hub = {
-                        "id": "driver_start",
-                        "name": "Meet at driver's start",
-                        "lat": trip.start_lat,
-                        "lng": trip.start_lng,
-                        "driver_distance": dist_driver,
-                        "passenger_distance": dist_passenger
-                    }
-
-                if best_hub:
-                    matches.append(schemas.ScheduledMatch(
-                        trip_id=trip.id,
-                        request_id=req.id,
-                        driver_name=trip.driver_name or "",
-                        passenger_name=req.passenger_name or "",
-                        resort=resort,
-                        suggested_hub={
-                            "id": str(best_hub["id"]),
-                            "name": str(best_hub["name"]),
-                            "lat": _safe_float(best_hub["lat"]),
-                            "lng": _safe_float(best_hub["lng"]),
-                        },
-                        driver_departure_time=t_dep,
-                        passenger_departure_time=r_dep,
-                        hub_distance_driver=_safe_float(best_hub.get("driver_distance")),
-                        hub_distance_passenger=_safe_float(best_hub.get("passenger_distance")),
-                    ))
-
-        matches.sort(key=lambda x: x.hub_distance_driver + x.hub_distance_passenger)
-        return matches[:10]
+        matches = compute_scheduled_matches(db, resort, target_date_parsed)
+        version = prematch.store_snapshot(db, resort, target_date_parsed, [m.model_dump() for m in matches], generation)
+        if version is not None:
+            response.headers["X-Match-Snapshot-Version"] = str(version)
+        return matches
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"match-scheduled error: {str(e)}")
 
-@app.get("/match-scheduled/debug")
-def match_scheduled_debug(resort: str, target_date: Optional[str] = None, db: Session = Depends(get_db)):
-    """Debug why match-scheduled returns no matches. Use same resort & target_date as match-scheduled."""
-    target_date_parsed = _parse_target_date(target_date)
+@app.get("/match-scheduled/batch")
+def match_scheduled_batch(
+    resort: List[str] = Query(...),
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    db: Session = Depends(get_db),
+):
+    """
+    Scheduled matches for several resorts and a date range in one call.
+    Example: /match-scheduled/batch?resort=Alta&resort=Brighton&start_date=2026-01-15&end_date=2026-01-17
+
+    Loads trips and requests with one query per table, partitions them by (resort, date) in memory,
+    runs the matcher per partition on a thread pool, and streams NDJSON as partitions finish:
+    one line per partition: {"resort", "target_date", "matches": [ScheduledMatch, ...]}.
+    start_date defaults to tomorrow; end_date defaults to start_date (inclusive, max 14 days).
+    """
+    start = _parse_target_date(start_date)
+    end = _parse_target_date(end_date) if end_date else start
+    if end < start:
+        raise HTTPException(status_code=400, detail="end_date must be on or after start_date")
+    days = (end - start).days + 1
+    if days > MATCH_BATCH_MAX_DAYS:
+        raise HTTPException(status_code=400, detail=f"Date range too large (max {MATCH_BATCH_MAX_DAYS} days)")
+    resorts = list(dict.fromkeys(resort))
+    dates = [start + timedelta(days=i) for i in range(days)]
 
     trips = db.query(Trip).filter(
-        Trip.resort == resort,
+        Trip.resort.in_(resorts),
         Trip.is_realtime == False,
         Trip.available_seats > 0
     ).all()
-    trips = [t for t in trips if _date_eq(t.trip_date, target_date_parsed)]
-
     now_expr = func.lower(func.trim(func.coalesce(RideRequest.departure_time, ""))) == "now"
     requests = db.query(RideRequest).filter(
-        RideRequest.resort == resort,
+        RideRequest.resort.in_(resorts),
         RideRequest.status == "pending",
         ~now_expr
     ).all()
-    requests = [r for r in requests if _date_eq(r.request_date, target_date_parsed)]
 
-    def _t(t):
-        return {
-            "id": t.id,
-            "departure_time": t.departure_time,
-            "trip_date": str(t.trip_date),
-            "trip_date_normalized": str(_normalize_date(t.trip_date) or ""),
-            "start_lat": t.start_lat,
-            "start_lng": t.start_lng,
-        }
-    def _r(r):
-        return {
-            "id": r.id,
-            "departure_time": r.departure_time,
-            "request_date": str(r.request_date),
-            "request_date_normalized": str(_normalize_date(r.request_date) or ""),
-            "pickup_lat": r.pickup_lat,
-            "pickup_lng": r.pickup_lng,
-        }
-    
-    skip_time = skip_coords = skip_matched = would_match = 0
+    # Partition in memory; dates are normalized in Python because the column can hold mixed types
+    partitions = {(r, d): ([], []) for r in resorts for d in dates}
     for t in trips:
-        for r in requests:
-            if r.matched_trip_id:
-                skip_matched += 1
-                continue
-            td = time_difference_minutes(t.departure_time, r.departure_time)
-            if td is None or td > 60:
-                skip_time += 1
-                continue
-            if t.start_lat is None or t.start_lng is None or r.pickup_lat is None or r.pickup_lng is None:
-                skip_coords += 1
+        key = (t.resort, _normalize_date(t.trip_date))
+        if key in partitions:
+            partitions[key][0].append(t)
+    for r in requests:
+        key = (r.resort, _normalize_date(r.request_date))
+        if key in partitions:
+            partitions[key][1].append(r)
+
+    def _stream():
+        # Rows are fully loaded above, so workers never touch the session
+        with ThreadPoolExecutor(max_workers=max(1, min(MATCH_BATCH_WORKERS, len(partitions)))) as pool:
+            futures = {
+                pool.submit(_match_scheduled_partition, r, p_trips, p_requests): (r, d)
+                for (r, d), (p_trips, p_requests) in partitions.items()
+            }
+            for fut in as_completed(futures):
+                r, d = futures[fut]
+                line = {"resort": r, "target_date": str(d)}
+                try:
+                    line["matches"] = [m.model_dump() for m in fut.result()]
+                except Exception as e:
+                    logger.error(f"match-scheduled batch partition {r} {d} failed: {e}")
+                    line["matches"] = []
+                    line["error"] = str(e)
+                yield json.dumps(line) + "\n"
+
+    return StreamingResponse(_stream(), media_type=NDJSON_MEDIA_TYPE)
+
+def _debug_trip_row(t: Trip) -> dict:
+    return {
+        "id": t.id,
+        "departure_time": t.departure_time,
+        "trip_date": str(t.trip_date),
+        "trip_date_normalized": str(_normalize_date(t.trip_date) or ""),
+        "start_lat": t.start_lat,
+        "start_lng": t.start_lng,
+    }
+
+def _debug_request_row(r: RideRequest) -> dict:
+    return {
+        "id": r.id,
+        "departure_time": r.departure_time,
+        "request_date": str(r.request_date),
+        "request_date_normalized": str(_normalize_date(r.request_date) or ""),
+        "pickup_lat": r.pickup_lat,
+        "pickup_lng": r.pickup_lng,
+    }
+
+def _debug_scheduled_queries(db: Session, resort: str):
+    """Trip and request queries used by match-scheduled/debug (date filtering happens in Python)."""
+    trips_q = db.query(Trip).filter(
+        Trip.resort == resort,
+        Trip.is_realtime == False,
+        Trip.available_seats > 0
+    )
+    now_expr = func.lower(func.trim(func.coalesce(RideRequest.departure_time, ""))) == "now"
+    requests_q = db.query(RideRequest).filter(
+        RideRequest.resort == resort,
+        RideRequest.status == "pending",
+        ~now_expr
+    )
+    return trips_q, requests_q
+
+def _debug_pair_counts(t: Trip, requests: List[RideRequest]) -> dict:
+    """Why each (trip, request) pair would or would not match, tallied for one trip."""
+    counts = {"skip_time": 0, "skip_coords": 0, "skip_matched": 0, "would_match": 0}
+    for r in requests:
+        if r.matched_trip_id:
+            counts["skip_matched"] += 1
+            continue
+        td = time_difference_minutes(t.departure_time, r.departure_time)
+        if td is None or td > 60:
+            counts["skip_time"] += 1
+            continue
+        if t.start_lat is None or t.start_lng is None or r.pickup_lat is None or r.pickup_lng is None:
+            counts["skip_coords"] += 1
+            continue
+        counts["would_match"] += 1
+    return counts
+
+def _debug_scheduled_stream(resort: str, target_date_parsed: date):
+    """NDJSON form of match-scheduled/debug: one line per request, one per trip (with its pair
+    counts), then a summary line. Trips stream from a server-side cursor; requests are held
+    in memory because every trip is checked against all of them."""
+    db = SessionLocal()
+    try:
+        trips_q, requests_q = _debug_scheduled_queries(db, resort)
+        requests = []
+        for r in requests_q.yield_per(STREAM_YIELD_PER):
+            if _date_eq(r.request_date, target_date_parsed):
+                requests.append(r)
+                yield json.dumps({"type": "request", **_debug_request_row(r)}) + "\n"
+
+        totals = {"skip_time": 0, "skip_coords": 0, "skip_matched": 0, "would_match": 0}
+        trips_count = 0
+        for t in trips_q.yield_per(STREAM_YIELD_PER):
+            if not _date_eq(t.trip_date, target_date_parsed):
                 continue
-            would_match += 1
+            trips_count += 1
+            counts = _debug_pair_counts(t, requests)
+            for k, v in counts.items():
+                totals[k] += v
+            yield json.dumps({"type": "trip", **_debug_trip_row(t), **counts}) + "\n"
+
+        yield json.dumps({
+            "type": "summary",
+            "target_date": str(target_date_parsed),
+            "resort": resort,
+            "trips_count": trips_count,
+            "requests_count": len(requests),
+            "pairs_with_time_ok": totals["would_match"] + totals["skip_coords"],
+            "pairs_would_match": totals["would_match"],
+            "skip_time": totals["skip_time"],
+            "skip_coords": totals["skip_coords"],
+            "skip_matched": totals["skip_matched"],
+        }) + "\n"
+    finally:
+        db.close()
+
+@app.get("/match-scheduled/debug")
+def match_scheduled_debug(
+    resort: str,
+    target_date: Optional[str] = None,
+    accept: Optional[str] = Header(None),
+    db: Session = Depends(get_db),
+):
+    """Debug why match-scheduled returns no matches. Use same resort & target_date as match-scheduled.
+    Send Accept: application/x-ndjson to stream every trip and request instead of 5-row samples."""
+    target_date_parsed = _parse_target_date(target_date)
+    if _wants_ndjson(accept):
+        return StreamingResponse(_debug_scheduled_stream(resort, target_date_parsed), media_type=NDJSON_MEDIA_TYPE)
+
+    trips_q, requests_q = _debug_scheduled_queries(db, resort)
+    trips = [t for t in trips_q.all() if _date_eq(t.trip_date, target_date_parsed)]
+    requests = [r for r in requests_q.all() if _date_eq(r.request_date, target_date_parsed)]
+
+    skip_time = skip_coords = skip_matched = would_match = 0
+    for t in trips:
+        counts = _debug_pair_counts(t, requests)
+        skip_time += counts["skip_time"]
+        skip_coords += counts["skip_coords"]
+        skip_matched += counts["skip_matched"]
+        would_match += counts["would_match"]
     
     return {
         "target_date": str(target_date_parsed),
@@ -1632,8 +2922,8 @@ def match_scheduled_debug(resort: str, target_date: Optional[str] = None, db: Se
         "skip_time": skip_time,
         "skip_coords": skip_coords,
         "skip_matched": skip_matched,
-        "trips_sample": [_t(t) for t in trips[:5]],
-        "requests_sample": [_r(r) for r in requests[:5]],
+        "trips_sample": [_debug_trip_row(t) for t in trips[:5]],
+        "requests_sample": [_debug_request_row(r) for r in requests[:5]],
     }
 
 @app.post("/match-scheduled/confirm")
@@ -1650,16 +2940,16 @@ def confirm_scheduled_match(
         request_id: The passenger's ride request ID
         hub_id: The selected hub ID (or "driver_start")
     """
-    trip = db.query(Trip).filter(Trip.id == trip_id).first()
+    trip, request = _trip_and_request(db, trip_id, request_id)
     if not trip:
         raise HTTPException(status_code=404, detail="Trip not found")
     
-    request = db.query(RideRequest).filter(RideRequest.id == request_id).first()
     if not request:
         raise HTTPException(status_code=404, detail="Ride request not found")
     
     # Validate hub exists (or is driver_start)
-    if hub_id != "driver_start" and hub_id not in HUBS:
+    registry = hubs.get_registry()
+    if hub_id != "driver_start" and hub_id not in registry.hubs:
         raise HTTPException(status_code=400, detail="Invalid hub ID")
     
     # Check if trip has available seats
@@ -1677,10 +2967,16 @@ def confirm_scheduled_match(
     request.status = "matched"
     trip.available_seats -= seats_needed
     trip.status = "matched"
+    _invalidate_trip_snapshot(db, trip)
+    _invalidate_request_snapshot(db, request)
+    _outbox_match(db, trip, request, notify_driver=True, notify_passenger=True)
     
     db.commit()
     db.refresh(trip)
     db.refresh(request)
+    outbox.wake()
+    _match_changed(trip_id, request_id)
+    _publish_status(trip_id, request_id, "matched")
     
     # Get hub details for response
     if hub_id == "driver_start" and trip.start_lat and trip.start_lng:
@@ -1692,7 +2988,7 @@ def confirm_scheduled_match(
             "address": trip.start_location_text or "Driver's starting location"
         }
     else:
-        hub_data = HUBS.get(hub_id)
+        hub_data = registry.hubs.get(hub_id)
         hub = {
             "id": hub_id,
             "name": hub_data["name"],
@@ -1769,6 +3065,7 @@ def create_ride_request(req: schemas.RideRequestCreate, db: Session = Depends(ge
         status="pending"
     )
     db.add(new_req)
+    _invalidate_request_snapshot(db, new_req)
     db.commit()
     db.refresh(new_req)
     elapsed = time.perf_counter() - t0
@@ -1776,21 +3073,41 @@ def create_ride_request(req: schemas.RideRequestCreate, db: Session = Depends(ge
     return new_req
 
 @app.get("/ride-requests/{request_id}", response_model=schemas.RideRequest)
-def get_ride_request(request_id: int, db: Session = Depends(get_db)):
-    """Get a ride request by ID"""
-    request = db.query(RideRequest).filter(RideRequest.id == request_id).first()
+def get_ride_request(request_id: int, response: Response, if_none_match: Optional[str] = Header(None), db: Session = Depends(get_db)):
+    """Get a ride request by ID (send the ETag back in If-None-Match to get a 304 while unchanged)"""
+    request = _cached_request(db, request_id)
     if not request:
         raise HTTPException(status_code=404, detail="Ride request not found")
+    etag = _etag("request", _row_version(request))
+    if _etag_matches(if_none_match, etag):
+        return _not_modified(etag)
+    response.headers["ETag"] = etag
     return request
 
+def _matched_driver_position(db: Session, request: RideRequest) -> Tuple[Optional[float], Optional[float]]:
+    """Matched driver's latest position (buffered fix first, then the row), or (None, None)."""
+    if not request.matched_trip_id:
+        return None, None
+    buffered = location_buffer.trip_locations.get(request.matched_trip_id)
+    if buffered:
+        return buffered[0], buffered[1]
+    row = db.query(Trip.current_lat, Trip.current_lng, Trip.start_lat, Trip.start_lng).filter(
+        Trip.id == request.matched_trip_id
+    ).first()
+    if not row:
+        return None, None
+    return (row.current_lat or row.start_lat), (row.current_lng or row.start_lng)
+
 @app.put("/ride-requests/{request_id}/location", response_model=schemas.RideRequest)
-def update_ride_request_location(request_id: int, location: schemas.LocationUpdate, db: Session = Depends(get_db)):
+def update_ride_request_location(request_id: int, location: schemas.LocationUpdate, response: Response, db: Session = Depends(get_db)):
     """Update passenger's current location. Only for scheduled requests on the day-of (en route).
     
     Ride Now: passengers are already at pickup when they open the app; we do not track their location.
     This ensures drivers never wait for passengers.
+    Same ingest policy and X-Location-Ingest / X-Next-Report-Seconds headers as PUT /trips/{id}/location,
+    with distance measured to the matched driver.
     """
-    db_request = db.query(RideRequest).filter(RideRequest.id == request_id).first()
+    db_request = _live_request(db.query(RideRequest).filter(RideRequest.id == request_id).first())
     if not db_request:
         raise HTTPException(status_code=404, detail="Ride request not found")
     today = date.today()
@@ -1809,11 +3126,32 @@ def update_ride_request_location(request_id: int, location: schemas.LocationUpda
             status_code=400,
             detail="Location updates only for scheduled requests on the day of the ride (en route)."
         )
+    now = datetime.utcnow()
+    target_km = _km_to(location.current_lat, location.current_lng, _matched_driver_position(db, db_request))
+    response.headers["X-Next-Report-Seconds"] = str(location_policy.next_report_seconds(target_km))
+    moved_m, age_s = _since_last_fix(
+        db_request.current_lat, db_request.current_lng, db_request.last_location_update,
+        location.current_lat, location.current_lng, now,
+    )
+    if not location_policy.evaluate(moved_m, age_s, target_km):
+        response.headers["X-Location-Ingest"] = "dropped"
+        return db_request
+    response.headers["X-Location-Ingest"] = "accepted"
+
+    match_context.cache.note_passenger_position(request_id, location.current_lat, location.current_lng)
+    # Write-behind: buffer the fix (flushed in batches); write through if disabled or the buffer is full.
+    # Publish once the position is readable: woken long-polls reload it
+    if location_buffer.LOCATION_WRITE_BEHIND and location_buffer.request_locations.put(
+        request_id, location.current_lat, location.current_lng, now
+    ):
+        _publish_location(pubsub.request_topic(request_id), location.current_lat, location.current_lng, now)
+        return _live_request(db_request)
     db_request.current_lat = location.current_lat
     db_request.current_lng = location.current_lng
-    db_request.last_location_update = datetime.utcnow()
+    db_request.last_location_update = now
     db.commit()
     db.refresh(db_request)
+    _publish_location(pubsub.request_topic(request_id), location.current_lat, location.current_lng, now)
     return db_request
 
 @app.patch("/ride-requests/{request_id}", response_model=schemas.RideRequest)
@@ -1839,7 +3177,13 @@ def update_ride_request(request_id: int, updates: schemas.RideRequestUpdate, db:
         trip = db.query(Trip).filter(Trip.id == db_request.matched_trip_id).first()
         if trip and trip.available_seats > 0:
             trip.available_seats -= 1
+            _invalidate_trip_snapshot(db, trip)
+    _invalidate_request_snapshot(db, db_request)
     
     db.commit()
     db.refresh(db_request)
+    if "matched_trip_id" in update_data or "status" in update_data:
+        _match_changed(prev_matched, request_id)
+        _match_changed(db_request.matched_trip_id)
+        _publish_status(db_request.matched_trip_id or prev_matched, request_id, db_request.status)
     return db_request
\ No newline at end of file
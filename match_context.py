@@ -0,0 +1,147 @@
+"""
+Matched-pair context cache for the driver location hot path
+
+Every driver ping checks "does this fix move the driver farther from the matched
+passenger's pickup?", which needs the trip's matched request and its navigation
+target. The match only changes on lifecycle writes (accept, confirm, pickup,
+complete, delete), so the context is cached per trip and those endpoints
+invalidate it; a location write then needs no extra query.
+
+Per-trip entries:
+    - MatchContext(request_id, mode, pickup, nav) for a matched trip, where mode is
+      "pickup" (Ride Now: navigate to the fixed pickup point) or "tracked" (scheduled:
+      navigate to the passenger's latest position, falling back to pickup)
+    - NO_MATCH for a trip without a matched passenger (cached too: that's most pings
+      before a match)
+
+Passenger position updates refresh the nav target of "tracked" entries in place.
+Entries also expire after MATCH_CONTEXT_TTL_SECONDS, which bounds staleness when a
+lifecycle write lands on another instance.
+
+Environment Variables:
+    MATCH_CONTEXT_TTL_SECONDS: Max age of a cached context (default 30)
+    MATCH_CONTEXT_MAX: Max trips cached, least recently used evicted first (default 10000)
+"""
+
+import os
+import time
+import threading
+import logging
+from collections import OrderedDict
+from typing import Callable, Dict, NamedTuple, Optional, Tuple
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+MATCH_CONTEXT_TTL_SECONDS = float(os.getenv("MATCH_CONTEXT_TTL_SECONDS", "30"))
+MATCH_CONTEXT_MAX = int(os.getenv("MATCH_CONTEXT_MAX", "10000"))
+
+
+class MatchContext(NamedTuple):
+    request_id: int
+    mode: str                                   # "pickup" | "tracked"
+    pickup: Tuple[Optional[float], Optional[float]]
+    nav: Tuple[Optional[float], Optional[float]]  # Where the driver is heading
+
+
+NO_MATCH = "no_match"
+
+
+class MatchContextCache:
+    """trip_id -> MatchContext | NO_MATCH, with TTL and LRU bound."""
+
+    def __init__(self, ttl: float = MATCH_CONTEXT_TTL_SECONDS, max_entries: int = MATCH_CONTEXT_MAX):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[int, Tuple[float, object]]" = OrderedDict()
+        self._by_request: Dict[int, int] = {}
+        self._generation = 0  # Bumped by invalidate() so a load racing with it isn't cached
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "invalidations": 0, "evictions": 0}
+
+    def get(self, trip_id: int, load: Callable[[int], object]) -> Optional[MatchContext]:
+        """Cached context for a trip, calling load(trip_id) on miss/expiry. None means no match."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(trip_id)
+            if entry is not None and now - entry[0] < self.ttl:
+                self._entries.move_to_end(trip_id)
+                self.counters["hits"] += 1
+                value = entry[1]
+                return None if value is NO_MATCH else value
+            self.counters["misses"] += 1
+            generation = self._generation
+        value = load(trip_id)
+        if value is None:
+            value = NO_MATCH
+        with self._lock:
+            if generation == self._generation:
+                self._store(trip_id, value, now)
+        return None if value is NO_MATCH else value
+
+    def peek(self, trip_id: int) -> Tuple[bool, Optional[MatchContext]]:
+        """(cached?, context) without loading; context None means no match."""
+        with self._lock:
+            entry = self._entries.get(trip_id)
+            if entry is None or time.monotonic() - entry[0] >= self.ttl:
+                self.counters["misses"] += 1
+                return False, None
+            self._entries.move_to_end(trip_id)
+            self.counters["hits"] += 1
+            return True, (None if entry[1] is NO_MATCH else entry[1])
+
+    def _store(self, trip_id: int, value, now: float) -> None:
+        old = self._entries.pop(trip_id, None)
+        if old is not None and isinstance(old[1], MatchContext):
+            self._by_request.pop(old[1].request_id, None)
+        self._entries[trip_id] = (now, value)
+        if isinstance(value, MatchContext):
+            self._by_request[value.request_id] = trip_id
+        while len(self._entries) > self.max_entries:
+            evicted_id, (_, evicted) = self._entries.popitem(last=False)
+            if isinstance(evicted, MatchContext):
+                self._by_request.pop(evicted.request_id, None)
+            self.counters["evictions"] += 1
+
+    def invalidate(self, trip_id: Optional[int] = None, request_id: Optional[int] = None) -> None:
+        """Drop the context of a trip and/or of whichever trip a request is matched to."""
+        with self._lock:
+            self._generation += 1
+            trip_ids = {trip_id} if trip_id is not None else set()
+            if request_id is not None and request_id in self._by_request:
+                trip_ids.add(self._by_request[request_id])
+            for tid in trip_ids:
+                old = self._entries.pop(tid, None)
+                if old is not None:
+                    self.counters["invalidations"] += 1
+                    if isinstance(old[1], MatchContext):
+                        self._by_request.pop(old[1].request_id, None)
+
+    def clear(self) -> None:
+        """Drop every context (e.g. pub/sub messages from other instances were lost)."""
+        with self._lock:
+            self._generation += 1
+            self.counters["invalidations"] += len(self._entries)
+            self._entries.clear()
+            self._by_request.clear()
+
+    def note_passenger_position(self, request_id: int, lat: float, lng: float) -> None:
+        """A matched passenger moved: update the nav target of a "tracked" context in place."""
+        with self._lock:
+            trip_id = self._by_request.get(request_id)
+            entry = self._entries.get(trip_id) if trip_id is not None else None
+            if entry is None or not isinstance(entry[1], MatchContext) or entry[1].mode != "tracked":
+                return
+            self._entries[trip_id] = (entry[0], entry[1]._replace(nav=(lat, lng)))
+
+    def stats(self) -> dict:
+        lookups = self.counters["hits"] + self.counters["misses"]
+        return {
+            "entries": len(self._entries),
+            **self.counters,
+            "hit_ratio": round(self.counters["hits"] / lookups, 4) if lookups else None,
+        }
+
+
+cache = MatchContextCache()
@@ -16,7 +16,10 @@ Usage:
 
 from sqlalchemy import text, inspect
 from database import engine, get_connection_string, IS_CLOUD_RUN
+from datetime import datetime
 import sys
+import zlib
+import struct
 import argparse
 import logging
 
@@ -35,6 +38,30 @@ def column_exists(connection, table_name, column_name):
     """), {"table_name": table_name, "column_name": column_name})
     return result.scalar() > 0
 
+# trip_location_chunks layout, encoding 1 (kept in step with location_history.py, which the
+# migration image doesn't ship: it needs NumPy)
+LOCATION_CHUNK_POINTS = 512
+LOCATION_COORD_SCALE = 10_000_000
+_EPOCH = datetime(1970, 1, 1)
+
+def encode_location_chunk(fixes):
+    """Encode time-ordered (lat, lng, recorded_at) fixes as trip_location_chunks values (encoding 1)"""
+    lat_q = [round(f[0] * LOCATION_COORD_SCALE) for f in fixes]
+    lng_q = [round(f[1] * LOCATION_COORD_SCALE) for f in fixes]
+    t_ms = [int((f[2] - _EPOCH).total_seconds() * 1000) for f in fixes]
+    deltas = []
+    for values in (lat_q, lng_q, t_ms):
+        deltas += [0] + [b - a for a, b in zip(values, values[1:])]
+    return {
+        "start_time": fixes[0][2],
+        "end_time": fixes[-1][2],
+        "n_points": len(fixes),
+        "base_lat": lat_q[0],
+        "base_lng": lng_q[0],
+        "encoding": 1,
+        "data": zlib.compress(struct.pack(f"<{len(deltas)}i", *deltas)),
+    }
+
 def run_migration():
     """Execute database migration"""
     import time
@@ -275,6 +302,172 @@ def run_migration():
                 else:
                     print("  ✓ 'last_location_update' already exists")
                 
+                # ===== SCHEDULED MATCH SNAPSHOTS (prematch.py) =====
+                print("\n🔄 Migrating 'scheduled_match_snapshots' table...")
+                connection.execute(text("""
+                    CREATE TABLE IF NOT EXISTS scheduled_match_snapshots (
+                        id SERIAL PRIMARY KEY,
+                        resort VARCHAR NOT NULL,
+                        target_date DATE NOT NULL,
+                        version BIGINT NOT NULL,
+                        matches JSON NOT NULL,
+                        computed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        generation INTEGER NOT NULL DEFAULT 0,
+                        CONSTRAINT uq_scheduled_match_snapshot UNIQUE (resort, target_date)
+                    )
+                """))
+                if not column_exists(connection, 'scheduled_match_snapshots', 'generation'):
+                    print("  ➕ Adding 'generation' column...")
+                    connection.execute(text("ALTER TABLE scheduled_match_snapshots ADD COLUMN generation INTEGER NOT NULL DEFAULT 0"))
+                print("  ✓ 'scheduled_match_snapshots' ready")
+                
+                # ===== TRIP LOCATION HISTORY (location_history.py) =====
+                print("\n🔄 Migrating 'trip_location_chunks' table...")
+                connection.execute(text("""
+                    CREATE TABLE IF NOT EXISTS trip_location_chunks (
+                        id SERIAL PRIMARY KEY,
+                        trip_id INTEGER NOT NULL REFERENCES trips(id) ON DELETE CASCADE,
+                        start_time TIMESTAMP NOT NULL,
+                        end_time TIMESTAMP NOT NULL,
+                        n_points INTEGER NOT NULL,
+                        base_lat INTEGER NOT NULL,
+                        base_lng INTEGER NOT NULL,
+                        encoding INTEGER NOT NULL DEFAULT 1,
+                        data BYTEA NOT NULL,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                """))
+                connection.execute(text(
+                    "CREATE INDEX IF NOT EXISTS ix_trip_location_chunks_trip_id ON trip_location_chunks (trip_id, start_time)"
+                ))
+                print("  ✓ 'trip_location_chunks' ready")
+                
+                # Earlier builds stored one row per fix in trip_location_history: re-encode and drop it
+                legacy = connection.execute(text("SELECT to_regclass('trip_location_history')")).scalar()
+                if legacy:
+                    rows = connection.execute(text(
+                        "SELECT trip_id, lat, lng, recorded_at FROM trip_location_history ORDER BY trip_id, recorded_at"
+                    )).fetchall()
+                    by_trip = {}
+                    for r in rows:
+                        by_trip.setdefault(r.trip_id, []).append((r.lat, r.lng, r.recorded_at))
+                    for trip_id, fixes in by_trip.items():
+                        for start in range(0, len(fixes), LOCATION_CHUNK_POINTS):
+                            chunk = encode_location_chunk(fixes[start:start + LOCATION_CHUNK_POINTS])
+                            connection.execute(text("""
+                                INSERT INTO trip_location_chunks
+                                    (trip_id, start_time, end_time, n_points, base_lat, base_lng, encoding, data)
+                                VALUES (:trip_id, :start_time, :end_time, :n_points, :base_lat, :base_lng, :encoding, :data)
+                            """), {"trip_id": trip_id, **chunk})
+                    connection.execute(text("DROP TABLE trip_location_history"))
+                    print(f"  ➕ Re-encoded {len(rows)} fixes from 'trip_location_history' and dropped it")
+                
+                # ===== MAP VIEWPORT INDEXES (GET /trips/active, /ride-requests/active with bbox) =====
+                print("\n🔄 Creating map viewport indexes...")
+                connection.execute(text(
+                    "CREATE INDEX IF NOT EXISTS ix_trips_active_position ON trips "
+                    "((COALESCE(current_lat, start_lat)), (COALESCE(current_lng, start_lng))) WHERE available_seats > 0"
+                ))
+                connection.execute(text(
+                    "CREATE INDEX IF NOT EXISTS ix_ride_requests_pending_position ON ride_requests "
+                    "((COALESCE(current_lat, pickup_lat)), (COALESCE(current_lng, pickup_lng))) WHERE status = 'pending'"
+                ))
+                print("  ✓ Map viewport indexes ready")
+                
+                # ===== CHANGE FEED (change_feed.py) =====
+                print("\n🔄 Migrating change feed (change_seq + tombstones)...")
+                for table in ('trips', 'ride_requests'):
+                    if not column_exists(connection, table, 'change_seq'):
+                        print(f"  ➕ Adding '{table}.change_seq' column...")
+                        connection.execute(text(f"ALTER TABLE {table} ADD COLUMN change_seq BIGINT"))
+                        connection.execute(text(f"UPDATE {table} SET change_seq = txid_current()"))
+                    else:
+                        print(f"  ✓ '{table}.change_seq' already exists")
+                    connection.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{table}_change_seq ON {table} (change_seq)"))
+                connection.execute(text("""
+                    CREATE TABLE IF NOT EXISTS row_tombstones (
+                        id SERIAL PRIMARY KEY,
+                        kind VARCHAR NOT NULL,
+                        row_id INTEGER NOT NULL,
+                        change_seq BIGINT NOT NULL,
+                        deleted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                """))
+                connection.execute(text(
+                    "CREATE INDEX IF NOT EXISTS ix_row_tombstones_change_seq ON row_tombstones (change_seq)"
+                ))
+                # Every write stamps the row with its transaction id; deletes leave a tombstone
+                connection.execute(text("""
+                    CREATE OR REPLACE FUNCTION skipool_stamp_change_seq() RETURNS trigger AS $$
+                    BEGIN
+                        NEW.change_seq := txid_current();
+                        RETURN NEW;
+                    END
+                    $$ LANGUAGE plpgsql
+                """))
+                connection.execute(text("""
+                    CREATE OR REPLACE FUNCTION skipool_record_tombstone() RETURNS trigger AS $$
+                    BEGIN
+                        INSERT INTO row_tombstones (kind, row_id, change_seq, deleted_at)
+                        VALUES (TG_ARGV[0], OLD.id, txid_current(), timezone('utc', now()));
+                        RETURN OLD;
+                    END
+                    $$ LANGUAGE plpgsql
+                """))
+                for table, kind in (('trips', 'trip'), ('ride_requests', 'request')):
+                    connection.execute(text(f"DROP TRIGGER IF EXISTS trg_{table}_change_seq ON {table}"))
+                    connection.execute(text(
+                        f"CREATE TRIGGER trg_{table}_change_seq BEFORE INSERT OR UPDATE ON {table} "
+                        f"FOR EACH ROW EXECUTE FUNCTION skipool_stamp_change_seq()"
+                    ))
+                    connection.execute(text(f"DROP TRIGGER IF EXISTS trg_{table}_tombstone ON {table}"))
+                    connection.execute(text(
+                        f"CREATE TRIGGER trg_{table}_tombstone AFTER DELETE ON {table} "
+                        f"FOR EACH ROW EXECUTE FUNCTION skipool_record_tombstone('{kind}')"
+                    ))
+                print("  ✓ Change feed triggers and 'row_tombstones' ready")
+                
+                # ===== NOTIFICATION OUTBOX (outbox.py) =====
+                print("\n🔄 Migrating 'outbox' table...")
+                connection.execute(text("""
+                    CREATE TABLE IF NOT EXISTS outbox (
+                        id SERIAL PRIMARY KEY,
+                        idempotency_key VARCHAR NOT NULL UNIQUE,
+                        push_token VARCHAR NOT NULL,
+                        message JSON NOT NULL,
+                        status VARCHAR NOT NULL DEFAULT 'pending',
+                        attempts INTEGER NOT NULL DEFAULT 0,
+                        next_attempt_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                        last_error VARCHAR,
+                        ticket_id VARCHAR,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        sent_at TIMESTAMP
+                    )
+                """))
+                # The worker only ever scans due, pending rows
+                connection.execute(text(
+                    "CREATE INDEX IF NOT EXISTS ix_outbox_due ON outbox (next_attempt_at) WHERE status = 'pending'"
+                ))
+                print("  ✓ 'outbox' ready")
+                
+                # ===== PUSH RECEIPTS (receipts.py) =====
+                print("\n🔄 Migrating push receipt tracking...")
+                if not column_exists(connection, 'outbox', 'receipt_due_at'):
+                    print("  ➕ Adding 'outbox.receipt_due_at' column...")
+                    connection.execute(text("ALTER TABLE outbox ADD COLUMN receipt_due_at TIMESTAMP"))
+                connection.execute(text(
+                    "CREATE INDEX IF NOT EXISTS ix_outbox_receipts_due ON outbox (receipt_due_at) WHERE receipt_due_at IS NOT NULL"
+                ))
+                connection.execute(text("""
+                    CREATE TABLE IF NOT EXISTS push_token_failures (
+                        push_token VARCHAR PRIMARY KEY,
+                        failures INTEGER NOT NULL DEFAULT 0,
+                        last_error VARCHAR,
+                        last_failure_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                """))
+                print("  ✓ 'outbox.receipt_due_at' and 'push_token_failures' ready")
+                
                 # Add foreign key constraint if matched_trip_id exists but constraint doesn't
                 print("\n🔗 Checking foreign key constraints...")
                 try:
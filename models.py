@@ -1,4 +1,5 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, Boolean, JSON, ForeignKey, Date
+from sqlalchemy import Column, Integer, BigInteger, String, Float, DateTime, Boolean, JSON, ForeignKey, Date, UniqueConstraint, LargeBinary, FetchedValue
+from sqlalchemy.orm import relationship
 from database import Base
 import datetime
 
@@ -40,6 +41,11 @@ class Trip(Base):
     # Timestamps
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
     updated_at = Column(DateTime, onupdate=datetime.datetime.utcnow)
+    # Set by a DB trigger on every insert/update (see change_feed.py)
+    change_seq = Column(BigInteger, server_default=FetchedValue(), server_onupdate=FetchedValue(), index=True)
+
+    # Requests linked to this trip (any status); delete_trip unlinks them itself
+    ride_requests = relationship("RideRequest", back_populates="matched_trip", passive_deletes=True)
 
 class RideRequest(Base):
     __tablename__ = "ride_requests"
@@ -69,6 +75,7 @@ class RideRequest(Base):
     
     # Matching relationships
     matched_trip_id = Column(Integer, ForeignKey('trips.id'), nullable=True)
+    matched_trip = relationship("Trip", back_populates="ride_requests")
     suggested_hub_id = Column(String, nullable=True)  # Store suggested hub ID
     
     # Push notifications
@@ -76,4 +83,73 @@ class RideRequest(Base):
     
     # Timestamps
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
-    updated_at = Column(DateTime, onupdate=datetime.datetime.utcnow)
\ No newline at end of file
+    updated_at = Column(DateTime, onupdate=datetime.datetime.utcnow)
+    # Set by a DB trigger on every insert/update (see change_feed.py)
+    change_seq = Column(BigInteger, server_default=FetchedValue(), server_onupdate=FetchedValue(), index=True)
+
+class ScheduledMatchSnapshot(Base):
+    """Precomputed /match-scheduled/ result for one resort and date (see prematch.py)."""
+    __tablename__ = "scheduled_match_snapshots"
+    __table_args__ = (UniqueConstraint("resort", "target_date", name="uq_scheduled_match_snapshot"),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    resort = Column(String, nullable=False)
+    target_date = Column(Date, nullable=False)
+
+    # Version stamp (epoch milliseconds when computed); echoed in X-Match-Snapshot-Version
+    version = Column(BigInteger, nullable=False)
+    matches = Column(JSON, nullable=False)  # List of schemas.ScheduledMatch dicts
+    computed_at = Column(DateTime, default=datetime.datetime.utcnow)  # NULL once invalidated
+    # Bumped by every invalidation; a store only lands if it's unchanged since the compute began
+    generation = Column(Integer, nullable=False, default=0, server_default="0")
+
+class TripLocationChunk(Base):
+    """A run of driver fixes for a trip, delta-encoded and compressed (see location_history.py)."""
+    __tablename__ = "trip_location_chunks"
+
+    id = Column(Integer, primary_key=True, index=True)
+    trip_id = Column(Integer, ForeignKey('trips.id', ondelete="CASCADE"), nullable=False, index=True)
+    start_time = Column(DateTime, nullable=False)  # First fix (UTC)
+    end_time = Column(DateTime, nullable=False)    # Last fix (UTC)
+    n_points = Column(Integer, nullable=False)
+    base_lat = Column(Integer, nullable=False)     # First fix, 1e-7 degrees
+    base_lng = Column(Integer, nullable=False)
+    encoding = Column(Integer, nullable=False, default=1)
+    data = Column(LargeBinary, nullable=False)     # zlib(int32 deltas: lat[n], lng[n], ms[n])
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+class RowTombstone(Base):
+    """A deleted trip / ride request, written by a DB trigger for the change feed (see change_feed.py)."""
+    __tablename__ = "row_tombstones"
+
+    id = Column(Integer, primary_key=True, index=True)
+    kind = Column(String, nullable=False)           # "trip" | "request"
+    row_id = Column(Integer, nullable=False)
+    change_seq = Column(BigInteger, nullable=False, index=True)
+    deleted_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+class OutboxMessage(Base):
+    """A push notification written in the same transaction as the state change behind it (see outbox.py)."""
+    __tablename__ = "outbox"
+
+    id = Column(Integer, primary_key=True, index=True)
+    idempotency_key = Column(String, nullable=False, unique=True)  # e.g. "en_route:12:34"; enqueueing twice is a no-op
+    push_token = Column(String, nullable=False)
+    message = Column(JSON, nullable=False)          # Expo push message
+    status = Column(String, nullable=False, default="pending")  # pending | sent | failed
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+    last_error = Column(String, nullable=True)
+    ticket_id = Column(String, nullable=True)       # Expo push ticket, once accepted
+    receipt_due_at = Column(DateTime, nullable=True)  # When to fetch the ticket's receipt; NULL once checked (receipts.py)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    sent_at = Column(DateTime, nullable=True)
+
+class PushTokenFailure(Base):
+    """Consecutive delivery failures of one push token, from tickets and receipts (see receipts.py)."""
+    __tablename__ = "push_token_failures"
+
+    push_token = Column(String, primary_key=True)
+    failures = Column(Integer, nullable=False, default=0)
+    last_error = Column(String, nullable=True)      # e.g. "DeviceNotRegistered"
+    last_failure_at = Column(DateTime, default=datetime.datetime.utcnow)
@@ -0,0 +1,257 @@
+"""
+Durable notification outbox
+
+Pushes used to be sent from the request handler after commit: a failure was only logged and
+a crash between commit and send lost the notification. Now the handler writes the message to
+the `outbox` table inside the same transaction as the state change (en-route, match, pickup),
+so the notification exists exactly when the change does, and a background worker delivers it.
+
+Worker (one per instance; instances coordinate through the table):
+    - Claims up to OUTBOX_BATCH due rows with FOR UPDATE SKIP LOCKED and leases them for
+      OUTBOX_LEASE_SECONDS (pushes moved past next_attempt_at), so two instances never send
+      the same row at once and rows claimed by a crashed instance come back after the lease
+    - Sends them through push.dispatcher.send_all (Expo chunks of 100, bounded concurrency)
+    - Marks accepted rows sent (keeping Expo's ticket id, with receipt_due_at set for
+      receipts.py); retries the rest with exponential backoff and jitter, up to
+      OUTBOX_MAX_ATTEMPTS. DeviceNotRegistered / MessageTooBig / KnownBadToken fail
+      immediately, retrying can't help. Ticket errors go to on_ticket_errors (main.py
+      wires it to receipts.record_failures) in the same transaction
+    - Handlers call wake() after commit so new rows go out without waiting for the next poll
+
+Idempotency: every row has a unique key derived from the event (e.g. "en_route:<trip>:<request>";
+match and pickup keys carry the request's change_seq, so a re-match of the same pair is a new
+event), so repeating a request or a retried transaction enqueues nothing twice. Delivery is at least
+once (a crash after Expo accepted a batch but before it was marked sent resends it); the key
+travels as data.notification_id so the app can drop a duplicate.
+
+Environment Variables:
+    OUTBOX_POLL_SECONDS: How often the worker looks for due rows when idle (default 1)
+    OUTBOX_BATCH: Rows claimed per cycle (default 500)
+    OUTBOX_LEASE_SECONDS: How long a claimed row stays invisible to other workers (default 60)
+    OUTBOX_MAX_ATTEMPTS: Attempts before a row is marked failed (default 8)
+    OUTBOX_BACKOFF_BASE_SECONDS: First retry delay, doubled per attempt (default 2)
+    OUTBOX_BACKOFF_MAX_SECONDS: Retry delay cap (default 600)
+    OUTBOX_RETENTION_HOURS: How long sent / failed rows are kept (default 72)
+    RECEIPTS_DELAY_SECONDS: Wait after a send before its receipt is fetched (default 900; Expo
+        suggests ~15 minutes)
+"""
+
+import os
+import time
+import random
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Callable, List, Optional, Tuple
+
+from sqlalchemy import text, update, func
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+import push
+from models import OutboxMessage
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+OUTBOX_POLL_SECONDS = float(os.getenv("OUTBOX_POLL_SECONDS", "1"))
+OUTBOX_BATCH = int(os.getenv("OUTBOX_BATCH", "500"))
+OUTBOX_LEASE_SECONDS = float(os.getenv("OUTBOX_LEASE_SECONDS", "60"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_BACKOFF_BASE_SECONDS = float(os.getenv("OUTBOX_BACKOFF_BASE_SECONDS", "2"))
+OUTBOX_BACKOFF_MAX_SECONDS = float(os.getenv("OUTBOX_BACKOFF_MAX_SECONDS", "600"))
+OUTBOX_RETENTION_HOURS = float(os.getenv("OUTBOX_RETENTION_HOURS", "72"))
+RECEIPTS_DELAY_SECONDS = float(os.getenv("RECEIPTS_DELAY_SECONDS", "900"))
+
+# Expo ticket errors that no retry will fix (KnownBadToken: push.Dispatcher skipped it)
+PERMANENT_ERRORS = {"DeviceNotRegistered", "MessageTooBig", "KnownBadToken"}
+
+# Called with (db, [(push_token, error)]) for ticket errors, before the results commit
+on_ticket_errors: Optional[Callable[[Session, List[Tuple[str, str]]], None]] = None
+
+counters = {"claimed": 0, "sent": 0, "retried": 0, "failed": 0}
+_wake: Optional[asyncio.Event] = None
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_task: Optional[asyncio.Task] = None
+_stopping = False
+_next_prune = 0.0
+
+
+def add(db: Session, key: str, push_token: Optional[str], title: str, body: str, data: dict = None) -> bool:
+    """Write a push to the outbox in db's transaction (commit is the caller's). False if the token isn't Expo's."""
+    if not push.is_expo_token(push_token):
+        return False
+    msg = push.message(push_token, title, body, {**(data or {}), "notification_id": key})
+    db.execute(
+        insert(OutboxMessage)
+        .values(idempotency_key=key, push_token=push_token, message=msg, status="pending",
+                attempts=0, next_attempt_at=datetime.utcnow(), created_at=datetime.utcnow())
+        .on_conflict_do_nothing(index_elements=["idempotency_key"])
+    )
+    return True
+
+
+def wake() -> None:
+    """Start a delivery cycle now (call after commit; safe from any thread)."""
+    if _loop is not None and _wake is not None:
+        _loop.call_soon_threadsafe(_wake.set)
+
+
+def backoff_seconds(attempts: int) -> float:
+    """Delay before attempt number attempts + 1: exponential, capped, with jitter."""
+    delay = min(OUTBOX_BACKOFF_MAX_SECONDS, OUTBOX_BACKOFF_BASE_SECONDS * 2 ** max(0, attempts - 1))
+    return delay * random.uniform(0.5, 1.0)
+
+
+def _claim(session_factory: Callable[[], Session]) -> List[tuple]:
+    """Lease a batch of due rows: [(id, message, attempts)]."""
+    now = datetime.utcnow()
+    db = session_factory()
+    try:
+        rows = db.execute(text(
+            "UPDATE outbox SET next_attempt_at = :lease_until WHERE id IN ("
+            "  SELECT id FROM outbox WHERE status = 'pending' AND next_attempt_at <= :now"
+            "  ORDER BY next_attempt_at LIMIT :batch FOR UPDATE SKIP LOCKED"
+            ") RETURNING id, message, attempts"
+        ), {"now": now, "lease_until": now + timedelta(seconds=OUTBOX_LEASE_SECONDS), "batch": OUTBOX_BATCH}).all()
+        db.commit()
+        return [tuple(row) for row in rows]
+    finally:
+        db.close()
+
+
+def _record(session_factory: Callable[[], Session], rows: List[tuple], tickets: List[Optional[dict]]) -> None:
+    """Mark accepted rows sent, reschedule or fail the rest."""
+    now = datetime.utcnow()
+    changes = []
+    ticket_errors = []
+    for (row_id, message, attempts), ticket in zip(rows, tickets):
+        attempts += 1
+        if ticket and ticket.get("status") == "ok":
+            changes.append({"id": row_id, "status": "sent", "attempts": attempts, "sent_at": now,
+                            "ticket_id": ticket.get("id"), "last_error": None,
+                            "receipt_due_at": now + timedelta(seconds=RECEIPTS_DELAY_SECONDS) if ticket.get("id") else None})
+            counters["sent"] += 1
+            continue
+        error = error_code(ticket) or "request failed"
+        if ticket:
+            ticket_errors.append((message["to"], error))
+        if error in PERMANENT_ERRORS or attempts >= OUTBOX_MAX_ATTEMPTS:
+            changes.append({"id": row_id, "status": "failed", "attempts": attempts, "last_error": error})
+            counters["failed"] += 1
+        else:
+            retry_at = now + timedelta(seconds=backoff_seconds(attempts))
+            changes.append({"id": row_id, "attempts": attempts, "next_attempt_at": retry_at, "last_error": error})
+            counters["retried"] += 1
+    db = session_factory()
+    try:
+        update_rows(db, changes)
+        if ticket_errors and on_ticket_errors is not None:
+            on_ticket_errors(db, ticket_errors)
+        db.commit()
+    finally:
+        db.close()
+
+
+def error_code(ticket_or_receipt: Optional[dict]) -> Optional[str]:
+    """Expo's error code for a ticket / receipt ("DeviceNotRegistered", ...), or its message."""
+    if not ticket_or_receipt:
+        return None
+    return (ticket_or_receipt.get("details") or {}).get("error") or ticket_or_receipt.get("message")
+
+
+def update_rows(db: Session, changes: List[dict]) -> None:
+    """Bulk UPDATE outbox rows by id: one executemany per column set (executemany needs the same columns in every row)."""
+    by_shape = {}
+    for change in changes:
+        by_shape.setdefault(tuple(sorted(change)), []).append(change)
+    for group in by_shape.values():
+        db.execute(update(OutboxMessage), group)
+
+
+def _maybe_prune(session_factory: Callable[[], Session]) -> None:
+    """Delete sent / failed rows past retention (at most hourly per instance)."""
+    global _next_prune
+    if time.monotonic() < _next_prune:
+        return
+    _next_prune = time.monotonic() + 3600
+    cutoff = datetime.utcnow() - timedelta(hours=OUTBOX_RETENTION_HOURS)
+    db = session_factory()
+    try:
+        deleted = db.query(OutboxMessage).filter(
+            OutboxMessage.status != "pending", OutboxMessage.created_at < cutoff
+        ).delete(synchronize_session=False)
+        db.commit()
+        if deleted:
+            logger.info(f"Outbox: pruned {deleted} delivered / failed row(s)")
+    finally:
+        db.close()
+
+
+async def deliver_once(session_factory: Callable[[], Session]) -> int:
+    """One cycle: claim, send, record. Returns how many rows were claimed."""
+    rows = await asyncio.to_thread(_claim, session_factory)
+    if not rows:
+        return 0
+    counters["claimed"] += len(rows)
+    tickets = await push.dispatcher.send_all([message for _, message, _ in rows])
+    await asyncio.to_thread(_record, session_factory, rows, tickets)
+    return len(rows)
+
+
+async def run_worker(session_factory: Callable[[], Session]) -> None:
+    """In-process task: deliver due rows; poll every OUTBOX_POLL_SECONDS or when woken."""
+    logger.info(f"Outbox worker started (batch {OUTBOX_BATCH}, poll {OUTBOX_POLL_SECONDS}s)")
+    while not _stopping:
+        claimed = 0
+        try:
+            claimed = await deliver_once(session_factory)
+            await asyncio.to_thread(_maybe_prune, session_factory)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Outbox delivery cycle failed: {e}")
+        if claimed >= OUTBOX_BATCH or _stopping:
+            continue  # Backlog: go again right away
+        try:
+            await asyncio.wait_for(_wake.wait(), timeout=OUTBOX_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        _wake.clear()
+
+
+def start(session_factory: Callable[[], Session]) -> None:
+    global _loop, _wake, _task, _stopping
+    if _task is None:
+        _stopping = False
+        _loop = asyncio.get_running_loop()
+        _wake = asyncio.Event()
+        _task = asyncio.create_task(run_worker(session_factory))
+
+
+async def stop(timeout: float = 2 * push.PUSH_TIMEOUT_SECONDS) -> None:
+    """Let the current cycle finish, then stop. Rows still in flight after timeout come back after the lease."""
+    global _loop, _wake, _task, _stopping
+    if _task is not None:
+        task, _task = _task, None
+        _stopping = True
+        _wake.set()
+        try:
+            await asyncio.wait_for(task, timeout=timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            pass
+    _loop = _wake = None
+
+
+def stats(db: Session) -> dict:
+    by_status = dict(db.query(OutboxMessage.status, func.count()).group_by(OutboxMessage.status).all())
+    oldest = db.query(func.min(OutboxMessage.created_at)).filter(OutboxMessage.status == "pending").scalar()
+    return {
+        "running": _task is not None,
+        "pending": by_status.get("pending", 0),
+        "sent": by_status.get("sent", 0),
+        "failed": by_status.get("failed", 0),
+        "oldest_pending": oldest.isoformat() if oldest else None,
+        "worker": dict(counters),
+    }
@@ -0,0 +1,237 @@
+"""
+Scheduled-match pre-computation for SkiPool
+
+Demand for tomorrow's scheduled matches arrives in a burst after dinner. This
+module precomputes /match-scheduled/ results for every resort and stores them
+in the scheduled_match_snapshots table with a version stamp, so peak-time
+requests are answered with a single-row read instead of re-running the matcher.
+
+Snapshots are invalidated by any write that can change the match set for a
+resort/date, and expire after PREMATCH_MAX_AGE_SECONDS as a safety net. An
+invalidation bumps the row's generation (inserting an empty row if there is none
+yet) in the writer's transaction. A computed result is only stored if the
+generation is still the one read before computing, so a result computed
+alongside a write can't put stale matches back, on any instance.
+
+It runs in one of two ways:
+    - In-process: set PREMATCH_IN_PROCESS=1 and main.py starts a periodic task
+    - Cloud Run Job (like migrate_database.py):
+        python prematch.py --yes              # Refresh tomorrow once
+        python prematch.py --yes --loop       # Keep refreshing through the evening window
+        python prematch.py --yes --date 2026-01-15
+
+Environment Variables:
+    PREMATCH_IN_PROCESS: "1" to run the refresher inside the API process (default off)
+    PREMATCH_REFRESH_SECONDS: Refresh interval during the evening window (default 300)
+    PREMATCH_MAX_AGE_SECONDS: Snapshots older than this are ignored (default 900)
+    PREMATCH_WINDOW_START_HOUR / PREMATCH_WINDOW_END_HOUR: Evening window in server
+        local hours, end exclusive (default 16 and 24)
+"""
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+import logging
+from datetime import date, datetime, timedelta
+from typing import Callable, Iterable, List, Optional, Tuple
+
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from models import ScheduledMatchSnapshot
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+PREMATCH_IN_PROCESS = os.getenv("PREMATCH_IN_PROCESS", "0") == "1"
+PREMATCH_REFRESH_SECONDS = int(os.getenv("PREMATCH_REFRESH_SECONDS", "300"))
+PREMATCH_MAX_AGE_SECONDS = int(os.getenv("PREMATCH_MAX_AGE_SECONDS", "900"))
+PREMATCH_WINDOW_START_HOUR = int(os.getenv("PREMATCH_WINDOW_START_HOUR", "16"))
+PREMATCH_WINDOW_END_HOUR = int(os.getenv("PREMATCH_WINDOW_END_HOUR", "24"))
+
+
+def new_version() -> int:
+    """Version stamp for a snapshot: epoch milliseconds (monotonic enough across instances)."""
+    return int(time.time() * 1000)
+
+
+def in_refresh_window(now: Optional[datetime] = None) -> bool:
+    """True if now falls inside the evening pre-matching window."""
+    hour = (now or datetime.now()).hour
+    return PREMATCH_WINDOW_START_HOUR <= hour < PREMATCH_WINDOW_END_HOUR
+
+
+def get_snapshot(db: Session, resort: str, target_date: date) -> Tuple[Optional[ScheduledMatchSnapshot], Optional[int]]:
+    """Return (fresh snapshot or None on miss / expiry / invalidation, generation to store against).
+
+    Read it before computing. Never raises: a missing table (migration not run yet) just
+    means a cache miss, with generation None (nothing will be stored).
+    """
+    try:
+        snap = db.query(ScheduledMatchSnapshot).filter(
+            ScheduledMatchSnapshot.resort == resort,
+            ScheduledMatchSnapshot.target_date == target_date,
+        ).first()
+    except Exception as e:
+        db.rollback()
+        logger.warning(f"Prematch snapshot read failed: {type(e).__name__}: {e}")
+        return None, None
+    if snap is None:
+        return None, 0
+    if snap.computed_at is None or (datetime.utcnow() - snap.computed_at).total_seconds() > PREMATCH_MAX_AGE_SECONDS:
+        return None, snap.generation
+    return snap, snap.generation
+
+
+def store_snapshot(db: Session, resort: str, target_date: date, matches: List[dict], generation: Optional[int]) -> Optional[int]:
+    """Store the snapshot for resort/date and commit, unless it was invalidated since generation was read.
+
+    Returns the new version, or None if it was refused or failed. Concurrent stores of the same
+    generation both land (last one wins); neither hits the unique constraint.
+    """
+    if generation is None:
+        return None
+    version = new_version()
+    try:
+        stmt = insert(ScheduledMatchSnapshot).values(
+            resort=resort,
+            target_date=target_date,
+            version=version,
+            matches=matches,
+            computed_at=datetime.utcnow(),
+            generation=generation,
+        )
+        stored = db.execute(stmt.on_conflict_do_update(
+            constraint="uq_scheduled_match_snapshot",
+            set_={"version": stmt.excluded.version, "matches": stmt.excluded.matches,
+                  "computed_at": stmt.excluded.computed_at},
+            where=ScheduledMatchSnapshot.generation == generation,
+        ).returning(ScheduledMatchSnapshot.id)).first()
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        logger.warning(f"Prematch snapshot write failed for {resort} {target_date}: {type(e).__name__}: {e}")
+        return None
+    if stored is None:
+        logger.info(f"Prematch snapshot for {resort} {target_date} not stored: invalidated while computing")
+        return None
+    return version
+
+
+def invalidate(db: Session, resort: Optional[str], target_date=None) -> None:
+    """Invalidate snapshots affected by a write: bump their generation. Runs inside the caller's
+    transaction (caller commits), so stores racing with the write are refused.
+
+    target_date=None invalidates every stored date for the resort; resort=None is a no-op.
+    """
+    if not resort:
+        return
+    try:
+        with db.begin_nested():
+            if target_date is None:
+                db.query(ScheduledMatchSnapshot).filter(ScheduledMatchSnapshot.resort == resort).update(
+                    {"generation": ScheduledMatchSnapshot.generation + 1, "computed_at": None},
+                    synchronize_session=False,
+                )
+                return
+            # An empty row when there's no snapshot yet: a compute already running must see the bump
+            stmt = insert(ScheduledMatchSnapshot).values(
+                resort=resort, target_date=target_date, version=0, matches=[], computed_at=None, generation=1,
+            )
+            db.execute(stmt.on_conflict_do_update(
+                constraint="uq_scheduled_match_snapshot",
+                set_={"generation": ScheduledMatchSnapshot.generation + 1, "computed_at": None},
+            ))
+    except Exception as e:
+        logger.warning(f"Prematch invalidation failed for {resort} {target_date}: {type(e).__name__}: {e}")
+
+
+def refresh_all(
+    session_factory: Callable[[], Session],
+    compute: Callable[[Session, str, date], list],
+    resorts: Iterable[str],
+    target_date: date,
+) -> int:
+    """Recompute and store snapshots for every resort. Returns how many were stored."""
+    stored = 0
+    db = session_factory()
+    try:
+        for resort in resorts:
+            t0 = time.perf_counter()
+            _, generation = get_snapshot(db, resort, target_date)
+            try:
+                matches = [m.model_dump() for m in compute(db, resort, target_date)]
+            except Exception as e:
+                db.rollback()
+                logger.error(f"Prematch compute failed for {resort} {target_date}: {e}")
+                continue
+            version = store_snapshot(db, resort, target_date, matches, generation)
+            if version is not None:
+                stored += 1
+                logger.info(
+                    f"🗓️  Prematched {resort} {target_date}: {len(matches)} matches "
+                    f"(version={version}, {time.perf_counter() - t0:.2f}s)"
+                )
+    finally:
+        db.close()
+    return stored
+
+
+async def run_refresher(
+    session_factory: Callable[[], Session],
+    compute: Callable[[Session, str, date], list],
+    resorts: Callable[[], List[str]],
+) -> None:
+    """In-process periodic task: refresh tomorrow's snapshots during the evening window.
+    resorts is called each cycle so hub registry reloads pick up new resorts."""
+    logger.info(f"Prematch refresher started (every {PREMATCH_REFRESH_SECONDS}s, "
+                f"window {PREMATCH_WINDOW_START_HOUR}:00-{PREMATCH_WINDOW_END_HOUR}:00)")
+    while True:
+        if in_refresh_window():
+            tomorrow = date.today() + timedelta(days=1)
+            try:
+                await asyncio.to_thread(refresh_all, session_factory, compute, resorts(), tomorrow)
+            except Exception as e:
+                logger.error(f"Prematch refresh cycle failed: {e}")
+        await asyncio.sleep(PREMATCH_REFRESH_SECONDS)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='SkiPool Scheduled Match Pre-computation')
+    parser.add_argument('--yes', action='store_true',
+                       help='Skip confirmation prompt (for automated runs)')
+    parser.add_argument('--date', default=None,
+                       help='Target date YYYY-MM-DD (default: tomorrow)')
+    parser.add_argument('--loop', action='store_true',
+                       help='Keep refreshing until the evening window closes')
+    args = parser.parse_args()
+
+    # Imported here so the store helpers above stay usable from main.py without a cycle
+    from database import SessionLocal
+    from main import compute_scheduled_matches
+    import hubs
+
+    target = datetime.strptime(args.date, "%Y-%m-%d").date() if args.date else date.today() + timedelta(days=1)
+    resorts = hubs.get_registry().resort_names()
+
+    print("=" * 60)
+    print("SkiPool Scheduled Match Pre-computation")
+    print("=" * 60)
+    print(f"\n📅 Target date: {target}")
+    print(f"🏔️  Resorts: {', '.join(resorts)}\n")
+
+    if not args.yes:
+        response = input("Continue? (yes/no): ")
+        if response.lower() not in ['yes', 'y']:
+            print("Cancelled.")
+            sys.exit(0)
+
+    while True:
+        stored = refresh_all(SessionLocal, compute_scheduled_matches, resorts, target)
+        print(f"✅ Stored {stored}/{len(resorts)} snapshots for {target}")
+        if not args.loop or not in_refresh_window():
+            break
+        time.sleep(PREMATCH_REFRESH_SECONDS)
@@ -0,0 +1,593 @@
+"""
+Pub/sub for live ride updates
+
+The location and lifecycle endpoints publish small change messages to topics
+("trip:{id}", "request:{id}", "resort:{name}"); live connections (WebSocket / SSE
+tracking in main.py) subscribe to the topics of the matched pair instead of
+polling the DB.
+
+Backends (PUBSUB_BACKEND):
+    - "memory" (default): fan-out within this process; enough for one worker
+    - "postgres": messages are also sent with NOTIFY on PUBSUB_PG_CHANNEL and every
+      instance LISTENs, so a subscriber on any Cloud Run instance sees changes made on
+      any other. Local subscribers are served immediately; outgoing NOTIFYs are sent
+      in batches every PUBSUB_PG_FLUSH_MS, coalesced like subscriber mailboxes (only
+      the newest position per entity within a batch). After a listener reconnect,
+      local subscribers are flagged as lagged so they resync from the DB.
+
+Delivery is built so a slow or stalled client can never hold up a publisher:
+    - publish() never blocks and may be called from any thread (sync endpoints run
+      in the threadpool); it only touches each subscriber's mailbox
+    - Messages published with a coalesce key (e.g. positions) replace the previous
+      undelivered message with the same topic + key, so a client that falls behind
+      gets the newest position, not a backlog of stale ones
+    - Other messages (lifecycle transitions) queue in order up to PUBSUB_QUEUE_MAX;
+      on overflow the oldest is dropped and the subscription is flagged as lagged,
+      telling the consumer to resync from the DB
+
+Every message gets a sequence number ("seq"), and the bus keeps a short per-topic
+history (recent ordered messages plus the latest coalesced one per key). since()
+answers "what changed on these topics after seq N" so streams can resume after a
+reconnect (SSE Last-Event-ID) without replaying stale positions; it returns None
+when the history no longer covers N and the caller must resync instead. Cursors
+carry a per-process boot id, so a cursor from another instance or an earlier
+process is never mistaken for a local one.
+
+Benchmark (publish throughput and end-to-end delivery):
+    python pubsub.py --bench --backend memory --messages 50000 --subscribers 100
+    python pubsub.py --bench --backend postgres     # Uses DATABASE_URL
+    Add --no-coalesce to require every message to be delivered.
+
+Environment Variables:
+    PUBSUB_BACKEND: "memory" or "postgres" (default "memory")
+    PUBSUB_PG_CHANNEL: NOTIFY channel (default "skipool_pubsub")
+    PUBSUB_PG_FLUSH_MS: Outgoing NOTIFY batching window (default 50)
+    PUBSUB_PG_POLL_SECONDS: Listener poll interval for drivers without socket
+        polling, e.g. pg8000 on Cloud Run (default 0.2)
+    PUBSUB_QUEUE_MAX: Max undelivered non-coalesced messages per subscriber (default 100)
+    PUBSUB_HISTORY: Ordered messages kept per topic for resume (default 50)
+    PUBSUB_HISTORY_TOPICS: Topics with resume history kept, least recently published
+        evicted first (default 10000)
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import select
+import asyncio
+import argparse
+import threading
+import logging
+from collections import OrderedDict, deque
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple, Union
+
+from sqlalchemy import text
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+PUBSUB_QUEUE_MAX = int(os.getenv("PUBSUB_QUEUE_MAX", "100"))
+PUBSUB_HISTORY = int(os.getenv("PUBSUB_HISTORY", "50"))
+PUBSUB_HISTORY_TOPICS = int(os.getenv("PUBSUB_HISTORY_TOPICS", "10000"))
+PUBSUB_BACKEND = os.getenv("PUBSUB_BACKEND", "memory")
+PUBSUB_PG_CHANNEL = os.getenv("PUBSUB_PG_CHANNEL", "skipool_pubsub")
+PUBSUB_PG_FLUSH_MS = float(os.getenv("PUBSUB_PG_FLUSH_MS", "50"))
+PUBSUB_PG_POLL_SECONDS = float(os.getenv("PUBSUB_PG_POLL_SECONDS", "0.2"))
+
+# Postgres NOTIFY payloads must stay under 8000 bytes
+NOTIFY_MAX_BYTES = 7900
+
+
+def trip_topic(trip_id: int) -> str:
+    return f"trip:{trip_id}"
+
+
+def request_topic(request_id: int) -> str:
+    return f"request:{request_id}"
+
+
+def resort_topic(resort: str) -> str:
+    return f"resort:{resort}"
+
+
+class Subscription:
+    """One consumer's mailbox. Created and read on the event loop; filled from any thread."""
+
+    def __init__(self, bus: "InProcessBus", max_queue: int = PUBSUB_QUEUE_MAX):
+        self.bus = bus
+        self.topics: Set[str] = set()
+        self._loop = asyncio.get_running_loop()
+        self._event = asyncio.Event()
+        self._lock = threading.Lock()
+        self._queue: deque = deque()
+        self._max_queue = max_queue
+        self._latest: Dict[Tuple[str, str], dict] = {}
+        self._lagged = False
+
+    def _deliver(self, topic: str, message: dict, coalesce_key: Optional[str]) -> str:
+        """Put a message in the mailbox. Returns "queued", "coalesced" or "dropped"."""
+        outcome = "queued"
+        with self._lock:
+            if coalesce_key is not None:
+                key = (topic, coalesce_key)
+                if key in self._latest:
+                    outcome = "coalesced"
+                self._latest[key] = message
+            else:
+                if len(self._queue) >= self._max_queue:
+                    self._queue.popleft()
+                    self._lagged = True
+                    outcome = "dropped"
+                self._queue.append(message)
+        self._wake()
+        return outcome
+
+    def _wake(self) -> None:
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            self._event.set()
+        elif not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._event.set)
+
+    def drain(self) -> Tuple[List[dict], bool]:
+        """Take everything pending without waiting: (messages, lagged).
+
+        Ordered messages come first, then the latest coalesced message per topic/key.
+        """
+        with self._lock:
+            messages = list(self._queue) + list(self._latest.values())
+            lagged = self._lagged
+            self._queue.clear()
+            self._latest.clear()
+            self._lagged = False
+            self._event.clear()
+        return messages, lagged
+
+    async def get(self) -> Tuple[List[dict], bool]:
+        """Wait until something is pending, then drain()."""
+        while True:
+            messages, lagged = self.drain()
+            if messages or lagged:
+                return messages, lagged
+            await self._event.wait()
+
+    def mark_lagged(self) -> None:
+        """Tell the consumer it may have missed messages (it should resync)."""
+        with self._lock:
+            self._lagged = True
+        self._wake()
+
+    def set_topics(self, topics: Iterable[str]) -> None:
+        """Replace the subscribed topic set (e.g. after the matched pair changes)."""
+        self.bus._set_topics(self, set(topics))
+
+    def close(self) -> None:
+        self.bus._set_topics(self, set())
+
+
+class _TopicHistory:
+    """Recent messages of one topic, for since()."""
+
+    def __init__(self):
+        self.ordered: deque = deque(maxlen=PUBSUB_HISTORY)
+        self.latest: Dict[str, dict] = {}
+        self.trimmed_seq = 0  # Highest seq that fell out of `ordered`
+
+
+class InProcessBus:
+    """Topic -> subscriptions fan-out within one worker process."""
+
+    def __init__(self):
+        self.boot_id = uuid.uuid4().hex[:8]
+        self._seq = 0
+        self._subs: Dict[str, Set[Subscription]] = {}
+        self._history: "OrderedDict[str, _TopicHistory]" = OrderedDict()
+        self._evicted_seq = 0  # Highest seq recorded in a topic history that was evicted
+        self._lock = threading.Lock()
+        # Hooks for process-local caches (only the postgres backend calls them): a message
+        # from another instance, before local subscribers see it; and messages lost while
+        # the listener was disconnected
+        self.on_remote_message: Optional[Callable[[List[str], dict], None]] = None
+        self.on_remote_gap: Optional[Callable[[], None]] = None
+        self.counters = {
+            "published": 0,
+            "delivered": 0,
+            "coalesced": 0,
+            "dropped": 0,
+        }
+
+    def subscribe(self, topics: Iterable[str] = ()) -> Subscription:
+        """New subscription (call from the event loop)."""
+        sub = Subscription(self)
+        sub.set_topics(topics)
+        return sub
+
+    def _set_topics(self, sub: Subscription, topics: Set[str]) -> None:
+        with self._lock:
+            for topic in sub.topics - topics:
+                subs = self._subs.get(topic)
+                if subs is not None:
+                    subs.discard(sub)
+                    if not subs:
+                        del self._subs[topic]
+            for topic in topics - sub.topics:
+                self._subs.setdefault(topic, set()).add(sub)
+            sub.topics = topics
+
+    name = "memory"
+
+    def start(self, engine=None) -> None:
+        """Start background work (none for the in-process bus)."""
+
+    def stop(self) -> None:
+        """Stop background work (none for the in-process bus)."""
+
+    def publish(self, topics: Union[str, Iterable[str]], message: dict, coalesce_key: Optional[str] = None) -> int:
+        """Fan a message out to the subscribers of one or more topics, once per subscriber.
+
+        coalesce_key identifies what a message supersedes (e.g. "location:trip:7"): an undelivered
+        message with the same key on the same topic is replaced. Never blocks; returns the number of
+        local subscribers reached.
+        """
+        topics = [topics] if isinstance(topics, str) else list(topics)
+        return self._fanout(topics, message, coalesce_key)
+
+    def _fanout(self, topics: List[str], message: dict, coalesce_key: Optional[str]) -> int:
+        """Deliver to this process's subscribers and record resume history."""
+        targets: Dict[Subscription, str] = {}
+        with self._lock:
+            self._seq += 1
+            message = {**message, "seq": self._seq}
+            for topic in topics:
+                self._record(topic, message, coalesce_key)
+                for sub in self._subs.get(topic, ()):
+                    targets.setdefault(sub, topic)
+        self.counters["published"] += 1
+        for sub, topic in targets.items():
+            outcome = sub._deliver(topic, message, coalesce_key)
+            self.counters["delivered"] += 1
+            if outcome != "queued":
+                self.counters[outcome] += 1
+        return len(targets)
+
+    def _record(self, topic: str, message: dict, coalesce_key: Optional[str]) -> None:
+        """Keep message in the topic's resume history (lock held)."""
+        history = self._history.get(topic)
+        if history is None:
+            history = self._history[topic] = _TopicHistory()
+            if len(self._history) > PUBSUB_HISTORY_TOPICS:
+                _, evicted = self._history.popitem(last=False)
+                seqs = [m["seq"] for m in evicted.ordered] + [m["seq"] for m in evicted.latest.values()]
+                self._evicted_seq = max([self._evicted_seq, evicted.trimmed_seq] + seqs)
+        else:
+            self._history.move_to_end(topic)
+        if coalesce_key is not None:
+            history.latest[coalesce_key] = message
+        else:
+            if len(history.ordered) == history.ordered.maxlen:
+                history.trimmed_seq = history.ordered[0]["seq"]
+            history.ordered.append(message)
+
+    def current_seq(self) -> int:
+        """Seq of the newest published message; take it *before* reading state from the DB."""
+        return self._seq
+
+    def since(self, topics: Iterable[str], after_seq: int) -> Optional[List[dict]]:
+        """Messages on topics with seq > after_seq, oldest first, only the latest per coalesce key.
+
+        Returns None if the history no longer covers after_seq (caller should resync).
+        """
+        found: Dict[int, dict] = {}
+        with self._lock:
+            if after_seq > self._seq:
+                return None
+            for topic in set(topics):
+                history = self._history.get(topic)
+                if history is None:
+                    if self._evicted_seq > after_seq:
+                        return None
+                    continue
+                if history.trimmed_seq > after_seq:
+                    return None
+                for message in list(history.ordered) + list(history.latest.values()):
+                    if message["seq"] > after_seq:
+                        found[message["seq"]] = message
+        return [found[seq] for seq in sorted(found)]
+
+    def cursor(self, seq: int) -> str:
+        """Opaque resume cursor for seq (e.g. an SSE event id)."""
+        return f"{self.boot_id}-{seq}"
+
+    def parse_cursor(self, value: Optional[str]) -> Optional[int]:
+        """seq from a cursor issued by this process, or None (missing, malformed or foreign)."""
+        if not value:
+            return None
+        boot_id, _, seq = value.strip().rpartition("-")
+        if boot_id != self.boot_id or not seq.isdigit():
+            return None
+        return int(seq)
+
+    def _mark_all_lagged(self) -> None:
+        with self._lock:
+            subs = {sub for subs in self._subs.values() for sub in subs}
+        for sub in subs:
+            sub.mark_lagged()
+
+    def stats(self) -> dict:
+        with self._lock:
+            topics = len(self._subs)
+            subscribers = len({sub for subs in self._subs.values() for sub in subs})
+            history_topics = len(self._history)
+        return {
+            "backend": self.name,
+            "topics": topics,
+            "subscribers": subscribers,
+            "history_topics": history_topics,
+            "seq": self._seq,
+            **self.counters,
+        }
+
+
+class PostgresBus(InProcessBus):
+    """In-process fan-out plus Postgres LISTEN/NOTIFY between instances."""
+
+    name = "postgres"
+
+    def __init__(self, channel: str = PUBSUB_PG_CHANNEL):
+        super().__init__()
+        self.channel = channel
+        self.engine = None
+        self._listen_pool = None
+        self._out_lock = threading.Lock()
+        self._out_ordered: List[str] = []
+        self._out_latest: "OrderedDict[Tuple[Tuple[str, ...], str], str]" = OrderedDict()
+        self._out_event = threading.Event()
+        self._running = False
+        self._threads: List[threading.Thread] = []
+        self.counters.update({
+            "notify_sent": 0,
+            "notify_batches": 0,
+            "notify_coalesced": 0,
+            "notify_errors": 0,
+            "notify_oversize": 0,
+            "notify_received": 0,
+            "listener_reconnects": 0,
+        })
+
+    def start(self, engine=None) -> None:
+        """Start the NOTIFY sender and LISTEN threads on engine (call once, at startup)."""
+        if self._running:
+            return
+        self.engine = engine
+        # Dedicated pool (same driver / connector settings) so the long-lived LISTEN
+        # connection doesn't permanently take a slot from request handlers
+        self._listen_pool = engine.pool.recreate()
+        self._running = True
+        for target, name in ((self._send_loop, "pubsub-notify"), (self._listen_loop, "pubsub-listen")):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f"Postgres pub/sub started on channel '{self.channel}' (instance {self.boot_id})")
+
+    def stop(self) -> None:
+        """Send anything still queued and stop the threads."""
+        if not self._running:
+            return
+        self._running = False
+        self._out_event.set()
+        for thread in self._threads:
+            thread.join(timeout=5)
+        self._threads = []
+        self._send_pending()
+        self._listen_pool.dispose()
+
+    def publish(self, topics: Union[str, Iterable[str]], message: dict, coalesce_key: Optional[str] = None) -> int:
+        topics = [topics] if isinstance(topics, str) else list(topics)
+        reached = self._fanout(topics, message, coalesce_key)
+        payload = json.dumps({"o": self.boot_id, "t": topics, "m": message, "k": coalesce_key}, default=str)
+        if len(payload.encode()) > NOTIFY_MAX_BYTES:
+            self.counters["notify_oversize"] += 1
+            logger.warning(f"Pub/sub message on {topics} too large for NOTIFY; delivered locally only")
+            return reached
+        with self._out_lock:
+            if coalesce_key is not None:
+                key = (tuple(topics), coalesce_key)
+                if key in self._out_latest:
+                    self.counters["notify_coalesced"] += 1
+                    del self._out_latest[key]
+                self._out_latest[key] = payload
+            else:
+                self._out_ordered.append(payload)
+        self._out_event.set()
+        return reached
+
+    def _send_pending(self) -> int:
+        with self._out_lock:
+            payloads = self._out_ordered + list(self._out_latest.values())
+            self._out_ordered = []
+            self._out_latest = OrderedDict()
+        if not payloads or self.engine is None:
+            return 0
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(
+                    text("SELECT pg_notify(:channel, p) FROM unnest(CAST(:payloads AS text[])) AS p"),
+                    {"channel": self.channel, "payloads": payloads},
+                )
+        except Exception as e:
+            self.counters["notify_errors"] += 1
+            logger.warning(f"Pub/sub NOTIFY failed ({len(payloads)} messages not sent to other instances): {e}")
+            return 0
+        self.counters["notify_sent"] += len(payloads)
+        self.counters["notify_batches"] += 1
+        return len(payloads)
+
+    def _send_loop(self) -> None:
+        while self._running:
+            self._out_event.wait()
+            self._out_event.clear()
+            if not self._running:
+                break
+            time.sleep(PUBSUB_PG_FLUSH_MS / 1000)  # Let a batch build up
+            self._send_pending()
+
+    def _handle_notification(self, payload: str) -> None:
+        try:
+            data = json.loads(payload)
+        except ValueError:
+            return
+        if data.get("o") == self.boot_id:
+            return  # Our own message, already delivered locally
+        self.counters["notify_received"] += 1
+        if self.on_remote_message is not None:
+            try:
+                self.on_remote_message(data["t"], data["m"])
+            except Exception as e:
+                logger.error(f"Pub/sub remote message hook failed: {e}")
+        self._fanout(data["t"], data["m"], data.get("k"))
+
+    def _listen_loop(self) -> None:
+        first = True
+        while self._running:
+            raw = None
+            try:
+                raw = self._listen_pool.connect()
+                conn = raw.driver_connection
+                conn.autocommit = True
+                cursor = conn.cursor()
+                cursor.execute(f'LISTEN "{self.channel}"')
+                if not first:
+                    # Anything published while we were disconnected is lost: make subscribers resync
+                    self.counters["listener_reconnects"] += 1
+                    if self.on_remote_gap is not None:
+                        self.on_remote_gap()
+                    self._mark_all_lagged()
+                first = False
+                if hasattr(conn, "poll") and hasattr(conn, "notifies"):
+                    # psycopg2: wait on the socket
+                    while self._running:
+                        if select.select([conn], [], [], 1.0)[0]:
+                            conn.poll()
+                            while conn.notifies:
+                                self._handle_notification(conn.notifies.pop(0).payload)
+                else:
+                    # pg8000: notifications arrive with the next query result
+                    while self._running:
+                        cursor.execute("SELECT 1")
+                        cursor.fetchall()
+                        while conn.notifications:
+                            self._handle_notification(conn.notifications.popleft()[2])
+                        time.sleep(PUBSUB_PG_POLL_SECONDS)
+            except Exception as e:
+                logger.warning(f"Pub/sub listener error, reconnecting: {type(e).__name__}: {e}")
+                if raw is not None:
+                    raw.invalidate()  # Don't hand a broken / LISTENing connection back to the pool
+                    raw = None
+                time.sleep(1)
+            finally:
+                if raw is not None:
+                    raw.invalidate()
+
+
+def make_bus(backend: str = PUBSUB_BACKEND) -> InProcessBus:
+    if backend == "postgres":
+        return PostgresBus()
+    if backend != "memory":
+        logger.warning(f"Unknown PUBSUB_BACKEND '{backend}', using in-process bus")
+    return InProcessBus()
+
+
+bus = make_bus()
+
+
+async def _bench(backend: str, messages: int, subscribers: int, topics: int, coalesce: bool = True) -> dict:
+    """Publish `messages` location updates over `topics` trips to `subscribers` subscriptions.
+
+    With coalesce=False every message must be delivered (like status changes), which
+    measures raw fan-out / NOTIFY throughput.
+
+    For postgres, a second bus instance (another "instance") does the publishing, so every
+    message goes through NOTIFY/LISTEN before it reaches the subscribers.
+    """
+    receiver = make_bus(backend)
+    publisher = receiver
+    if backend == "postgres":
+        from database import engine
+        publisher = make_bus(backend)
+        receiver.start(engine)
+        publisher.start(engine)
+        await asyncio.sleep(1.0)  # Let LISTEN settle
+    subs = [receiver.subscribe([trip_topic(i % topics)]) for i in range(subscribers)]
+    received = [0]
+    latencies: List[float] = []
+    done = asyncio.Event()
+    last_id = messages - 1
+
+    async def consume(sub: Subscription) -> None:
+        while not done.is_set():
+            batch, _ = await sub.get()
+            for m in batch:
+                received[0] += 1
+                latencies.append(time.perf_counter() - m["sent"])
+                if m["i"] == last_id:
+                    done.set()
+
+    tasks = [asyncio.create_task(consume(sub)) for sub in subs]
+
+    def produce() -> float:
+        t0 = time.perf_counter()
+        for i in range(messages):
+            topic = trip_topic(i % topics)
+            publisher.publish(topic, {"type": "location", "i": i, "sent": time.perf_counter()},
+                              coalesce_key=f"location:{topic}" if coalesce else None)
+        return time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    publish_s = await asyncio.to_thread(produce)
+    try:
+        await asyncio.wait_for(done.wait(), timeout=60)
+    except asyncio.TimeoutError:
+        logger.warning("Benchmark timed out waiting for the last message")
+    total_s = time.perf_counter() - t0
+    for task in tasks:
+        task.cancel()
+    if backend == "postgres":
+        publisher.stop()
+        receiver.stop()
+    lat_ms = sorted(l * 1000 for l in latencies) or [0.0]
+    return {
+        "backend": backend,
+        "messages": messages,
+        "subscribers": subscribers,
+        "topics": topics,
+        "coalesce": coalesce,
+        "publish_per_s": round(messages / publish_s),
+        "delivered": received[0],
+        "delivered_per_s": round(received[0] / total_s),
+        "coalesced_ratio": round(1 - received[0] / (messages * subscribers / topics), 3),
+        "latency_ms_p50": round(lat_ms[len(lat_ms) // 2], 2),
+        "latency_ms_p99": round(lat_ms[int(len(lat_ms) * 0.99)], 2),
+        "publisher": publisher.stats(),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='SkiPool pub/sub benchmark')
+    parser.add_argument('--bench', action='store_true', help='Run the throughput benchmark')
+    parser.add_argument('--backend', default=PUBSUB_BACKEND, choices=['memory', 'postgres'])
+    parser.add_argument('--messages', type=int, default=50000)
+    parser.add_argument('--subscribers', type=int, default=100)
+    parser.add_argument('--topics', type=int, default=50)
+    parser.add_argument('--no-coalesce', action='store_true', help='Publish non-coalesced messages')
+    args = parser.parse_args()
+    if not args.bench:
+        parser.print_help()
+        sys.exit(0)
+    result = asyncio.run(_bench(args.backend, args.messages, args.subscribers, args.topics, not args.no_coalesce))
+    print(json.dumps(result, indent=2))
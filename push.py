@@ -0,0 +1,351 @@
+"""
+Expo push client
+
+Every notification used to open its own httpx.AsyncClient: a new TCP connection, TLS
+handshake and SSL context per push. PushClient is created once at startup (main.py) and
+closed at shutdown; it keeps a pool of connections to Expo alive, speaks HTTP/2 when the
+h2 package is installed (requests multiplex over one connection) and uses separate
+connect / read timeouts, so a slow handshake fails fast instead of eating the whole budget.
+
+Dispatcher.send_all() sends a batch of messages in chunks of up to 100 per request (Expo's
+limit), with at most PUSH_CONCURRENCY chunk requests in flight, and returns Expo's ticket
+for each message. Its caller is outbox.py's worker, which keeps sends off the request path.
+Tokens in dispatcher.skip_tokens (known bad, kept current by receipts.py) are never sent:
+send_all() answers for them with a KnownBadToken error ticket.
+
+Benchmark (per-notification latency against a local stand-in for Expo's push API):
+    python push.py --bench --notifications 500
+    python push.py --bench --tls                 # Self-signed TLS (needs the openssl CLI)
+Compares a fresh client per notification (the old behaviour) with the pooled client,
+sequentially and with --concurrency parallel sends, plus the dispatcher's batches. The
+stand-in speaks HTTP/1.1 only (uvicorn), so it measures connection reuse; HTTP/2
+multiplexing adds to that against exp.host.
+
+Environment Variables:
+    EXPO_PUSH_URL: Push API endpoint (default https://exp.host/--/api/v2/push/send)
+    EXPO_RECEIPTS_URL: Receipts API endpoint (default https://exp.host/--/api/v2/push/getReceipts)
+    PUSH_HTTP2: "0" to stick to HTTP/1.1 (default "1"; needs the h2 package)
+    PUSH_MAX_CONNECTIONS: Max open connections to Expo (default 10)
+    PUSH_KEEPALIVE_CONNECTIONS: Idle connections kept for reuse (default 5)
+    PUSH_KEEPALIVE_SECONDS: How long an idle connection is kept (default 60)
+    PUSH_CONNECT_TIMEOUT_SECONDS: TCP + TLS setup timeout (default 3)
+    PUSH_TIMEOUT_SECONDS: Read / write / pool wait timeout (default 10)
+    PUSH_BATCH_SIZE: Messages per Expo request (default 100, Expo's maximum)
+    PUSH_CONCURRENCY: Chunk requests in flight at once (default 4)
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import asyncio
+import argparse
+import logging
+from typing import List, Optional
+
+import httpx
+
+try:
+    import h2  # noqa: F401  (enables httpx's HTTP/2 support)
+except ImportError:
+    h2 = None
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+EXPO_PUSH_URL = os.getenv("EXPO_PUSH_URL", "https://exp.host/--/api/v2/push/send")
+EXPO_RECEIPTS_URL = os.getenv("EXPO_RECEIPTS_URL", "https://exp.host/--/api/v2/push/getReceipts")
+PUSH_HTTP2 = os.getenv("PUSH_HTTP2", "1") == "1"
+PUSH_MAX_CONNECTIONS = int(os.getenv("PUSH_MAX_CONNECTIONS", "10"))
+PUSH_KEEPALIVE_CONNECTIONS = int(os.getenv("PUSH_KEEPALIVE_CONNECTIONS", "5"))
+PUSH_KEEPALIVE_SECONDS = float(os.getenv("PUSH_KEEPALIVE_SECONDS", "60"))
+PUSH_CONNECT_TIMEOUT_SECONDS = float(os.getenv("PUSH_CONNECT_TIMEOUT_SECONDS", "3"))
+PUSH_TIMEOUT_SECONDS = float(os.getenv("PUSH_TIMEOUT_SECONDS", "10"))
+EXPO_MAX_BATCH = 100
+EXPO_MAX_RECEIPT_IDS = 1000
+PUSH_BATCH_SIZE = max(1, min(EXPO_MAX_BATCH, int(os.getenv("PUSH_BATCH_SIZE", str(EXPO_MAX_BATCH)))))
+PUSH_CONCURRENCY = max(1, int(os.getenv("PUSH_CONCURRENCY", "4")))
+
+
+def is_expo_token(push_token: Optional[str]) -> bool:
+    return bool(push_token) and push_token.startswith("ExponentPushToken")
+
+
+def message(push_token: str, title: str, body: str, data: dict = None) -> dict:
+    """An Expo push message."""
+    return {
+        "to": push_token,
+        "sound": "default",
+        "title": title,
+        "body": body,
+        "data": data or {},
+    }
+
+
+class PushClient:
+    """Application-scoped pooled client for Expo's push API."""
+
+    def __init__(self, url: str = EXPO_PUSH_URL, http2: bool = PUSH_HTTP2, verify=True,
+                 receipts_url: str = EXPO_RECEIPTS_URL):
+        self.url = url
+        self.receipts_url = receipts_url
+        self.http2 = http2 and h2 is not None
+        if http2 and h2 is None:
+            logger.warning("PUSH_HTTP2 is on but the h2 package is missing; using HTTP/1.1")
+        self.verify = verify
+        self._client: Optional[httpx.AsyncClient] = None
+        self.counters = {"sent": 0, "ok": 0, "failed": 0, "errors": 0, "http2": 0}
+
+    async def start(self) -> None:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                http2=self.http2,
+                verify=self.verify,
+                limits=httpx.Limits(
+                    max_connections=PUSH_MAX_CONNECTIONS,
+                    max_keepalive_connections=PUSH_KEEPALIVE_CONNECTIONS,
+                    keepalive_expiry=PUSH_KEEPALIVE_SECONDS,
+                ),
+                timeout=httpx.Timeout(PUSH_TIMEOUT_SECONDS, connect=PUSH_CONNECT_TIMEOUT_SECONDS),
+                headers={"Accept": "application/json", "Accept-Encoding": "gzip, deflate"},
+            )
+
+    async def close(self) -> None:
+        if self._client is not None:
+            client, self._client = self._client, None
+            await client.aclose()
+
+    async def post(self, payload, url: Optional[str] = None) -> httpx.Response:
+        """POST one message (dict) or a batch (list) to the push API (or url) on a pooled connection."""
+        if self._client is None:
+            # Scripts and tests without the app's startup hook
+            await self.start()
+        response = await self._client.post(url or self.url, json=payload)
+        if response.http_version == "HTTP/2":
+            self.counters["http2"] += 1
+        return response
+
+    async def send_batch(self, msgs: List[dict]) -> List[Optional[dict]]:
+        """Send up to EXPO_MAX_BATCH messages in one request; Expo's ticket per message (None if the request failed)."""
+        self.counters["sent"] += len(msgs)
+        try:
+            response = await self.post(msgs)
+        except Exception as e:
+            self.counters["errors"] += len(msgs)
+            logger.error(f"Error sending {len(msgs)} push notification(s): {e}")
+            return [None] * len(msgs)
+        if response.status_code != 200:
+            self.counters["failed"] += len(msgs)
+            logger.error(f"Expo push API error: {response.status_code} - {response.text}")
+            return [None] * len(msgs)
+        tickets = response.json().get("data") or []
+        tickets = (tickets + [None] * len(msgs))[:len(msgs)]
+        for msg, ticket in zip(msgs, tickets):
+            if ticket and ticket.get("status") == "ok":
+                self.counters["ok"] += 1
+            else:
+                self.counters["failed"] += 1
+                logger.warning(f"Push notification to {msg['to'][:20]}... failed: {ticket}")
+        return tickets
+
+    async def get_receipts(self, ticket_ids: List[str]) -> Optional[dict]:
+        """Receipts for up to EXPO_MAX_RECEIPT_IDS tickets: {ticket_id: receipt}; ids not ready yet are absent.
+        None if the request failed."""
+        try:
+            response = await self.post({"ids": ticket_ids}, url=self.receipts_url)
+        except Exception as e:
+            logger.error(f"Error fetching {len(ticket_ids)} push receipt(s): {e}")
+            return None
+        if response.status_code != 200:
+            logger.error(f"Expo receipts API error: {response.status_code} - {response.text}")
+            return None
+        return response.json().get("data") or {}
+
+    def stats(self) -> dict:
+        return {"url": self.url, "http2_enabled": self.http2, "open": self._client is not None, **self.counters}
+
+
+client = PushClient()
+
+
+# Ticket send_all() returns for a message it didn't send because its token is known bad
+KNOWN_BAD_TICKET = {"status": "error", "message": "Push token is known to be bad", "details": {"error": "KnownBadToken"}}
+
+
+class Dispatcher:
+    """Sends batches in Expo-sized chunks under a concurrency limit, skipping known-bad tokens."""
+
+    def __init__(self, push_client: PushClient, batch_size: int = PUSH_BATCH_SIZE,
+                 concurrency: int = PUSH_CONCURRENCY):
+        self.client = push_client
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self._gate: Optional[asyncio.Semaphore] = None
+        self._gate_loop: Optional[asyncio.AbstractEventLoop] = None
+        self._in_flight = 0
+        self.skip_tokens: frozenset = frozenset()  # Replaced wholesale, never mutated (read from any thread)
+        self.counters = {"skipped": 0, "requests": 0}
+
+    async def send_all(self, msgs: List[dict]) -> List[Optional[dict]]:
+        """Send msgs now, in chunks under the concurrency limit; Expo's tickets in order."""
+        loop = asyncio.get_running_loop()
+        if self._gate_loop is not loop:
+            self._gate, self._gate_loop = asyncio.Semaphore(self.concurrency), loop
+        skip = self.skip_tokens
+        sendable = [msg for msg in msgs if msg["to"] not in skip]
+        chunks = [sendable[i:i + self.batch_size] for i in range(0, len(sendable), self.batch_size)]
+        results = await asyncio.gather(*(self._send_chunk(chunk) for chunk in chunks))
+        sent = iter([ticket for tickets in results for ticket in tickets])
+        self.counters["skipped"] += len(msgs) - len(sendable)
+        return [KNOWN_BAD_TICKET if msg["to"] in skip else next(sent) for msg in msgs]
+
+    async def _send_chunk(self, chunk: List[dict]) -> List[Optional[dict]]:
+        async with self._gate:
+            self.counters["requests"] += 1
+            self._in_flight += 1
+            try:
+                return await self.client.send_batch(chunk)
+            finally:
+                self._in_flight -= 1
+
+    def stats(self) -> dict:
+        return {"in_flight": self._in_flight, "skip_tokens": len(self.skip_tokens),
+                "batch_size": self.batch_size, "concurrency": self.concurrency, **self.counters}
+
+
+dispatcher = Dispatcher(client)
+
+
+# --- Benchmark ---
+async def _stand_in_expo(scope, receive, send):
+    """Minimal ASGI stand-in for Expo's push API: accepts one message or a list of them."""
+    if scope["type"] != "http":
+        return
+    body = b""
+    more = True
+    while more:
+        event = await receive()
+        body += event.get("body", b"")
+        more = event.get("more_body", False)
+    payload = json.loads(body or b"{}")
+    ticket = lambda: {"status": "ok", "id": str(uuid.uuid4())}
+    data = [ticket() for _ in payload] if isinstance(payload, list) else ticket()
+    out = json.dumps({"data": data}).encode()
+    await send({"type": "http.response.start", "status": 200,
+                "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(out)).encode())]})
+    await send({"type": "http.response.body", "body": out})
+
+
+def _self_signed_cert(directory: str):
+    import subprocess
+    cert, key = os.path.join(directory, "cert.pem"), os.path.join(directory, "key.pem")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1", "-subj", "/CN=localhost",
+         "-addext", "subjectAltName=DNS:localhost,IP:127.0.0.1", "-keyout", key, "-out", cert],
+        check=True, capture_output=True,
+    )
+    return cert, key
+
+
+def _summary(latencies: List[float], elapsed: float) -> dict:
+    ms = sorted(l * 1000 for l in latencies)
+    return {
+        "per_s": round(len(ms) / elapsed),
+        "latency_ms_mean": round(sum(ms) / len(ms), 2),
+        "latency_ms_p50": round(ms[len(ms) // 2], 2),
+        "latency_ms_p95": round(ms[int(len(ms) * 0.95)], 2),
+    }
+
+
+async def _bench(notifications: int, concurrency: int, tls: bool) -> dict:
+    """Per-notification latency: new client per push (old behaviour) vs the pooled client."""
+    import socket
+    import tempfile
+    import threading
+    import ssl
+    import uvicorn
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    with tempfile.TemporaryDirectory() as tmp:
+        ssl_args, verify = {}, True
+        if tls:
+            cert, key = _self_signed_cert(tmp)
+            ssl_args = {"ssl_certfile": cert, "ssl_keyfile": key}
+            verify = ssl.create_default_context(cafile=cert)
+        server = uvicorn.Server(uvicorn.Config(_stand_in_expo, host="127.0.0.1", port=port, log_level="warning", **ssl_args))
+        thread = threading.Thread(target=server.run, daemon=True)
+        thread.start()
+        while not server.started:
+            if not thread.is_alive():
+                raise RuntimeError("Stand-in server failed to start")
+            await asyncio.sleep(0.05)
+        url = f"{'https' if tls else 'http'}://127.0.0.1:{port}/--/api/v2/push/send"
+        msg = message("ExponentPushToken[bench]", "Benchmark", "Hello")
+
+        async def fresh_client_send() -> None:
+            async with httpx.AsyncClient(verify=verify) as one_off:
+                (await one_off.post(url, json=msg, timeout=10.0)).raise_for_status()
+
+        pooled = PushClient(url=url, verify=verify)
+        await pooled.start()
+
+        async def pooled_send() -> None:
+            (await pooled.post(msg)).raise_for_status()
+
+        async def batched(n: int) -> dict:
+            batcher = Dispatcher(pooled)
+            t0 = time.perf_counter()
+            await batcher.send_all([msg] * n)
+            elapsed = time.perf_counter() - t0
+            return {"per_s": round(n / elapsed), "elapsed_ms": round(elapsed * 1000, 1),
+                    "requests": batcher.counters["requests"]}
+
+        async def run(send_one, parallel: int) -> dict:
+            latencies: List[float] = []
+            gate = asyncio.Semaphore(parallel)
+
+            async def timed() -> None:
+                async with gate:
+                    t0 = time.perf_counter()
+                    await send_one()
+                    latencies.append(time.perf_counter() - t0)
+
+            await send_one()  # Warm-up
+            t0 = time.perf_counter()
+            await asyncio.gather(*(timed() for _ in range(notifications)))
+            return _summary(latencies, time.perf_counter() - t0)
+
+        try:
+            return {
+                "notifications": notifications,
+                "tls": tls,
+                "concurrency": concurrency,
+                "fresh_client_sequential": await run(fresh_client_send, 1),
+                "pooled_sequential": await run(pooled_send, 1),
+                "fresh_client_concurrent": await run(fresh_client_send, concurrency),
+                "pooled_concurrent": await run(pooled_send, concurrency),
+                "dispatcher_batched": await batched(notifications),
+            }
+        finally:
+            await pooled.close()
+            server.should_exit = True
+            thread.join(timeout=5)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='SkiPool Expo push client benchmark')
+    parser.add_argument('--bench', action='store_true', help='Run the latency benchmark')
+    parser.add_argument('--notifications', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--tls', action='store_true', help='Serve the stand-in over self-signed TLS')
+    args = parser.parse_args()
+    if not args.bench:
+        parser.print_help()
+        sys.exit(0)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    result = asyncio.run(_bench(args.notifications, args.concurrency, args.tls))
+    print(json.dumps(result, indent=2))
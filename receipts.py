@@ -0,0 +1,247 @@
+"""
+Push receipt polling and bad-token pruning
+
+A ticket from Expo's send API only says Expo accepted the message; whether it reached the
+device is in the receipt, available some minutes later and kept for a day. Nobody checked
+them, so tokens of uninstalled apps stayed on trips and ride requests and every later push
+to them was wasted.
+
+Worker (one per instance; claims like outbox.py: FOR UPDATE SKIP LOCKED plus a lease):
+    - Outbox rows Expo accepted carry receipt_due_at (sent_at + RECEIPTS_DELAY_SECONDS)
+    - Each cycle claims up to 1000 due tickets (Expo's limit per request), fetches their
+      receipts through the pooled push.client and clears receipt_due_at
+    - ok: the token's failure count is reset
+    - DeviceNotRegistered: the row is failed and the token is cleared from every Trip and
+      RideRequest holding it (ORM writes, so entity_cache and the change feed see them)
+    - MessageRateExceeded: the row goes back to the outbox with backoff
+    - any other error: the row is failed and counts against the token
+    - no receipt yet: asked again after the lease, given up after RECEIPTS_EXPIRE_HOURS
+
+Per-token failures live in push_token_failures; outbox.py's ticket errors count too
+(outbox.on_ticket_errors). A token is known bad after DeviceNotRegistered or
+PUSH_TOKEN_MAX_FAILURES failures in a row; every cycle loads the known-bad set into
+push.dispatcher.skip_tokens, so no instance sends to them. Registering a token again
+(POST /register-push-token) forgets its failures.
+
+Environment Variables:
+    RECEIPTS_POLL_SECONDS: How often the worker looks for due receipts (default 60)
+    RECEIPTS_LEASE_SECONDS: How long claimed tickets are hidden from other workers (default 300)
+    RECEIPTS_EXPIRE_HOURS: Stop asking for a missing receipt after this long (default 24)
+    PUSH_TOKEN_MAX_FAILURES: Failures in a row before a token is skipped (default 5)
+    PUSH_TOKEN_FAILURE_RETENTION_DAYS: How long failure records are kept (default 30)
+"""
+
+import os
+import time
+import asyncio
+import logging
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import text, or_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+import push
+import outbox
+from models import PushTokenFailure, RideRequest, Trip
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+RECEIPTS_POLL_SECONDS = float(os.getenv("RECEIPTS_POLL_SECONDS", "60"))
+RECEIPTS_LEASE_SECONDS = float(os.getenv("RECEIPTS_LEASE_SECONDS", "300"))
+RECEIPTS_EXPIRE_HOURS = float(os.getenv("RECEIPTS_EXPIRE_HOURS", "24"))
+PUSH_TOKEN_MAX_FAILURES = int(os.getenv("PUSH_TOKEN_MAX_FAILURES", "5"))
+PUSH_TOKEN_FAILURE_RETENTION_DAYS = float(os.getenv("PUSH_TOKEN_FAILURE_RETENTION_DAYS", "30"))
+
+DEVICE_NOT_REGISTERED = "DeviceNotRegistered"
+RATE_EXCEEDED = "MessageRateExceeded"
+# Errors that say nothing about the token itself
+NOT_TOKEN_ERRORS = {RATE_EXCEEDED, "MessageTooBig", "InvalidCredentials", "KnownBadToken"}
+
+counters = {"checked": 0, "ok": 0, "errors": 0, "requeued": 0, "expired": 0, "tokens_cleared": 0}
+_task: Optional[asyncio.Task] = None
+_next_prune = 0.0
+
+
+def record_failures(db: Session, failures: List[Tuple[str, str]]) -> None:
+    """Count failed deliveries [(push_token, error)] against their tokens; clear DeviceNotRegistered tokens.
+    Runs in db's transaction (commit is the caller's)."""
+    counted = [(token, error) for token, error in failures if error not in NOT_TOKEN_ERRORS]
+    if not counted:
+        return
+    now = datetime.utcnow()
+    per_token = Counter(token for token, _ in counted)
+    last_error = dict(counted)
+    stmt = insert(PushTokenFailure).values([
+        {"push_token": token, "failures": n, "last_error": last_error[token], "last_failure_at": now}
+        for token, n in per_token.items()
+    ])
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=["push_token"],
+        set_={
+            "failures": PushTokenFailure.failures + stmt.excluded.failures,
+            "last_error": stmt.excluded.last_error,
+            "last_failure_at": stmt.excluded.last_failure_at,
+        },
+    ))
+    dead = {token for token, error in counted if error == DEVICE_NOT_REGISTERED}
+    if dead:
+        _clear_tokens(db, dead)
+        # This instance stops sending to them now; others on their next refresh
+        push.dispatcher.skip_tokens = push.dispatcher.skip_tokens | dead
+
+
+def record_successes(db: Session, tokens: Iterable[str]) -> None:
+    """A delivered receipt resets a token's count (DeviceNotRegistered stays until the token is registered again)."""
+    tokens = list(tokens)
+    if tokens:
+        db.query(PushTokenFailure).filter(
+            PushTokenFailure.push_token.in_(tokens), PushTokenFailure.last_error != DEVICE_NOT_REGISTERED
+        ).delete(synchronize_session=False)
+
+
+def forget(db: Session, token: str) -> None:
+    """The app registered this token (again): drop its failure record."""
+    db.query(PushTokenFailure).filter(PushTokenFailure.push_token == token).delete(synchronize_session=False)
+    push.dispatcher.skip_tokens = push.dispatcher.skip_tokens - {token}
+
+
+def _clear_tokens(db: Session, tokens: set) -> None:
+    cleared = 0
+    for model in (Trip, RideRequest):
+        for row in db.query(model).filter(model.push_token.in_(list(tokens))):
+            row.push_token = None
+            cleared += 1
+    counters["tokens_cleared"] += cleared
+    logger.info(f"Push receipts: cleared {len(tokens)} unregistered token(s) from {cleared} trip(s) / request(s)")
+
+
+def refresh_skip_tokens(db: Session) -> None:
+    """Load the known-bad tokens into push.dispatcher.skip_tokens."""
+    rows = db.query(PushTokenFailure.push_token).filter(or_(
+        PushTokenFailure.last_error == DEVICE_NOT_REGISTERED,
+        PushTokenFailure.failures >= PUSH_TOKEN_MAX_FAILURES,
+    )).all()
+    push.dispatcher.skip_tokens = frozenset(token for (token,) in rows)
+
+
+def _claim(session_factory: Callable[[], Session]) -> List[tuple]:
+    """Lease a batch of due tickets: [(id, ticket_id, push_token, attempts, sent_at)]."""
+    now = datetime.utcnow()
+    db = session_factory()
+    try:
+        rows = db.execute(text(
+            "UPDATE outbox SET receipt_due_at = :lease_until WHERE id IN ("
+            "  SELECT id FROM outbox WHERE receipt_due_at <= :now"
+            "  ORDER BY receipt_due_at LIMIT :batch FOR UPDATE SKIP LOCKED"
+            ") RETURNING id, ticket_id, push_token, attempts, sent_at"
+        ), {"now": now, "lease_until": now + timedelta(seconds=RECEIPTS_LEASE_SECONDS),
+            "batch": push.EXPO_MAX_RECEIPT_IDS}).all()
+        db.commit()
+        return [tuple(row) for row in rows]
+    finally:
+        db.close()
+
+
+def _apply(session_factory: Callable[[], Session], rows: List[tuple], receipts: Dict[str, dict]) -> None:
+    """Settle each claimed row by its receipt and update token health, in one transaction."""
+    now = datetime.utcnow()
+    expired_before = now - timedelta(hours=RECEIPTS_EXPIRE_HOURS)
+    changes, delivered, failures = [], set(), []
+    for row_id, ticket_id, token, attempts, sent_at in rows:
+        receipt = receipts.get(ticket_id)
+        if receipt is None:
+            if sent_at is None or sent_at < expired_before:
+                changes.append({"id": row_id, "receipt_due_at": None})
+                counters["expired"] += 1
+            continue  # Not ready yet: the lease brings it back
+        counters["checked"] += 1
+        if receipt.get("status") == "ok":
+            changes.append({"id": row_id, "receipt_due_at": None})
+            delivered.add(token)
+            counters["ok"] += 1
+            continue
+        error = outbox.error_code(receipt) or "unknown"
+        failures.append((token, error))
+        counters["errors"] += 1
+        if error == RATE_EXCEEDED and attempts < outbox.OUTBOX_MAX_ATTEMPTS:
+            changes.append({"id": row_id, "receipt_due_at": None, "status": "pending", "last_error": error,
+                            "next_attempt_at": now + timedelta(seconds=outbox.backoff_seconds(attempts))})
+            counters["requeued"] += 1
+        else:
+            changes.append({"id": row_id, "receipt_due_at": None, "status": "failed", "last_error": error})
+    db = session_factory()
+    try:
+        outbox.update_rows(db, changes)
+        record_successes(db, delivered - {token for token, _ in failures})
+        record_failures(db, failures)
+        db.commit()
+    finally:
+        db.close()
+
+
+def _refresh_and_prune(session_factory: Callable[[], Session]) -> None:
+    """Reload known-bad tokens; drop stale failure records (at most hourly per instance)."""
+    global _next_prune
+    db = session_factory()
+    try:
+        if time.monotonic() >= _next_prune:
+            _next_prune = time.monotonic() + 3600
+            cutoff = datetime.utcnow() - timedelta(days=PUSH_TOKEN_FAILURE_RETENTION_DAYS)
+            db.query(PushTokenFailure).filter(PushTokenFailure.last_failure_at < cutoff).delete(synchronize_session=False)
+            db.commit()
+        refresh_skip_tokens(db)
+    finally:
+        db.close()
+
+
+async def check_once(session_factory: Callable[[], Session]) -> int:
+    """One cycle: claim due tickets, fetch their receipts, apply them. Returns how many were claimed."""
+    rows = await asyncio.to_thread(_claim, session_factory)
+    if rows:
+        receipts = await push.client.get_receipts([ticket_id for _, ticket_id, _, _, _ in rows])
+        if receipts is not None:
+            await asyncio.to_thread(_apply, session_factory, rows, receipts)
+    await asyncio.to_thread(_refresh_and_prune, session_factory)
+    return len(rows)
+
+
+async def run_worker(session_factory: Callable[[], Session]) -> None:
+    """In-process task: check due receipts every RECEIPTS_POLL_SECONDS (right away while there's a backlog)."""
+    logger.info(f"Push receipt worker started (every {RECEIPTS_POLL_SECONDS}s)")
+    while True:
+        claimed = 0
+        try:
+            claimed = await check_once(session_factory)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Push receipt cycle failed: {e}")
+        if claimed < push.EXPO_MAX_RECEIPT_IDS:
+            await asyncio.sleep(RECEIPTS_POLL_SECONDS)
+
+
+def start(session_factory: Callable[[], Session]) -> None:
+    global _task
+    if _task is None:
+        _task = asyncio.create_task(run_worker(session_factory))
+
+
+async def stop() -> None:
+    """Stop the worker. Tickets it had claimed come back after the lease."""
+    global _task
+    if _task is not None:
+        task, _task = _task, None
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+
+def stats() -> dict:
+    return {"running": _task is not None, "skip_tokens": len(push.dispatcher.skip_tokens), **counters}
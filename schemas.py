@@ -47,6 +47,14 @@ class LocationUpdate(BaseModel):
     current_lat: float
     current_lng: float
 
+class LocationFix(BaseModel):
+    lat: float
+    lng: float
+    timestamp: datetime  # When the device took the fix (ISO 8601; naive values are treated as UTC)
+
+class LocationBatch(BaseModel):
+    fixes: List[LocationFix]
+
 # --- RIDE REQUEST SCHEMAS (Passenger) ---
 class RideRequestCreate(RideRequestBase):
     # CHANGED: Made Optional so it doesn't crash if using a text address instead
@@ -85,4 +93,12 @@ class ScheduledMatch(BaseModel):
     driver_departure_time: str
     passenger_departure_time: str
     hub_distance_driver: float  # km
-    hub_distance_passenger: float  # km
\ No newline at end of file
+    hub_distance_passenger: float  # km
+
+class PassengerPoint(BaseModel):
+    lat: float
+    lng: float
+
+class OptimalHubBatchRequest(BaseModel):
+    trip_id: int
+    passengers: List[PassengerPoint]
@@ -154,11 +154,16 @@ def wait_for_driver_trip(base_url: str, expected_name: str, resort: str, timeout
     
     start = time.time()
     dots = 0
+    cursor = None
     while time.time() - start < timeout:
         try:
-            resp = requests.get(f"{base_url}/trips/active")
+            # Change feed: the first call lists active trips, later calls only what changed since
+            resp = requests.get(f"{base_url}/changes", params={"since": cursor} if cursor else None)
             if resp.status_code == 200:
-                trips = resp.json()
+                feed = resp.json()
+                fields = feed["trips"]["fields"]
+                trips = [dict(zip(fields, row)) for row in feed["trips"]["rows"]]
+                trips = [t for t in trips if t["active"]]
                 # region agent log
                 import json
                 with open('/Users/ashley/skipool/.cursor/debug.log', 'a') as f:
@@ -168,6 +173,9 @@ def wait_for_driver_trip(base_url: str, expected_name: str, resort: str, timeout
                     if trip.get('driver_name') == expected_name and trip.get('resort') == resort:
                         print_success(f"Driver detected! Trip ID: {trip['id']}")
                         return trip
+                cursor = feed["cursor"]  # None after a reset: start over
+                if feed["more"]:
+                    continue
         except Exception as e:
             print_warning(f"Error polling for driver: {e}")
         
@@ -790,6 +790,157 @@ def test_edge_cases(base_url: str) -> bool:
         return False
 
 
+# SQL statements per call for the pair endpoints (X-DB-Queries, API started with DB_QUERY_COUNT=1).
+# Reads load both sides of the pair in one statement; writes add their UPDATEs and refreshes.
+QUERY_BUDGETS = {
+    "GET matched-passenger": 1,
+    "GET matched-driver": 1,
+    "GET trip scheduled-match": 1,
+    "GET request scheduled-match": 1,
+    "GET rides/state (trip)": 1,
+    "GET rides/state (request)": 1,
+    "GET hubs-for-match": 1,
+    "POST accept-driver": 5,
+    "POST trip confirm-pickup": 4,
+    "POST request confirm-pickup": 5,
+    "POST trip complete": 4,
+}
+
+
+def test_query_counts(base_url: str) -> bool:
+    """Regression check: pair endpoints must not fall back to one query per side"""
+    print_header("Test: Query Counts (pair endpoints)")
+    scenario = "Query Counts"
+    
+    resp = requests.get(f"{base_url}/health")
+    if "X-DB-Queries" not in resp.headers:
+        print_info("Skipped: start the API with DB_QUERY_COUNT=1 to enable query counting")
+        return True
+    
+    all_passed = True
+    
+    def check(label: str, resp) -> None:
+        nonlocal all_passed
+        count = int(resp.headers.get("X-DB-Queries", "-1"))
+        budget = QUERY_BUDGETS[label]
+        passed = resp.status_code == 200 and 0 <= count <= budget
+        if passed:
+            print_pass(f"{label}: {count} statement(s) (budget {budget})")
+        else:
+            print_fail(f"{label}: status {resp.status_code}, {count} statement(s) (budget {budget})")
+            all_passed = False
+        TestResult(scenario, label, passed, f"{count} / {budget} statements")
+    
+    try:
+        origin = DRIVER_ORIGINS[0]
+        pickup = PASSENGER_PICKUPS[0]
+        resp = requests.post(f"{base_url}/trips/", json={
+            "driver_name": "Test Driver (Query Counts)",
+            "resort": "Solitude",
+            "departure_time": "Now",
+            "available_seats": 3,
+            "is_realtime": True,
+            "current_lat": origin['lat'],
+            "current_lng": origin['lng'],
+        })
+        trip_id = resp.json()['id']
+        created_trip_ids.append(trip_id)
+        resp = requests.post(f"{base_url}/ride-requests/", json={
+            "passenger_name": "Test Passenger (Query Counts)",
+            "resort": "Solitude",
+            "departure_time": "Now",
+            "lat": pickup['lat'],
+            "lng": pickup['lng'],
+        })
+        request_id = resp.json()['id']
+        
+        check("POST accept-driver", requests.post(f"{base_url}/ride-requests/{request_id}/accept-driver", params={"trip_id": trip_id}))
+        check("GET matched-passenger", requests.get(f"{base_url}/trips/{trip_id}/matched-passenger"))
+        check("GET matched-driver", requests.get(f"{base_url}/ride-requests/{request_id}/matched-driver"))
+        check("GET trip scheduled-match", requests.get(f"{base_url}/trips/{trip_id}/scheduled-match"))
+        check("GET request scheduled-match", requests.get(f"{base_url}/ride-requests/{request_id}/scheduled-match"))
+        check("GET rides/state (trip)", requests.get(f"{base_url}/rides/state", params={"trip_id": trip_id}))
+        check("GET rides/state (request)", requests.get(f"{base_url}/rides/state", params={"request_id": request_id}))
+        check("GET hubs-for-match", requests.get(f"{base_url}/hubs-for-match/", params={"trip_id": trip_id, "request_id": request_id}))
+        check("POST trip confirm-pickup", requests.post(f"{base_url}/trips/{trip_id}/confirm-pickup"))
+        check("POST request confirm-pickup", requests.post(f"{base_url}/ride-requests/{request_id}/confirm-pickup"))
+        check("POST trip complete", requests.post(f"{base_url}/trips/{trip_id}/complete"))
+        
+        requests.delete(f"{base_url}/ride-requests/{request_id}")
+        return all_passed
+        
+    except Exception as e:
+        print_fail(f"Query count test failed with exception: {e}")
+        TestResult(scenario, "Exception", False, str(e))
+        return False
+
+
+def test_conditional_gets(base_url: str) -> bool:
+    """Polling GETs answer 304 while unchanged and a fresh ETag after a change"""
+    print_header("Test: Conditional GETs (ETag / If-None-Match)")
+    scenario = "Conditional GETs"
+    all_passed = True
+    
+    def check(label: str, passed: bool, details: str) -> None:
+        nonlocal all_passed
+        if passed:
+            print_pass(f"{label}: {details}")
+        else:
+            print_fail(f"{label}: {details}")
+            all_passed = False
+        TestResult(scenario, label, passed, details)
+    
+    def revalidate(label: str, url: str, params: dict = None) -> str:
+        resp = requests.get(url, params=params)
+        etag = resp.headers.get("ETag")
+        again = requests.get(url, params=params, headers={"If-None-Match": etag or ""})
+        check(label, resp.status_code == 200 and bool(etag) and again.status_code == 304,
+              f"{resp.status_code} then {again.status_code} (ETag {etag})")
+        return etag
+    
+    try:
+        origin = DRIVER_ORIGINS[0]
+        pickup = PASSENGER_PICKUPS[0]
+        resp = requests.post(f"{base_url}/trips/", json={
+            "driver_name": "Test Driver (ETags)",
+            "resort": "Solitude",
+            "departure_time": "Now",
+            "available_seats": 3,
+            "is_realtime": True,
+            "current_lat": origin['lat'],
+            "current_lng": origin['lng'],
+        })
+        trip_id = resp.json()['id']
+        created_trip_ids.append(trip_id)
+        resp = requests.post(f"{base_url}/ride-requests/", json={
+            "passenger_name": "Test Passenger (ETags)",
+            "resort": "Solitude",
+            "departure_time": "Now",
+            "lat": pickup['lat'],
+            "lng": pickup['lng'],
+        })
+        request_id = resp.json()['id']
+        
+        etag = revalidate("GET trip", f"{base_url}/trips/{trip_id}")
+        requests.post(f"{base_url}/ride-requests/{request_id}/accept-driver", params={"trip_id": trip_id})
+        resp = requests.get(f"{base_url}/trips/{trip_id}", headers={"If-None-Match": etag or ""})
+        check("GET trip after accept", resp.status_code == 200 and resp.headers.get("ETag") != etag,
+              f"{resp.status_code}, ETag changed: {resp.headers.get('ETag') != etag}")
+        
+        revalidate("GET ride request", f"{base_url}/ride-requests/{request_id}")
+        revalidate("GET matched-driver", f"{base_url}/ride-requests/{request_id}/matched-driver")
+        revalidate("GET matched-passenger", f"{base_url}/trips/{trip_id}/matched-passenger")
+        revalidate("GET rides/state", f"{base_url}/rides/state", {"request_id": request_id})
+        
+        requests.delete(f"{base_url}/ride-requests/{request_id}")
+        return all_passed
+        
+    except Exception as e:
+        print_fail(f"Conditional GET test failed with exception: {e}")
+        TestResult(scenario, "Exception", False, str(e))
+        return False
+
+
 def write_markdown_report(base_url: str, wipe_performed: bool):
     """Write test results to a markdown file"""
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -884,6 +1035,8 @@ def main():
     results.append(("Ride Now Lifecycle", test_ride_now_lifecycle(base_url)))
     results.append(("Scheduled Ride Lifecycle", test_scheduled_ride_lifecycle(base_url)))
     results.append(("Edge Cases", test_edge_cases(base_url)))
+    results.append(("Query Counts", test_query_counts(base_url)))
+    results.append(("Conditional GETs", test_conditional_gets(base_url)))
     
     # Cleanup
     cleanup_test_data(base_url)